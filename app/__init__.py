@@ -19,6 +19,38 @@ def create_app(config_class=Config):
     db.init_app(app)
     login_manager.init_app(app)
 
+    # Initialize file caches with app
+    from app.files.cache import listing_cache
+    from app.files.usage import storage_usage
+    from app.files.sampler import system_sampler
+    from app.files.search_index import search_index
+    from app.files.content_index import content_index
+    from app.files.catalog import catalog
+    from app.files.watcher import file_watcher
+    from app.files.downloads import download_manager
+    from app.files.compression import response_compressor
+    from app.files.hotcache import hot_cache
+    from app.files.prefetch import prefetcher
+    from app.files.uploads import upload_manager
+    from app.files.dedup import dedup_index
+    listing_cache.init_app(app)
+    storage_usage.init_app(app)
+    system_sampler.init_app(app)
+    search_index.init_app(app)
+    content_index.init_app(app)
+    catalog.init_app(app)
+    file_watcher.init_app(app)
+    download_manager.init_app(app)
+    response_compressor.init_app(app)
+    hot_cache.init_app(app)
+    prefetcher.init_app(app)
+    upload_manager.init_app(app)
+    dedup_index.init_app(app)
+
+    # Keep caches and indexes in line with changes made outside the web UI
+    for subscriber in (listing_cache, storage_usage, search_index, content_index, catalog, hot_cache, dedup_index):
+        file_watcher.subscribe(subscriber.handle_changes)
+
     # Ensure storage directory exists
     os.makedirs(app.config['STORAGE_PATH'], exist_ok=True)
 
@@ -50,3 +50,67 @@ class SharedLink(db.Model):
 
     def __repr__(self):
         return f'<SharedLink {self.token}>'
+
+class BandwidthLimit(db.Model):
+    """Download rate limit of a user or of a share link"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, unique=True)
+    shared_link_id = db.Column(db.Integer, db.ForeignKey('shared_link.id'), nullable=True, unique=True)
+    rate = db.Column(db.BigInteger, default=0)  # bytes per second, 0 is unlimited
+
+    user = db.relationship('User', backref=db.backref('bandwidth_limit', uselist=False))
+    shared_link = db.relationship('SharedLink', backref=db.backref('bandwidth_limit', uselist=False, cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return f'<BandwidthLimit {self.rate}>'
+
+class CatalogEntry(db.Model):
+    """A file or directory under STORAGE_PATH, maintained by the catalog scanner"""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), index=True, unique=True)  # relative to STORAGE_PATH, '' is the root
+    parent = db.Column(db.String(1024), nullable=True)
+    name = db.Column(db.String(255))
+    is_dir = db.Column(db.Boolean, default=False)
+    size = db.Column(db.BigInteger, default=0)
+    mtime_ns = db.Column(db.BigInteger, default=0)
+    inode = db.Column(db.BigInteger, nullable=True)
+    mime_type = db.Column(db.String(127), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_catalog_entry_parent_name', 'parent', 'name'),
+        db.Index('ix_catalog_entry_parent_size', 'parent', 'size'),
+        db.Index('ix_catalog_entry_parent_mtime', 'parent', 'mtime_ns'),
+        db.Index('ix_catalog_entry_size', 'size'),
+    )
+
+    def __repr__(self):
+        return f'<CatalogEntry {self.path}>'
+
+class UploadSession(db.Model):
+    """A resumable upload, received into a hidden partial file in its target directory"""
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(64), unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    target_dir = db.Column(db.String(1024))  # relative to STORAGE_PATH, '' is the root
+    filename = db.Column(db.String(255))
+    size = db.Column(db.BigInteger)
+    fingerprint = db.Column(db.String(64), nullable=True)  # set by the client to recognize the file when resuming
+    created_at = db.Column(db.DateTime, default=get_utc_now)
+    updated_at = db.Column(db.DateTime, default=get_utc_now, index=True)
+
+    user = db.relationship('User', backref='upload_sessions')
+
+    def __repr__(self):
+        return f'<UploadSession {self.token}>'
+
+class FileHash(db.Model):
+    """SHA-256 of a file's content, recorded for deduplication of uploads"""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), index=True, unique=True)  # relative to STORAGE_PATH
+    sha256 = db.Column(db.String(64), index=True)
+    size = db.Column(db.BigInteger)
+    inode = db.Column(db.BigInteger)
+    mtime_ns = db.Column(db.BigInteger)
+
+    def __repr__(self):
+        return f'<FileHash {self.path}>'
@@ -1,10 +1,19 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify
 from flask_login import login_required, current_user
 from app import db
 from app.files.utils import get_storage_info
+from app.files.cache import listing_cache
+from app.files.catalog import catalog
+from app.files.watcher import file_watcher
+from app.files.downloads import download_manager
+from app.files.compression import response_compressor
+from app.files.hotcache import hot_cache
+from app.files.prefetch import prefetcher
+from app.auth.models import User, SharedLink, BandwidthLimit
 from flask_wtf import FlaskForm
-from wtforms import StringField, BooleanField, IntegerField, SelectField, SubmitField
-from wtforms.validators import DataRequired, NumberRange
+from wtforms import StringField, BooleanField, IntegerField, SelectField, SubmitField, HiddenField
+from wtforms.validators import DataRequired, NumberRange, AnyOf
+from wtforms.widgets import HiddenInput
 import os
 import json
 
@@ -17,6 +26,12 @@ class ConfigForm(FlaskForm):
     default_theme = SelectField('Default Theme', choices=[('light', 'Light'), ('dark', 'Dark')])
     submit = SubmitField('Save Configuration')
 
+class BandwidthLimitForm(FlaskForm):
+    target = HiddenField(validators=[AnyOf(['user', 'link'])])
+    target_id = IntegerField(widget=HiddenInput(), validators=[DataRequired(), NumberRange(min=1)])
+    rate_kb = IntegerField('Limit (KB/s)', default=0, validators=[NumberRange(min=0, max=10 * 1024 * 1024)])
+    submit = SubmitField('Save')
+
 @config.route('/', methods=['GET', 'POST'])
 @login_required
 def index():
@@ -77,6 +92,69 @@ def system():
         'storage_path': current_app.config['STORAGE_PATH']
     }
 
+    # Get cache statistics
+    cache_stats = {
+        'listing': listing_cache.stats(),
+        'catalog': catalog.stats(),
+        'watcher': file_watcher.stats(),
+        'compression': response_compressor.stats(),
+        'hot_files': hot_cache.stats(),
+        'prefetch': prefetcher.stats()
+    }
+
     return render_template('config/system.html',
                           system_info=system_info,
-                          storage_info=storage_info)
+                          storage_info=storage_info,
+                          cache_stats=cache_stats)
+
+@config.route('/bandwidth', methods=['GET', 'POST'])
+@login_required
+def bandwidth():
+    # Only admin can manage bandwidth limits
+    if not current_user.is_admin:
+        flash('You do not have permission to manage bandwidth', 'danger')
+        return redirect(url_for('files.index'))
+
+    form = BandwidthLimitForm()
+    if form.validate_on_submit():
+        # Find the limit of the user or share link
+        if form.target.data == 'user':
+            owner = db.session.get(User, form.target_id.data)
+            limit = BandwidthLimit.query.filter_by(user_id=owner.id).first() if owner else None
+        else:
+            owner = db.session.get(SharedLink, form.target_id.data)
+            limit = BandwidthLimit.query.filter_by(shared_link_id=owner.id).first() if owner else None
+        if owner is None:
+            flash('User or share link not found', 'danger')
+            return redirect(url_for('config.bandwidth'))
+
+        if form.rate_kb.data:
+            if limit is None:
+                limit = BandwidthLimit(user_id=owner.id) if form.target.data == 'user' else BandwidthLimit(shared_link_id=owner.id)
+                db.session.add(limit)
+            limit.rate = form.rate_kb.data * 1024
+        elif limit is not None:
+            db.session.delete(limit)
+        db.session.commit()
+        flash('Bandwidth limit saved', 'success')
+        return redirect(url_for('config.bandwidth'))
+    elif request.method == 'POST':
+        flash('Invalid bandwidth limit', 'danger')
+        return redirect(url_for('config.bandwidth'))
+
+    users = User.query.order_by(User.username).all()
+    share_links = SharedLink.query.order_by(SharedLink.created_at.desc()).all()
+
+    return render_template('config/bandwidth.html',
+                          users=users,
+                          share_links=share_links,
+                          download_stats=download_manager.stats(),
+                          form_class=BandwidthLimitForm)
+
+@config.route('/bandwidth/active')
+@login_required
+def bandwidth_active():
+    """Get the active downloads and throughput as JSON"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Permission denied'}), 403
+    return jsonify(download_manager.stats())
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Rough per-item cost of a listing record (dict, floats, strings), used to
+# bound the cache by memory without walking every object with sys.getsizeof
+ITEM_SIZE_ESTIMATE = 400
+
+# Alternative sort orders kept per listing
+MAX_VARIANTS = 4
+
+
+class ListingCache:
+    """
+    Process-wide LRU cache of sorted directory listings.
+
+    Entries are keyed by (path, st_mtime_ns, st_ino) of the directory, so any
+    change to its contents makes the cached listing unreachable. Routes that
+    modify files and the file watcher also invalidate the affected entries
+    explicitly. The cache is bounded both by the number of listings and by
+    an estimate of their memory use, evicting the least recently used
+    listing first.
+
+    Besides the listing as returned by the loader, each entry can hold a few
+    re-sorted variants of it (e.g. by size), so paging through any sort
+    order only slices a list.
+    """
+
+    def __init__(self, max_entries=64, max_bytes=32 * 1024 * 1024, min_age=2.0):
+        self.root = None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Directories modified less than min_age seconds ago are not cached,
+        # since filesystems with coarse timestamps (FAT, sdcardfs) may not
+        # bump the mtime again for a second change within the same tick
+        self.min_age = min_age
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> [items, size, variants]
+        self._keys_by_path = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.root = app.config['STORAGE_PATH']
+        self.max_entries = app.config.get('LISTING_CACHE_MAX_ENTRIES', self.max_entries)
+        self.max_bytes = app.config.get('LISTING_CACHE_MAX_BYTES', self.max_bytes)
+        app.extensions['listing_cache'] = self
+
+    def get(self, path, loader, variant=None, sorter=None):
+        """
+        Get the listing for a directory, calling loader() on a cache miss.
+
+        Args:
+            path (str): Path to the directory
+            loader (callable): Returns the sorted list of items for the directory
+            variant (hashable): Key of an alternative sort order, None for the
+                                loader's order
+            sorter (callable): Returns the variant's list from the loader's list
+
+        Returns:
+            list: The cached list of items. Callers must not modify it.
+
+        Raises:
+            OSError: If the directory cannot be accessed
+        """
+        path = os.path.normpath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_ino)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if variant is None:
+                    return entry[0]
+                if variant in entry[2]:
+                    return entry[2][variant]
+            else:
+                self.misses += 1
+
+        if entry is None:
+            items = loader()
+            entry = self._store(path, key, stat, items)
+        else:
+            items = entry[0]
+
+        if variant is None:
+            return items
+
+        variant_items = sorter(items)
+        if entry is not None:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    if len(entry[2]) >= MAX_VARIANTS:
+                        entry[2].pop(next(iter(entry[2])))
+                    entry[2][variant] = variant_items
+        return variant_items
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drop the cached listing of a directory.
+
+        Args:
+            path (str): Path to the directory
+            recursive (bool): Also drop listings of all directories below it
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            self._remove_path(path)
+            if recursive:
+                prefix = path.rstrip(os.sep) + os.sep
+                for cached_path in [p for p in self._keys_by_path if p.startswith(prefix)]:
+                    self._remove_path(cached_path)
+
+    def handle_changes(self, events):
+        """Drop the listings made stale by a batch of file watcher ChangeEvents"""
+        for event in events:
+            full_path = os.path.join(self.root, event.path)
+            if event.action in ('changed', 'rescan'):
+                self.invalidate(full_path, recursive=event.action == 'rescan')
+                continue
+            # The parent's listing shows the entry, with its size and mtime
+            # which don't touch the parent's own mtime
+            self.invalidate(os.path.dirname(full_path))
+            if event.is_dir and event.action == 'deleted':
+                self.invalidate(full_path, recursive=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Get hit/miss counters and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups * 100) if lookups else 0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def _store(self, path, key, stat, items):
+        # Returns the new entry, or None if the listing shouldn't be cached
+        if time.time() - stat.st_mtime < self.min_age:
+            return None
+
+        # Variants are lists of references to the same items, so they are
+        # counted as if the listing were twice as big
+        size = ITEM_SIZE_ESTIMATE * len(items) + sum(len(item['name']) for item in items)
+        size += 8 * len(items) * MAX_VARIANTS
+        if size > self.max_bytes:
+            return None
+
+        entry = [items, size, {}]
+        with self._lock:
+            self._remove_path(path)
+            self._entries[key] = entry
+            self._keys_by_path[path] = key
+            self._bytes += size
+
+            # Evict least recently used listings until we are within bounds
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._keys_by_path.pop(old_key[0], None)
+                self._bytes -= old_entry[1]
+
+        return entry
+
+    def _remove_path(self, path):
+        # Caller must hold the lock
+        key = self._keys_by_path.pop(path, None)
+        if key is not None:
+            entry = self._entries.pop(key)
+            self._bytes -= entry[1]
+
+
+listing_cache = ListingCache()
@@ -0,0 +1,405 @@
+import logging
+import mimetypes
+import os
+import stat as stat_module
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import and_, bindparam, delete, func, insert, or_, select, update
+
+from app import db
+from app.auth.models import CatalogEntry
+from app.files.usage import normalize_relative_path
+
+# A scan commits after this many rows, or this many seconds after its first
+# uncommitted write, so requests never wait long for the database lock
+COMMIT_BATCH = 500
+COMMIT_INTERVAL = 0.5
+
+# Sortable columns of catalog views
+CATALOG_SORT_COLUMNS = {
+    'name': CatalogEntry.name,
+    'size': CatalogEntry.size,
+    'modified': CatalogEntry.mtime_ns,
+    'path': CatalogEntry.path,
+}
+
+
+def subtree_filter(relative_path):
+    """Match a catalog path and everything below it, as a range on the path index"""
+    table = CatalogEntry.__table__
+    if not relative_path:
+        return table.c.path.isnot(None)
+    return or_(
+        table.c.path == relative_path,
+        and_(table.c.path > relative_path + '/', table.c.path < relative_path + '0')
+    )
+
+
+class CatalogScanner:
+    """
+    Keeps the CatalogEntry table in line with the files under STORAGE_PATH.
+
+    A directory's entries only change when its mtime does, so an incremental
+    pass stats the directories already in the catalog and lists only those
+    whose mtime (or inode) changed since they were last listed, descending
+    into the new subdirectories it finds. Changes to a file's content don't
+    touch its directory, so a full pass that lists every directory runs
+    every CATALOG_FULL_SCAN_INTERVAL seconds, and routes that write files
+    and the file watcher ask for their directory to be listed again with
+    rescan_later().
+
+    The MIME type is guessed from the file name; sniffing content would
+    make a scan read every file.
+    """
+
+    def __init__(self, scan_interval=300, full_scan_interval=86400):
+        self.app = None
+        self.root = None
+        self.scan_interval = scan_interval
+        self.full_scan_interval = full_scan_interval
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._full_pending = False
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # Statistics of the last completed pass
+        self.last_scan = None
+
+    def init_app(self, app):
+        self.app = app
+        self.root = app.config['STORAGE_PATH']
+        self.scan_interval = app.config.get('CATALOG_SCAN_INTERVAL', self.scan_interval)
+        self.full_scan_interval = app.config.get('CATALOG_FULL_SCAN_INTERVAL', self.full_scan_interval)
+        self.logger = app.logger
+        app.extensions['catalog'] = self
+
+    def start(self):
+        """Start the background scanner if it isn't running yet"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='catalog', daemon=True)
+            self._thread.start()
+
+    def rescan_later(self, relative_dir=''):
+        """Queue a directory to be listed again on the next pass, which runs soon"""
+        with self._lock:
+            self._pending.add(normalize_relative_path(relative_dir))
+        self.start()
+        self._wakeup.set()
+
+    def full_scan_later(self):
+        """Queue a pass that lists every directory, e.g. after changes were missed"""
+        with self._lock:
+            self._full_pending = True
+        self.start()
+        self._wakeup.set()
+
+    def handle_changes(self, events):
+        """Apply a batch of file watcher ChangeEvents"""
+        for event in events:
+            if event.action == 'rescan' and not event.path:
+                self.full_scan_later()
+            elif event.action in ('changed', 'rescan'):
+                self.rescan_later(event.path)
+            else:
+                # Listing the parent picks up the entry, and new
+                # subdirectories are listed in the same pass
+                self.rescan_later(os.path.dirname(event.path))
+
+    def query(self, parent=None, recursive=False, kind=None, mime_prefix=None,
+              min_size=None, max_size=None, modified_after=None,
+              sort='name', reverse=False, offset=0, limit=50):
+        """
+        Query the catalog for a sorted and filtered view.
+
+        Args:
+            parent (str): Directory to list, None for the whole storage
+            recursive (bool): Include everything below parent, not only its children
+            kind (str): 'file' or 'dir' to only return one kind of entry
+            mime_prefix (str): Only return files whose MIME type starts with this
+            min_size (int): Minimum size in bytes
+            max_size (int): Maximum size in bytes
+            modified_after (float): Only return entries modified after this timestamp
+            sort (str): One of CATALOG_SORT_COLUMNS
+            reverse (bool): Sort in descending order
+            offset (int): Number of entries to skip
+            limit (int): Maximum number of entries to return
+
+        Returns:
+            tuple: (total, entries) where entries are dicts with the catalog columns
+        """
+        self.start()
+        table = CatalogEntry.__table__
+        conditions = [table.c.path != '']
+        if parent is not None:
+            parent = normalize_relative_path(parent)
+            if recursive:
+                if parent:
+                    conditions.append(and_(table.c.path > parent + '/', table.c.path < parent + '0'))
+            else:
+                conditions.append(table.c.parent == parent)
+        if kind in ('file', 'dir'):
+            conditions.append(table.c.is_dir == (kind == 'dir'))
+        if mime_prefix:
+            conditions.append(table.c.mime_type.startswith(mime_prefix, autoescape=True))
+        if min_size is not None:
+            conditions.append(table.c.size >= min_size)
+        if max_size is not None:
+            conditions.append(table.c.size <= max_size)
+        if modified_after is not None:
+            conditions.append(table.c.mtime_ns > int(modified_after * 1e9))
+
+        where = and_(*conditions)
+        total = db.session.execute(select(func.count()).select_from(table).where(where)).scalar()
+
+        column = CATALOG_SORT_COLUMNS.get(sort, CatalogEntry.name)
+        order = [column.desc() if reverse else column.asc(), table.c.path.asc()]
+        rows = db.session.execute(
+            select(table.c.path, table.c.name, table.c.is_dir, table.c.size,
+                   table.c.mtime_ns, table.c.mime_type)
+            .where(where).order_by(*order).offset(offset).limit(limit)
+        )
+        entries = [{
+            'path': row.path,
+            'name': row.name,
+            'is_dir': row.is_dir,
+            'size': row.size,
+            'mtime': row.mtime_ns / 1e9,
+            'mime_type': row.mime_type,
+        } for row in rows]
+        return total, entries
+
+    def stats(self):
+        """Get the size of the catalog and statistics of the last pass"""
+        table = CatalogEntry.__table__
+        entries = db.session.execute(select(func.count()).select_from(table)).scalar()
+        return {'entries': max(entries - 1, 0), 'last_scan': self.last_scan}
+
+    def scan(self, full=False, force=()):
+        """
+        Bring the catalog in line with the disk.
+
+        Must be called within an application context.
+
+        Args:
+            full (bool): List every directory, not only those whose mtime changed
+            force (iterable): Relative directories to list even if unchanged
+
+        Returns:
+            dict: Statistics of the pass
+        """
+        table = CatalogEntry.__table__
+        started = time.time()
+        force = set(force)
+        stats = {'full': full, 'dirs_listed': 0, 'dirs_skipped': 0, 'writes': 0}
+
+        # Directories the catalog knows, with the mtime they had when listed
+        known_dirs = {}
+        children = defaultdict(list)
+        for path, mtime_ns, inode in db.session.execute(
+                select(table.c.path, table.c.mtime_ns, table.c.inode).where(table.c.is_dir)):
+            known_dirs[path] = (mtime_ns, inode)
+            if path:
+                children[os.path.dirname(path)].append(path)
+
+        writer = CatalogWriter()
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            full_path = os.path.join(self.root, relative_dir) if relative_dir else self.root
+            try:
+                stat = os.stat(full_path) if not relative_dir else os.lstat(full_path)
+            except OSError:
+                writer.delete_tree(relative_dir)
+                continue
+            if not stat_module.S_ISDIR(stat.st_mode):
+                # Replaced by a file or symlink, its parent's listing records that
+                continue
+
+            if not full and relative_dir not in force and known_dirs.get(relative_dir) == (stat.st_mtime_ns, stat.st_ino):
+                # Nothing was added, removed or renamed in here
+                stats['dirs_skipped'] += 1
+                stack.extend(children.get(relative_dir, ()))
+                continue
+
+            stats['dirs_listed'] += 1
+            try:
+                subdirs = self._list_directory(writer, relative_dir, full_path, stat)
+            except OSError as e:
+                self.logger.warning(f"Cannot catalog {full_path}: {e}")
+                continue
+            stack.extend(subdirs)
+            writer.flush_if_due()
+
+        writer.flush()
+        stats['writes'] = writer.writes
+        stats['duration'] = time.time() - started
+        stats['finished_at'] = time.time()
+        return stats
+
+    def _list_directory(self, writer, relative_dir, full_path, stat):
+        # Sync the entries of one directory, returns its subdirectories
+        table = CatalogEntry.__table__
+        on_disk = {}
+        with os.scandir(full_path) as entries:
+            for entry in entries:
+                # Hidden files are not shown anywhere else either
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                on_disk[entry.name] = (is_dir, entry_stat)
+
+        cataloged = {
+            row.name: row for row in db.session.execute(
+                select(table.c.name, table.c.is_dir, table.c.size, table.c.mtime_ns, table.c.inode)
+                .where(table.c.parent == relative_dir)
+            )
+        }
+
+        subdirs = []
+        for name, (is_dir, entry_stat) in on_disk.items():
+            path = os.path.join(relative_dir, name) if relative_dir else name
+            row = cataloged.get(name)
+            if is_dir:
+                subdirs.append(path)
+
+            if row is not None and row.is_dir != is_dir:
+                writer.delete_tree(path)
+                row = None
+
+            if row is None:
+                writer.insert(make_catalog_row(path, relative_dir, name, is_dir, entry_stat))
+            elif not is_dir and (row.size, row.mtime_ns, row.inode) != (entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_ino):
+                writer.update(path, size=entry_stat.st_size, mtime_ns=entry_stat.st_mtime_ns, inode=entry_stat.st_ino)
+
+        for name in cataloged.keys() - on_disk.keys():
+            writer.delete_tree(os.path.join(relative_dir, name) if relative_dir else name)
+
+        # Record the mtime the directory had when it was listed. The root has
+        # no parent listing to create its row.
+        if relative_dir or db.session.execute(select(table.c.id).where(table.c.path == '')).first():
+            writer.update(relative_dir, size=0, mtime_ns=stat.st_mtime_ns, inode=stat.st_ino)
+        else:
+            writer.insert(make_catalog_row('', None, '', True, stat, mtime_ns=stat.st_mtime_ns))
+        return subdirs
+
+    def _run(self):
+        with self.app.app_context():
+            next_full_scan = 0
+            while True:
+                with self._lock:
+                    force, self._pending = self._pending, set()
+                    full, self._full_pending = self._full_pending, False
+                full = full or time.time() >= next_full_scan
+                try:
+                    self.last_scan = self.scan(full=full, force=force)
+                    if full:
+                        next_full_scan = time.time() + self.full_scan_interval
+                except Exception as e:
+                    db.session.rollback()
+                    self.logger.error(f"Error scanning catalog: {e}")
+                finally:
+                    db.session.remove()
+
+                self._wakeup.wait(self.scan_interval)
+                self._wakeup.clear()
+
+
+def make_catalog_row(path, parent, name, is_dir, stat, mtime_ns=None):
+    """Build the column values of a new catalog entry"""
+    return {
+        'path': path,
+        'parent': parent,
+        'name': name,
+        'is_dir': is_dir,
+        'size': 0 if is_dir else stat.st_size,
+        # A directory's mtime is recorded when the directory itself is
+        # listed, until then it must not look up to date
+        'mtime_ns': (mtime_ns or 0) if is_dir else stat.st_mtime_ns,
+        'inode': stat.st_ino,
+        'mime_type': None if is_dir else mimetypes.guess_type(name)[0],
+    }
+
+
+class CatalogWriter:
+    """
+    Batches the inserts, updates and deletes of a scan into few statements.
+
+    SQLite locks the whole database from the first write of a transaction,
+    so the transaction is committed after COMMIT_BATCH rows, or once it has
+    been open for COMMIT_INTERVAL seconds while directories are being listed.
+    """
+
+    def __init__(self):
+        self.table = CatalogEntry.__table__
+        self.inserts = []
+        self.updates = []
+        self.writes = 0
+        self._pending = 0
+        self._first_write = None
+
+    def insert(self, row):
+        self.inserts.append(row)
+        self._count()
+
+    def update(self, path, **values):
+        values['b_path'] = path
+        self.updates.append(values)
+        self._count()
+
+    def delete_tree(self, relative_path):
+        # Deletes go out right away, so a re-insert of the same path that
+        # follows them in the batch doesn't collide
+        self._flush_statements()
+        db.session.execute(delete(self.table).where(subtree_filter(relative_path)))
+        self._count()
+
+    def flush(self):
+        self._flush_statements()
+        db.session.commit()
+        self._pending = 0
+        self._first_write = None
+
+    def flush_if_due(self):
+        if self._first_write is not None and time.time() - self._first_write >= COMMIT_INTERVAL:
+            self.flush()
+
+    def _count(self):
+        self.writes += 1
+        self._pending += 1
+        if self._first_write is None:
+            self._first_write = time.time()
+        if self._pending >= COMMIT_BATCH:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def _flush_statements(self):
+        if self.inserts:
+            db.session.execute(insert(self.table), self.inserts)
+            self.inserts = []
+        # Updates of different columns are grouped, executemany needs the same keys
+        groups = defaultdict(list)
+        for values in self.updates:
+            groups[tuple(sorted(values))].append(values)
+        for keys, rows in groups.items():
+            db.session.execute(
+                update(self.table)
+                .where(self.table.c.path == bindparam('b_path'))
+                .values({key: bindparam(key) for key in keys if key != 'b_path'}),
+                rows
+            )
+        self.updates = []
+
+
+catalog = CatalogScanner()
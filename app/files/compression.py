@@ -0,0 +1,451 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+# Try to import optional encoders
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Non-text types worth compressing. Everything else outside text/ (images,
+# video, audio, archives) is compressed already and sent as-is.
+COMPRESSIBLE_MIMETYPES = frozenset((
+    'application/json', 'application/x-ndjson', 'application/javascript',
+    'application/xml', 'application/xhtml+xml', 'application/rss+xml', 'application/atom+xml',
+    'application/x-yaml', 'application/yaml', 'application/toml', 'application/sql',
+    'application/x-sh', 'application/x-httpd-php', 'application/x-tex', 'application/rtf',
+    'application/postscript', 'image/svg+xml', 'image/bmp', 'image/x-icon',
+))
+
+# Extensions of the cached variants
+VARIANT_EXTENSIONS = {'zstd': '.zst', 'br': '.br', 'gzip': '.gz'}
+
+# Hit counters kept for files that may become worth caching
+MAX_TRACKED_FILES = 4096
+
+# Seconds after its last write a variant's temporary file counts as left
+# behind by a crashed worker, rather than being written by another one
+STALE_TEMP_AGE = 3600
+
+
+def is_compressible(mimetype):
+    """Check if a content type is worth compressing"""
+    if not mimetype:
+        return False
+    # Server-sent events stay open for hours and must reach the browser
+    # right away, so they are left alone
+    if mimetype.startswith('text/'):
+        return mimetype != 'text/event-stream'
+    return mimetype in COMPRESSIBLE_MIMETYPES or mimetype.endswith(('+json', '+xml'))
+
+
+class Encoder:
+    """Streaming compressor with the same interface for every encoding"""
+
+    def __init__(self, encoding, level):
+        if encoding == 'gzip':
+            # The gzip header zlib writes has no timestamp, so the output is
+            # the same for the same input and can carry a strong ETag
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress = compressor.compress
+            self.flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = compressor.flush
+        elif encoding == 'br':
+            compressor = brotli.Compressor(quality=level)
+            self.compress = compressor.process
+            self.flush = compressor.flush
+            self.finish = compressor.finish
+        elif encoding == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self.compress = compressor.compress
+            self.flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            self.finish = compressor.flush
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+class CompressedBody:
+    """
+    Response body that compresses the chunks of another one.
+
+    Streamed responses (flush=True) have every chunk flushed, so what the
+    app yields still reaches the client right away. File bodies let the
+    encoder fill its blocks, and can be written to a cached variant as they
+    are sent.
+    """
+
+    def __init__(self, source, encoder, flush=False, variant=None, on_finish=None):
+        self.source = source
+        self.encoder = encoder
+        self.flush = flush
+        self.variant = variant
+        self.on_finish = on_finish
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._iterator = iter(source)
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._finished:
+            try:
+                chunk = next(self._iterator)
+            except StopIteration:
+                self._finished = True
+                data = self.encoder.finish()
+                self.bytes_out += len(data)
+                self._write_variant(data)
+                if self.variant is not None:
+                    self.variant.commit()
+                    self.variant = None
+                if self.on_finish is not None:
+                    self.on_finish(self.bytes_in, self.bytes_out)
+                if data:
+                    return data
+                break
+
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            self.bytes_in += len(chunk)
+            data = self.encoder.compress(chunk)
+            if self.flush:
+                data += self.encoder.flush()
+            if data:
+                self.bytes_out += len(data)
+                self._write_variant(data)
+                return data
+        raise StopIteration
+
+    def _write_variant(self, data):
+        if self.variant is not None and data:
+            self.variant.write(data)
+
+    def close(self):
+        # A client that went away leaves an incomplete variant behind
+        if self.variant is not None:
+            self.variant.discard()
+            self.variant = None
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+
+
+class VariantWriter:
+    """Writes a compressed variant to a temporary file, moved into place when complete"""
+
+    def __init__(self, compressor, path, verify):
+        self.compressor = compressor
+        self.path = path
+        self.verify = verify
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        # The file changed while it was read, the variant matches neither version
+        if not self.verify():
+            self.discard()
+            return
+        os.replace(self.temp_path, self.path)
+        self.compressor._variant_added(self.path, self.size)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+        self.compressor._variant_dropped(self.path)
+
+
+class ResponseCompressor:
+    """
+    Compresses text responses for clients that accept it.
+
+    Rendered pages and JSON are compressed in an after_request hook, whole
+    or, for streamed responses, chunk by chunk. Downloads of text files are
+    compressed by serve_file(), which streams them through the encoder.
+
+    The encoding is negotiated from Accept-Encoding among gzip and, when
+    their packages are installed, brotli and zstd. Files downloaded at least
+    COMPRESS_CACHE_MIN_HITS times get their compressed variant written to
+    COMPRESS_CACHE_PATH while it is sent, and later downloads send that file
+    (with sendfile, and ranges) without compressing again. Variants are
+    named after the inode, size and mtime of the file, so a changed file
+    simply stops using its old ones, which are evicted least recently used
+    first once the cache outgrows COMPRESS_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, min_size=1024, min_hits=2, max_bytes=256 * 1024 * 1024, min_age=2.0):
+        self.enabled = True
+        self.min_size = min_size
+        self.levels = {'zstd': 3, 'br': 5, 'gzip': 6}
+        self.cache_path = None
+        self.min_hits = min_hits
+        self.max_bytes = max_bytes
+        # Files modified less than min_age seconds ago are not cached, since
+        # filesystems with coarse timestamps may not bump the mtime again
+        # for a second change within the same tick
+        self.min_age = min_age
+
+        # Encodings in order of preference, when the client accepts several
+        self.encodings = [encoding for encoding, module in (('zstd', zstandard), ('br', brotli), ('gzip', zlib)) if module]
+
+        self._lock = threading.Lock()
+        self._hits = OrderedDict()  # variant key -> downloads seen
+        self._writing = set()
+        self._bytes = None
+        self.compressed = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESS_ENABLED', self.enabled)
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        self.levels = {
+            'zstd': app.config.get('COMPRESS_ZSTD_LEVEL', self.levels['zstd']),
+            'br': app.config.get('COMPRESS_BROTLI_QUALITY', self.levels['br']),
+            'gzip': app.config.get('COMPRESS_LEVEL', self.levels['gzip']),
+        }
+        self.cache_path = app.config.get('COMPRESS_CACHE_PATH') or os.path.join(app.instance_path, 'compressed')
+        self.min_hits = app.config.get('COMPRESS_CACHE_MIN_HITS', self.min_hits)
+        self.max_bytes = app.config.get('COMPRESS_CACHE_MAX_BYTES', self.max_bytes)
+        self.remove_stale_temp_files()
+        app.after_request(self.compress_response)
+        app.extensions['response_compressor'] = self
+
+    def negotiate(self):
+        """
+        Pick the encoding for the current request.
+
+        Returns:
+            str: The accepted encoding with the highest quality, ties going
+                 to the better compressing one, or None to send identity
+        """
+        if not self.enabled:
+            return None
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = request.accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def encoder(self, encoding):
+        return Encoder(encoding, self.levels[encoding])
+
+    def compress_response(self, response):
+        """after_request hook compressing rendered pages and JSON"""
+        if not self.enabled or not is_compressible(response.mimetype):
+            return response
+
+        # Caches must keep the variants apart, even for the identity one
+        response.vary.add('Accept-Encoding')
+
+        # Files are compressed by serve_file(), partial and empty responses not at all
+        if (response.direct_passthrough or response.status_code != 200 or request.method == 'HEAD'
+                or 'Content-Encoding' in response.headers or 'Content-Range' in response.headers):
+            return response
+
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = CompressedBody(response.response, self.encoder(encoding), flush=True,
+                                               on_finish=self._count)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            encoder = self.encoder(encoding)
+            compressed = encoder.compress(data) + encoder.finish()
+            if len(compressed) >= len(data):
+                return response
+            response.set_data(compressed)
+            self._count(len(data), len(compressed))
+
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        response.headers['Content-Encoding'] = encoding
+        with self._lock:
+            self.compressed += 1
+        return response
+
+    def get_cached(self, stat, encoding):
+        """
+        Get the cached compressed variant of a file version.
+
+        Returns:
+            str: Path of the variant, or None if it isn't cached
+        """
+        if not self.max_bytes:
+            return None
+        path = self._variant_path(stat, encoding)
+        try:
+            # The mtime of a variant records its last use, for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            self.cache_hits += 1
+            self.compressed += 1
+        return path
+
+    def compress_file(self, chunks, file, stat, encoding):
+        """
+        Compress a file as it is sent, caching the result if it is fetched often.
+
+        Args:
+            chunks (iterable): The file's content, closing the file when closed
+            file: The open file, to check it didn't change while being read
+            stat (os.stat_result): Status of the file when it was opened
+            encoding (str): Negotiated encoding
+
+        Returns:
+            CompressedBody: The response body
+        """
+        with self._lock:
+            self.compressed += 1
+
+        variant = None
+        path = self._variant_path(stat, encoding)
+        if self._should_cache(path, stat):
+            def verify():
+                current = os.fstat(file.fileno())
+                return (current.st_size, current.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+            try:
+                os.makedirs(self.cache_path, exist_ok=True)
+                variant = VariantWriter(self, path, verify)
+            except OSError:
+                self._variant_dropped(path)
+        return CompressedBody(chunks, self.encoder(encoding), variant=variant, on_finish=self._count)
+
+    def stats(self):
+        """Get counters of compressed responses and the size of the variant cache"""
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan_cache()[1]
+            return {
+                'encodings': list(self.encodings),
+                'compressed': self.compressed,
+                'cache_hits': self.cache_hits,
+                'ratio': (self.bytes_out / self.bytes_in * 100) if self.bytes_in else 0,
+                'cache_bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def remove_stale_temp_files(self):
+        """Delete the temporary files of variants whose writer died mid-write"""
+        cutoff = time.time() - STALE_TEMP_AGE
+        try:
+            with os.scandir(self.cache_path) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.unlink(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+
+    def _variant_path(self, stat, encoding):
+        key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        name = hashlib.sha1(key.encode('ascii')).hexdigest()
+        return os.path.join(self.cache_path, name + VARIANT_EXTENSIONS[encoding])
+
+    def _should_cache(self, key, stat):
+        if not self.max_bytes or stat.st_size > self.max_bytes // 4:
+            return False
+        if time.time() - stat.st_mtime < self.min_age:
+            return False
+        with self._lock:
+            hits = self._hits.pop(key, 0) + 1
+            self._hits[key] = hits
+            if len(self._hits) > MAX_TRACKED_FILES:
+                self._hits.popitem(last=False)
+            if hits < self.min_hits or key in self._writing:
+                return False
+            self._writing.add(key)
+            return True
+
+    def _count(self, bytes_in, bytes_out):
+        with self._lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def _variant_added(self, key, size):
+        with self._lock:
+            self._writing.discard(key)
+            self._hits.pop(key, None)
+            if self._bytes is None:
+                self._bytes = self._scan_cache()[1]
+            else:
+                self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _variant_dropped(self, key):
+        with self._lock:
+            self._writing.discard(key)
+
+    def _scan_cache(self):
+        """List the cached variants, oldest use first, with their total size"""
+        variants = []
+        total = 0
+        try:
+            with os.scandir(self.cache_path) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    variants.append((stat.st_mtime, entry.path, stat.st_size))
+                    total += stat.st_size
+        except OSError:
+            pass
+        variants.sort()
+        return variants, total
+
+    def _evict(self):
+        # Delete least recently used variants down to 90% of the limit
+        variants, total = self._scan_cache()
+        target = self.max_bytes * 0.9
+        for _, path, size in variants:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+        self._bytes = total
+
+
+response_compressor = ResponseCompressor()
@@ -0,0 +1,375 @@
+import logging
+import mimetypes
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from app.files.search_index import subtree_condition
+from app.files.usage import is_hidden, normalize_relative_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+    content,
+    start_line UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+# Extensions indexed besides text/* MIME types
+TEXT_EXTENSIONS = frozenset({
+    '.md', '.markdown', '.rst', '.txt', '.log', '.csv', '.tsv', '.json', '.xml',
+    '.yaml', '.yml', '.toml', '.ini', '.cfg', '.conf', '.env', '.properties',
+    '.py', '.js', '.ts', '.jsx', '.tsx', '.html', '.htm', '.css', '.scss',
+    '.c', '.h', '.cpp', '.hpp', '.cc', '.java', '.kt', '.go', '.rs', '.rb',
+    '.php', '.pl', '.lua', '.swift', '.sh', '.bash', '.zsh', '.fish', '.sql',
+    '.r', '.m', '.cs', '.dart', '.vue', '.svelte', '.tex', '.srt', '.vtt',
+})
+
+# Text stored per indexed chunk. Chunks end at line breaks, so hits can be
+# reported with line numbers.
+CHUNK_SIZE = 16 * 1024
+
+# Chunk rowids are (file id << CHUNK_BITS) + chunk number, so the chunks of
+# a file can be deleted by rowid range
+CHUNK_BITS = 20
+
+# Lines shown per hit, and characters of context around the match
+SNIPPET_LINES = 3
+SNIPPET_WIDTH = 160
+
+
+def is_text_file(name):
+    """Check whether a file name looks like a text file worth indexing"""
+    ext = os.path.splitext(name)[1].lower()
+    if ext in TEXT_EXTENSIONS:
+        return True
+    mime_type, _ = mimetypes.guess_type(name)
+    return bool(mime_type and mime_type.startswith('text/'))
+
+
+def get_query_terms(query):
+    """Split a search query into the words the tokenizer would produce"""
+    return re.findall(r'\w+', query.lower())
+
+
+def make_snippet(line, terms):
+    """Cut a line down to SNIPPET_WIDTH characters around the first term"""
+    line = line.strip()
+    if len(line) <= SNIPPET_WIDTH:
+        return line
+    lower = line.lower()
+    positions = [lower.find(term) for term in terms if term in lower]
+    start = max(0, min(positions, default=0) - SNIPPET_WIDTH // 3)
+    snippet = line[start:start + SNIPPET_WIDTH]
+    return ('...' if start else '') + snippet + ('...' if start + SNIPPET_WIDTH < len(line) else '')
+
+
+class ContentIndex:
+    """
+    Optional full-text index of text files under STORAGE_PATH.
+
+    Text-like files (text/* MIME types, Markdown, logs, CSV, source code)
+    no larger than CONTENT_INDEX_MAX_FILE_SIZE are split into line-aligned
+    chunks of CHUNK_SIZE and stored in an SQLite FTS5 table in a sidecar
+    database. Searches are answered from the index, ranked by BM25, with the
+    matching lines of the best chunk of each file as snippets.
+
+    A background worker walks the tree every CONTENT_INDEX_RESCAN_INTERVAL
+    seconds and re-indexes only files whose mtime or size changed. Routes
+    and the file watcher queue the files they see written and update the
+    index directly for deletes and renames.
+    """
+
+    def __init__(self, rescan_interval=3600, max_file_size=5 * 1024 * 1024):
+        self.enabled = False
+        self.root = None
+        self.db_path = None
+        self.rescan_interval = rescan_interval
+        self.max_file_size = max_file_size
+        self.logger = logging.getLogger(__name__)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ready = False
+        self._pending = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # Time of the last completed full scan
+        self.scanned_at = None
+
+    def init_app(self, app):
+        self.enabled = app.config.get('CONTENT_INDEX_ENABLED', False)
+        self.root = app.config['STORAGE_PATH']
+        self.db_path = app.config.get('CONTENT_INDEX_PATH') or os.path.join(app.instance_path, 'content_index.db')
+        self.rescan_interval = app.config.get('CONTENT_INDEX_RESCAN_INTERVAL', self.rescan_interval)
+        self.max_file_size = app.config.get('CONTENT_INDEX_MAX_FILE_SIZE', self.max_file_size)
+        self.logger = app.logger
+        app.extensions['content_index'] = self
+
+    def start(self):
+        """Start the background indexer if content search is enabled"""
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='content-index', daemon=True)
+            self._thread.start()
+
+    @property
+    def ready(self):
+        self.start()
+        return self.enabled and self._ready
+
+    def search(self, query, offset=0, limit=50):
+        """
+        Find text files containing all words of the query, best match first.
+
+        Args:
+            query (str): Words to look for
+            offset (int): Number of hits to skip
+            limit (int): Maximum number of hits to return
+
+        Returns:
+            list: {name, path, snippets} records, snippets being a list of
+                  {line, text}, or None if the index isn't available
+        """
+        if not self.ready:
+            return None
+        terms = get_query_terms(query)
+        if not terms:
+            return []
+
+        conn = self._connect()
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+        # The best ranked chunk of each file stands for the file. bm25() can't
+        # be used inside an aggregate, so the hits are materialized first.
+        rows = conn.execute(
+            "WITH hits AS MATERIALIZED (SELECT rowid, rank FROM chunks WHERE chunks MATCH ?) "
+            "SELECT files.path, MIN(hits.rank), hits.rowid FROM hits "
+            f"JOIN files ON files.id = hits.rowid >> {CHUNK_BITS} "
+            "GROUP BY files.id ORDER BY MIN(hits.rank), files.path LIMIT ? OFFSET ?",
+            (match, limit, offset)
+        ).fetchall()
+
+        results = []
+        for path, rank, chunk_id in rows:
+            content, start_line = conn.execute(
+                "SELECT content, start_line FROM chunks WHERE rowid = ?", (chunk_id,)
+            ).fetchone()
+            snippets = []
+            for number, line in enumerate(content.split('\n'), start_line):
+                lower = line.lower()
+                if any(term in lower for term in terms):
+                    snippets.append({'line': number, 'text': make_snippet(line, terms)})
+                    if len(snippets) >= SNIPPET_LINES:
+                        break
+            results.append({'name': os.path.basename(path), 'path': path, 'snippets': snippets})
+        return results
+
+    def file_changed(self, relative_path):
+        """Queue a file, or every file below a directory, to be (re)indexed"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending.add(normalize_relative_path(relative_path))
+        self.start()
+        self._wakeup.set()
+
+    def remove(self, relative_path):
+        """Drop a file, or every file below a directory, from the index"""
+        if not self.enabled:
+            return
+        relative_path = normalize_relative_path(relative_path)
+        conn = self._connect()
+        with conn:
+            where, params = subtree_condition(relative_path)
+            for file_id, in conn.execute(f"SELECT id FROM files WHERE {where}", params).fetchall():
+                self._delete_file(conn, file_id)
+
+    def move(self, old_relative_path, new_relative_path):
+        """Record a rename or move, the content of the files stays indexed"""
+        if not self.enabled:
+            return
+        old_relative_path = normalize_relative_path(old_relative_path)
+        new_relative_path = normalize_relative_path(new_relative_path)
+        if is_hidden(new_relative_path):
+            self.remove(old_relative_path)
+            return
+
+        conn = self._connect()
+        with conn:
+            where, params = subtree_condition(old_relative_path)
+            conn.execute(
+                f"UPDATE files SET path = ? || substr(path, ?) WHERE {where}",
+                (new_relative_path, len(old_relative_path) + 1) + params
+            )
+        # A file may have become (or stopped being) text-like by its new name,
+        # and the worker may have been indexing the old path meanwhile
+        self.file_changed(new_relative_path)
+        self.file_changed(old_relative_path)
+
+    def handle_changes(self, events):
+        """Apply a batch of file watcher ChangeEvents"""
+        if not self.enabled:
+            return
+        for event in events:
+            if event.action == 'deleted':
+                self.remove(event.path)
+            else:
+                self.file_changed(event.path)
+
+    def _run(self):
+        next_rescan = 0
+        while True:
+            if time.time() >= next_rescan:
+                try:
+                    self._index_tree('')
+                    self.scanned_at = time.time()
+                    self._ready = True
+                except Exception as e:
+                    self.logger.error(f"Error building content index: {e}")
+                next_rescan = time.time() + self.rescan_interval
+
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            for relative_path in sorted(pending):
+                try:
+                    self._index_tree(relative_path)
+                except Exception as e:
+                    self.logger.error(f"Error indexing {relative_path}: {e}")
+
+            self._wakeup.wait(max(0, next_rescan - time.time()))
+            self._wakeup.clear()
+
+    def _index_tree(self, relative_path):
+        # Bring the index of a file or subtree in line with the disk
+        conn = self._connect()
+        if relative_path:
+            where, params = subtree_condition(relative_path)
+            rows = conn.execute(f"SELECT path, id, mtime_ns, size FROM files WHERE {where}", params)
+        else:
+            rows = conn.execute("SELECT path, id, mtime_ns, size FROM files")
+        indexed = {path: (file_id, mtime_ns, size) for path, file_id, mtime_ns, size in rows}
+
+        seen = set()
+        for path, stat in self._walk(relative_path):
+            seen.add(path)
+            known = indexed.get(path)
+            if known and known[1:] == (stat.st_mtime_ns, stat.st_size):
+                continue
+            try:
+                self._index_file(conn, path, stat, known[0] if known else None)
+            except OSError as e:
+                self.logger.warning(f"Cannot index {path}: {e}")
+
+        gone = [file_id for path, (file_id, _, _) in indexed.items() if path not in seen]
+        if gone:
+            with conn:
+                for file_id in gone:
+                    self._delete_file(conn, file_id)
+
+    def _walk(self, relative_path):
+        # Yields (relative path, stat) of the indexable files in a subtree
+        if relative_path and is_hidden(relative_path):
+            return
+        full_path = os.path.join(self.root, relative_path) if relative_path else self.root
+        try:
+            stat = os.stat(full_path, follow_symlinks=False)
+        except OSError:
+            return
+
+        if not os.path.isdir(full_path) or os.path.islink(full_path):
+            if is_text_file(relative_path) and stat.st_size <= self.max_file_size and os.path.isfile(full_path):
+                yield relative_path, stat
+            return
+
+        pending = [relative_path]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(os.path.join(self.root, directory)) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        child = os.path.join(directory, entry.name) if directory else entry.name
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending.append(child)
+                            elif entry.is_file(follow_symlinks=False) and is_text_file(entry.name):
+                                stat = entry.stat(follow_symlinks=False)
+                                if stat.st_size <= self.max_file_size:
+                                    yield child, stat
+                        except OSError:
+                            continue
+            except OSError as e:
+                self.logger.warning(f"Cannot index {directory}: {e}")
+
+    def _index_file(self, conn, relative_path, stat, file_id=None):
+        # Read the file in chunks of whole lines, at most CHUNK_SIZE each
+        chunks = []
+        with open(os.path.join(self.root, relative_path), 'r', encoding='utf-8', errors='replace') as f:
+            lines = []
+            length = 0
+            start_line = line_number = 1
+            while True:
+                line = f.readline(CHUNK_SIZE)
+                if not line:
+                    break
+                if '\0' in line:
+                    # Binary file with a text-like name
+                    chunks = []
+                    break
+                lines.append(line)
+                length += len(line)
+                if line.endswith('\n'):
+                    line_number += 1
+                if length >= CHUNK_SIZE:
+                    chunks.append((''.join(lines), start_line))
+                    lines, length, start_line = [], 0, line_number
+            if lines:
+                chunks.append((''.join(lines), start_line))
+
+        with conn:
+            if file_id is None:
+                file_id = conn.execute(
+                    "INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                    (relative_path, stat.st_mtime_ns, stat.st_size)
+                ).lastrowid
+            else:
+                self._delete_file(conn, file_id, keep_file=True)
+                conn.execute("UPDATE files SET mtime_ns = ?, size = ? WHERE id = ?",
+                             (stat.st_mtime_ns, stat.st_size, file_id))
+            conn.executemany(
+                "INSERT INTO chunks (rowid, content, start_line) VALUES (?, ?, ?)",
+                [((file_id << CHUNK_BITS) + number, content, start_line)
+                 for number, (content, start_line) in enumerate(chunks[:1 << CHUNK_BITS])]
+            )
+
+    def _delete_file(self, conn, file_id, keep_file=False):
+        conn.execute("DELETE FROM chunks WHERE rowid BETWEEN ? AND ?",
+                     (file_id << CHUNK_BITS, ((file_id + 1) << CHUNK_BITS) - 1))
+        if not keep_file:
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def _connect(self):
+        # One connection per thread, SQLite connections can't be shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+
+content_index = ContentIndex()
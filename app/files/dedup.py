@@ -0,0 +1,288 @@
+import errno
+import hashlib
+import logging
+import os
+import secrets
+import threading
+
+from sqlalchemy import and_, func, or_, select
+
+from app import db
+from app.auth.models import CatalogEntry, FileHash
+from app.files.usage import normalize_relative_path
+
+# Bytes read per block when hashing a file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Catalog rows checked for a missing or outdated hash per query
+HASH_BATCH = 100
+
+# Errors of filesystems that can't hardlink (FAT, sdcardfs, FUSE mounts)
+LINK_UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EACCES)
+
+
+def hash_file(path):
+    """Get the SHA-256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def subtree_condition(relative_path):
+    """Match a path and everything below it"""
+    return or_(
+        FileHash.path == relative_path,
+        and_(FileHash.path > relative_path + '/', FileHash.path < relative_path + '0')
+    )
+
+
+class DedupIndex:
+    """
+    Content-addressed deduplication of uploads.
+
+    Uploads are hashed as they arrive and their SHA-256 is recorded in the
+    FileHash table, keyed by path. An upload whose content is already
+    stored becomes a hardlink to the existing file instead of a second
+    copy, and a client that sends the hash before the bytes skips the
+    transfer altogether. Requests only look up recorded hashes. Files
+    stored before, or changed outside the web UI, are hashed on a
+    background thread, which goes through the catalog for files without a
+    current hash every DEDUP_HASH_INTERVAL seconds.
+
+    Recorded hashes are checked against the file's inode, size and mtime
+    before they are trusted. Where the filesystem can't hardlink the upload
+    is kept as a copy.
+
+    Hardlinked files share their content, so a file edited in place
+    outside the web UI changes all its links (uploads, renames and deletes
+    through the web UI replace or unlink paths and are safe).
+    """
+
+    def __init__(self, enabled=False, hash_interval=300):
+        self.app = None
+        self.root = None
+        self.enabled = enabled
+        self.hash_interval = hash_interval
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.root = app.config['STORAGE_PATH']
+        self.enabled = app.config.get('DEDUP_ENABLED', self.enabled)
+        self.hash_interval = app.config.get('DEDUP_HASH_INTERVAL', self.hash_interval)
+        self.logger = app.logger
+        app.extensions['dedup_index'] = self
+
+    def start(self):
+        """Start the background hasher if deduplication is enabled"""
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='dedup', daemon=True)
+            self._thread.start()
+
+    def hash_later(self):
+        """Wake the background hasher to look for files without a current hash"""
+        self.start()
+        self._wakeup.set()
+
+    def find(self, sha256, size):
+        """
+        Find a stored file with the given content.
+
+        Args:
+            sha256 (str): Hex digest of the content
+            size (int): Size of the content in bytes
+
+        Returns:
+            str: Path of the file relative to STORAGE_PATH, or None
+        """
+        if not self.enabled:
+            return None
+        self.start()
+
+        outdated = False
+        for row in FileHash.query.filter_by(sha256=sha256, size=size).all():
+            if self._is_current(row):
+                return row.path
+            db.session.delete(row)
+            outdated = True
+        db.session.commit()
+        if outdated:
+            # Changed in place, hash its new content
+            self.hash_later()
+        return None
+
+    def hash_pending(self):
+        """
+        Hash the cataloged files without a current recorded hash.
+
+        Must be called within an application context.
+
+        Returns:
+            int: Number of files hashed
+        """
+        catalog = CatalogEntry.__table__
+        hashes = FileHash.__table__
+        hashed = 0
+        last_path = None
+        while self.enabled:
+            query = (
+                select(catalog.c.path)
+                .select_from(catalog.outerjoin(hashes, hashes.c.path == catalog.c.path))
+                .where(catalog.c.is_dir == False)  # noqa: E712
+                .where(or_(hashes.c.id.is_(None), hashes.c.size != catalog.c.size,
+                           hashes.c.mtime_ns != catalog.c.mtime_ns, hashes.c.inode != catalog.c.inode))
+                .order_by(catalog.c.path)
+                .limit(HASH_BATCH)
+            )
+            if last_path is not None:
+                query = query.where(catalog.c.path > last_path)
+            paths = db.session.execute(query).scalars().all()
+            if not paths:
+                break
+            for relative_path in paths:
+                full_path = os.path.join(self.root, relative_path)
+                if os.path.islink(full_path):
+                    # Links are never deduplicated against
+                    continue
+                try:
+                    sha256 = hash_file(full_path)
+                except OSError:
+                    continue
+                self.record(relative_path, sha256)
+                hashed += 1
+            last_path = paths[-1]
+        return hashed
+
+    def link_duplicate(self, sha256, size, file_path):
+        """
+        Make a path a hardlink to a stored file with the given content.
+
+        Replaces whatever is at file_path atomically.
+
+        Args:
+            sha256 (str): Hex digest of the content
+            size (int): Size of the content in bytes
+            file_path (str): Full path to link
+
+        Returns:
+            bool: True if file_path now shares the stored file's content,
+                  False if there is none or it can't be linked
+        """
+        existing = self.find(sha256, size)
+        if existing is None:
+            return False
+
+        existing_path = os.path.join(self.root, existing)
+        if os.path.abspath(existing_path) == os.path.abspath(file_path):
+            return False
+
+        # Link under a hidden name first, then rename it over the target
+        link_path = os.path.join(os.path.dirname(file_path), f'.dedup-{secrets.token_hex(12)}.tmp')
+        try:
+            os.link(existing_path, link_path)
+        except OSError as e:
+            if e.errno not in LINK_UNSUPPORTED:
+                raise
+            self.logger.info("Can't hardlink %s, keeping a copy: %s", existing, e)
+            return False
+        try:
+            os.replace(link_path, file_path)
+        except OSError:
+            os.remove(link_path)
+            raise
+        return True
+
+    def record(self, relative_path, sha256):
+        """Record the hash of a file's current content"""
+        if not self.enabled:
+            return
+        relative_path = normalize_relative_path(relative_path)
+        try:
+            stat = os.stat(os.path.join(self.root, relative_path))
+        except OSError:
+            return
+        row = FileHash.query.filter_by(path=relative_path).first()
+        if row is None:
+            row = FileHash(path=relative_path)
+            db.session.add(row)
+        row.sha256 = sha256
+        row.size = stat.st_size
+        row.inode = stat.st_ino
+        row.mtime_ns = stat.st_mtime_ns
+        db.session.commit()
+
+    def forget(self, relative_path):
+        """Drop the hashes of a path and everything below it"""
+        relative_path = normalize_relative_path(relative_path)
+        FileHash.query.filter(subtree_condition(relative_path)).delete(synchronize_session=False)
+        db.session.commit()
+
+    def move(self, old_relative_path, new_relative_path):
+        """Keep the hashes of a renamed file or directory"""
+        old_relative_path = normalize_relative_path(old_relative_path)
+        new_relative_path = normalize_relative_path(new_relative_path)
+        for row in FileHash.query.filter(subtree_condition(old_relative_path)).all():
+            row.path = new_relative_path + row.path[len(old_relative_path):]
+        db.session.commit()
+
+    def handle_changes(self, events):
+        """Drop the hashes of files deleted outside the web UI, from a batch of file watcher ChangeEvents"""
+        # Files changed in place are caught when their hash is checked
+        # against the file. Linking a file changes its attributes too.
+        deleted = [event.path for event in events if event.action == 'deleted']
+        if not self.enabled or not deleted:
+            return
+        with self.app.app_context():
+            for relative_path in deleted:
+                self.forget(relative_path)
+
+    def stats(self):
+        """Get the number of deduplicated files and the bytes they save"""
+        linked = (
+            select(FileHash.inode, FileHash.size, func.count().label('paths'))
+            .group_by(FileHash.inode, FileHash.size)
+            .having(func.count() > 1)
+            .subquery()
+        )
+        files, saved = db.session.execute(
+            select(func.coalesce(func.sum(linked.c.paths - 1), 0),
+                   func.coalesce(func.sum((linked.c.paths - 1) * linked.c.size), 0))
+        ).one()
+        return {'enabled': self.enabled, 'files': files, 'saved': saved}
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    hashed = self.hash_pending()
+                    if hashed:
+                        self.logger.info(f"Hashed {hashed} files for deduplication")
+                except Exception as e:
+                    db.session.rollback()
+                    self.logger.error(f"Error hashing files for deduplication: {e}")
+                finally:
+                    db.session.remove()
+
+                self._wakeup.wait(self.hash_interval)
+                self._wakeup.clear()
+
+    def _is_current(self, row):
+        try:
+            stat = os.stat(os.path.join(self.root, row.path))
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (row.inode, row.size, row.mtime_ns)
+
+
+dedup_index = DedupIndex()
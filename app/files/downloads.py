@@ -0,0 +1,258 @@
+import itertools
+import logging
+import threading
+import time
+
+# Smallest chunk a throttled stream is read and paced in
+MIN_PACED_CHUNK = 16 * 1024
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every stream it limits.
+
+    Tokens are bytes, refilled at rate per second up to burst. consume()
+    takes its tokens right away, going into debt if needed, and sleeps
+    until the debt is paid, so concurrent streams on the same bucket split
+    the rate between them instead of racing for it.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self.burst = rate
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DownloadStream:
+    """
+    An active download, holding one of the download slots until closed.
+
+    Streams without a rate limit are sent with sendfile() where the server
+    supports it, which Python never sees, so their bytes are counted when
+    they finish. Other streams go through paced() and count every chunk.
+    Only the stream's own request thread updates its count.
+    """
+
+    def __init__(self, manager, stream_id, name, owner, buckets):
+        self.manager = manager
+        self.id = stream_id
+        self.name = name
+        self.owner = owner
+        self.buckets = buckets
+        self.started = time.time()
+        self.sent = 0
+        self.length = None
+        self.counted = False  # bytes are counted as they are sent
+        self.sendfile = False  # sent by the server through wsgi.file_wrapper
+        self._closed = False
+
+    @property
+    def throttled(self):
+        return bool(self.buckets)
+
+    @property
+    def chunk_size(self):
+        """Chunk size that keeps a throttled stream smooth, about 1/10 s of its rate"""
+        rate = min(bucket.rate for bucket in self.buckets)
+        return max(MIN_PACED_CHUNK, rate // 10)
+
+    def expect(self, length):
+        """Record the size of a body sent without passing through Python"""
+        self.length = length
+        self.sendfile = True
+
+    def paced(self, iterable):
+        """Wrap a response body so its chunks are counted and rate limited"""
+        self.counted = True
+        return PacedBody(self, iterable)
+
+    def record(self, amount):
+        for bucket in self.buckets:
+            bucket.consume(amount)
+        self.sent += amount
+
+    def close(self):
+        """Release the slot. Called when the response is closed."""
+        if self._closed:
+            return
+        self._closed = True
+        if self.length is not None and not self.sent:
+            self.sent = self.length
+        self.manager.release(self)
+
+
+class PacedBody:
+    """Response body that counts and paces the chunks of another one"""
+
+    def __init__(self, stream, iterable):
+        self.stream = stream
+        self.iterable = iterable
+        self._iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self._iterator)
+        self.stream.record(len(chunk))
+        return chunk
+
+    def close(self):
+        close = getattr(self.iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+class DownloadManager:
+    """
+    Admission control and bandwidth shaping for downloads.
+
+    At most DOWNLOAD_MAX_STREAMS downloads are sent at once per process.
+    Further ones wait in line for up to DOWNLOAD_QUEUE_TIMEOUT seconds and
+    are turned away after that, so a hammered share link queues up instead
+    of saturating the uplink with dozens of parallel streams.
+
+    Rate limits come from BandwidthLimit rows of users and share links,
+    falling back to DOWNLOAD_USER_RATE_LIMIT and DOWNLOAD_SHARE_RATE_LIMIT.
+    Every user and every link has one token bucket shared by all its
+    streams, so opening more connections doesn't raise the limit.
+    """
+
+    def __init__(self, max_streams=8, queue_timeout=30):
+        self.max_streams = max_streams
+        self.queue_timeout = queue_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._streams = {}
+        self._queued = 0
+        self._ids = itertools.count(1)
+        self._buckets = {}
+
+        # Counters for the admin page. Bytes of active streams are added
+        # to bytes_sent when they are released.
+        self.bytes_sent = 0
+        self.rejected = 0
+        self._rate_sample = (time.time(), 0)
+        self._rate = 0
+
+    def init_app(self, app):
+        self.max_streams = app.config.get('DOWNLOAD_MAX_STREAMS', self.max_streams)
+        self.queue_timeout = app.config.get('DOWNLOAD_QUEUE_TIMEOUT', self.queue_timeout)
+        self.logger = app.logger
+        app.extensions['download_manager'] = self
+
+    def get_bucket(self, key, rate):
+        """
+        Get the shared token bucket of a user or link.
+
+        Args:
+            key (tuple): ('user', id) or ('link', id)
+            rate (int): Limit in bytes per second, 0 for none
+
+        Returns:
+            TokenBucket: The bucket, or None if the rate is unlimited
+        """
+        with self._lock:
+            if not rate:
+                self._buckets.pop(key, None)
+                return None
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate)
+            elif bucket.rate != rate:
+                bucket.set_rate(rate)
+            return bucket
+
+    def open_stream(self, name, owner, buckets=()):
+        """
+        Wait for a free download slot.
+
+        Args:
+            name (str): What is downloaded, for the admin page
+            owner (str): Who downloads it, for the admin page
+            buckets (iterable): Token buckets limiting the stream
+
+        Returns:
+            DownloadStream: The stream, or None if no slot freed up in time
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        with self._lock:
+            self._queued += 1
+            try:
+                while len(self._streams) >= self.max_streams:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return None
+                    self._slot_freed.wait(remaining)
+            finally:
+                self._queued -= 1
+
+            stream = DownloadStream(self, next(self._ids), name, owner,
+                                    [bucket for bucket in buckets if bucket is not None])
+            self._streams[stream.id] = stream
+            return stream
+
+    def release(self, stream):
+        with self._lock:
+            if self._streams.pop(stream.id, None) is not None:
+                self.bytes_sent += stream.sent
+                self._slot_freed.notify()
+
+    def stats(self):
+        """Get the active streams and overall throughput"""
+        now = time.time()
+        with self._lock:
+            streams = list(self._streams.values())
+            queued = self._queued
+            bytes_sent = self.bytes_sent + sum(stream.sent for stream in streams)
+            # Throughput since the previous call, counting bytes of finished
+            # sendfile streams at the time they finished
+            last_time, last_bytes = self._rate_sample
+            if now - last_time >= 1:
+                self._rate = max(bytes_sent - last_bytes, 0) / (now - last_time)
+                self._rate_sample = (now, bytes_sent)
+
+        active = []
+        for stream in streams:
+            elapsed = max(now - stream.started, 0.001)
+            active.append({
+                'id': stream.id,
+                'name': stream.name,
+                'owner': stream.owner,
+                'elapsed': elapsed,
+                'sent': stream.sent,
+                'rate': stream.sent / elapsed if stream.counted else None,
+                'sendfile': stream.sendfile,
+                'limit': min(bucket.rate for bucket in stream.buckets) if stream.throttled else None,
+            })
+        return {
+            'active': active,
+            'queued': queued,
+            'max_streams': self.max_streams,
+            'rejected': self.rejected,
+            'bytes_sent': bytes_sent,
+            'bytes_per_second': self._rate,
+        }
+
+
+download_manager = DownloadManager()
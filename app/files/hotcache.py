@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.files.serving import make_etag, file_last_modified
+
+# Download counters kept for files that aren't cached (yet)
+MAX_TRACKED_FILES = 4096
+
+
+class HotFile:
+    """A cached file version: its content and validators"""
+
+    def __init__(self, data, stat):
+        self.data = data
+        self.key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.size = stat.st_size
+        self.etag = make_etag(stat)
+        self.last_modified = file_last_modified(stat)
+
+
+class HotFileCache:
+    """
+    Process-wide cache of the content of frequently downloaded files.
+
+    Share links tend to point at a few popular files, so a file downloaded
+    HOT_CACHE_MIN_HITS times is admitted if it is at most
+    HOT_CACHE_MAX_FILE_SIZE, and its content read into memory. A hit then
+    costs one stat() to validate the entry against the file's inode, size
+    and mtime, instead of opening and reading the file again.
+
+    Entries are bounded by HOT_CACHE_MAX_BYTES and HOT_CACHE_MAX_ENTRIES,
+    evicting the least recently used first. Content is copied rather than
+    memory mapped: a mapped file truncated outside the web UI while it is
+    being sent would fault the worker with SIGBUS.
+
+    Changes reported by the file watcher drop the affected entries right
+    away. Files modified in the last min_age seconds may still be being
+    written and are not admitted.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, max_file_size=1024 * 1024,
+                 min_hits=2, min_age=60.0):
+        self.root = None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.min_hits = min_hits
+        self.min_age = min_age
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> HotFile
+        self._downloads = OrderedDict()  # path -> downloads while not cached
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.root = app.config['STORAGE_PATH']
+        self.max_entries = app.config.get('HOT_CACHE_MAX_ENTRIES', self.max_entries)
+        self.max_bytes = app.config.get('HOT_CACHE_MAX_BYTES', self.max_bytes)
+        self.max_file_size = app.config.get('HOT_CACHE_MAX_FILE_SIZE', self.max_file_size)
+        self.min_hits = app.config.get('HOT_CACHE_MIN_HITS', self.min_hits)
+        app.extensions['hot_cache'] = self
+
+    def get(self, path, stat):
+        """
+        Get the cached content of a file, admitting it if it has become hot.
+
+        Args:
+            path (str): Path to the file
+            stat (os.stat_result): Current status of the file
+
+        Returns:
+            HotFile: The entry, or None to serve the file from disk
+        """
+        if not self.max_entries:
+            return None
+
+        path = os.path.normpath(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                if entry.key == key:
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    return entry
+                # The file changed since it was cached
+                self._remove(path)
+
+            self.misses += 1
+            if not self._admissible(stat):
+                return None
+            downloads = self._downloads.pop(path, 0) + 1
+            if downloads < self.min_hits:
+                self._downloads[path] = downloads
+                if len(self._downloads) > MAX_TRACKED_FILES:
+                    self._downloads.popitem(last=False)
+                return None
+
+        entry = self._load(path, stat)
+        if entry is None:
+            return None
+
+        with self._lock:
+            self._remove(path)
+            self._entries[path] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drop the cached content of a file.
+
+        Args:
+            path (str): Path to the file, or a directory with recursive
+            recursive (bool): Also drop all files below it
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            self._remove(path)
+            self._downloads.pop(path, None)
+            if recursive:
+                prefix = path.rstrip(os.sep) + os.sep
+                for cached_path in [p for p in self._entries if p.startswith(prefix)]:
+                    self._remove(cached_path)
+
+    def handle_changes(self, events):
+        """Drop the files made stale by a batch of file watcher ChangeEvents"""
+        for event in events:
+            full_path = os.path.join(self.root, event.path)
+            if event.action == 'changed':
+                # Only the directory's listing changed. Entries are checked
+                # against the file's stat on every hit anyway.
+                continue
+            self.invalidate(full_path, recursive=event.is_dir or event.action == 'rescan')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._downloads.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Get hit/miss counters and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups * 100) if lookups else 0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def _admissible(self, stat):
+        if time.time() - stat.st_mtime < self.min_age:
+            return False
+        return stat.st_size <= min(self.max_file_size, self.max_bytes)
+
+    def _load(self, path, stat):
+        # Returns the new entry, or None if the file changed or can't be read
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                current = os.fstat(f.fileno())
+                if (current.st_ino, current.st_size, current.st_mtime_ns) != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                    return None
+                data = f.read(stat.st_size)
+                if len(data) != stat.st_size:
+                    return None
+                return HotFile(data, stat)
+        except OSError:
+            return None
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+
+hot_cache = HotFileCache()
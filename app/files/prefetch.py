@@ -0,0 +1,246 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Clients tracked for sequential access detection
+MAX_TRACKED_STREAMS = 1024
+
+# A range starting at most this far past where the client's previous one
+# ended still counts as reading on (players skip over the odd chunk)
+SEQUENTIAL_SLACK = 1024 * 1024
+
+# Seconds after which a client's previous range is forgotten
+STREAM_TIMEOUT = 60
+
+# Chunk size the page cache is warmed in where posix_fadvise is missing
+WARM_CHUNK_SIZE = 1024 * 1024
+
+
+def is_media(mimetype):
+    """Check if a content type is played as a stream (video and audio)"""
+    return bool(mimetype) and mimetype.startswith(('video/', 'audio/'))
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Give the kernel a hint about how a file will be read.
+
+    Returns:
+        bool: False if the platform has no posix_fadvise or refused the hint
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        return False
+    return True
+
+
+class ReadAheadRange:
+    """
+    Iterator over a byte range of an open file, read ahead on the I/O threads.
+
+    Up to depth chunks are being read with pread() while the request thread
+    sends the current one, so disk latency overlaps with the network. A
+    chunk whose read hasn't started yet when it is needed (all I/O threads
+    busy) is read right away instead, so this is never slower than reading
+    in the request thread. Closes the file when closed.
+    """
+
+    def __init__(self, prefetcher, file, start, length, chunk_size, depth):
+        self.prefetcher = prefetcher
+        self.file = file
+        self.fd = file.fileno()
+        self.next_offset = start
+        self.end = start + length
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.pending = deque()  # (future, offset, size)
+        self._fill()
+
+    def _fill(self):
+        executor = self.prefetcher.executor()
+        while len(self.pending) < self.depth and self.next_offset < self.end:
+            size = min(self.chunk_size, self.end - self.next_offset)
+            future = executor.submit(os.pread, self.fd, size, self.next_offset)
+            self.pending.append((future, self.next_offset, size))
+            self.next_offset += size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            raise StopIteration
+        future, offset, size = self.pending.popleft()
+        if future.cancel():
+            self.prefetcher.count('sync_reads')
+            chunk = os.pread(self.fd, size, offset)
+        else:
+            chunk = future.result()
+            self.prefetcher.count('buffered_reads')
+
+        if len(chunk) < size:
+            # The file shrank since the response was started
+            self._cancel()
+            if not chunk:
+                raise StopIteration
+            return chunk
+        self._fill()
+        return chunk
+
+    def _cancel(self):
+        # Reads already running must finish before the file is closed, or
+        # they could hit another file opened under the same descriptor
+        running = [future for future, _, _ in self.pending if not future.cancel()]
+        self.pending.clear()
+        self.next_offset = self.end
+        wait(running)
+
+    def close(self):
+        self._cancel()
+        self.file.close()
+
+
+class Prefetcher:
+    """
+    Read-ahead for video and audio played through the download routes.
+
+    Players fetch media as a run of Range requests, each read synchronously
+    by the request thread, so on slow storage (SD cards) every request
+    starts with a stall. The prefetcher remembers where each client's last
+    range of a file ended. A range that continues it, or that runs to the
+    end of the file, is a sequential stream, which gets:
+
+    - POSIX_FADV_SEQUENTIAL on the response's file, doubling the kernel's
+      read-ahead,
+    - the next PREFETCH_WINDOW bytes loaded into the page cache from a
+      background I/O thread (POSIX_FADV_WILLNEED, or by reading them where
+      that isn't available), so the client's next request is served from
+      memory,
+    - and, when the body is read through Python rather than sent with
+      sendfile, a ReadAheadRange reading PREFETCH_BUFFER_CHUNKS chunks
+      ahead of the one being sent.
+
+    Random access (seeking) is left alone.
+    """
+
+    def __init__(self, window=8 * 1024 * 1024, buffer_chunks=4, workers=4):
+        self.enabled = True
+        self.window = window
+        self.buffer_chunks = buffer_chunks
+        self.workers = workers
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._streams = OrderedDict()  # (client, path) -> [stop, warmed_until, last_seen]
+        self._counters = {
+            'sequential': 0,
+            'random': 0,
+            'warmed_bytes': 0,
+            'buffered_reads': 0,
+            'sync_reads': 0,
+        }
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PREFETCH_ENABLED', self.enabled)
+        self.window = app.config.get('PREFETCH_WINDOW', self.window)
+        self.buffer_chunks = app.config.get('PREFETCH_BUFFER_CHUNKS', self.buffer_chunks)
+        self.workers = app.config.get('PREFETCH_WORKERS', self.workers)
+        app.extensions['prefetcher'] = self
+
+    def executor(self):
+        """Get the I/O thread pool, starting it on first use"""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='prefetch')
+        return self._executor
+
+    def track(self, client, path, file, start, length):
+        """
+        Record a range a client requested and start read-ahead if it is sequential.
+
+        Args:
+            client (hashable): Who requests it, e.g. ('user', id, address)
+            path (str): Path to the file
+            file: The file the response is sent from
+            start (int): Offset of the range
+            length (int): Length of the range
+
+        Returns:
+            bool: True if the range is part of a sequential stream
+        """
+        if not self.enabled:
+            return False
+
+        stop = start + length
+        size = os.fstat(file.fileno()).st_size
+        key = (client, path)
+        now = time.monotonic()
+        with self._lock:
+            stream = self._streams.pop(key, None)
+            if stream is not None and now - stream[2] > STREAM_TIMEOUT:
+                stream = None
+            continues = stream is not None and 0 <= start - stream[0] <= SEQUENTIAL_SLACK
+            sequential = continues or stop >= size
+            warmed_until = stream[1] if continues else start
+
+            # Warm the window after the range (ranges running to the end
+            # are chased by the kernel's read-ahead from their start)
+            warm_from = max(warmed_until, start if stop >= size else stop)
+            warm_to = min(size, (start if stop >= size else stop) + self.window)
+            if sequential and warm_to > warm_from:
+                warmed_until = warm_to
+            self._streams[key] = [stop, warmed_until, now]
+            if len(self._streams) > MAX_TRACKED_STREAMS:
+                self._streams.popitem(last=False)
+            self._counters['sequential' if sequential else 'random'] += 1
+
+        if sequential:
+            fadvise(file.fileno(), 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 2))
+            if warm_to > warm_from:
+                self.executor().submit(self._warm, path, warm_from, warm_to - warm_from)
+        return sequential
+
+    def reader(self, file, start, length, chunk_size):
+        """Body reading a range of a sequential stream ahead of the one being sent"""
+        return ReadAheadRange(self, file, start, length, chunk_size, self.buffer_chunks)
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def stats(self):
+        """Get counters of detected streams and read-ahead"""
+        with self._lock:
+            return dict(self._counters, streams=len(self._streams))
+
+    def _warm(self, path, offset, length):
+        # Runs on an I/O thread. Opens the file itself, the response's file
+        # may be closed any time.
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            if fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_WILLNEED', 3)):
+                self.count('warmed_bytes', length)
+                return
+            end = offset + length
+            while offset < end:
+                read = len(os.pread(fd, min(WARM_CHUNK_SIZE, end - offset), offset))
+                if not read:
+                    break
+                offset += read
+                self.count('warmed_bytes', read)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+prefetcher = Prefetcher()
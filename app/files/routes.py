@@ -1,26 +1,51 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, abort, jsonify, Response
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, abort, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
 from app import db
 from app.files.utils import (
     get_file_info, get_storage_info, create_thumbnail, create_share_link,
-    search_files, sanitize_path, get_system_info, read_file_in_chunks,
-    is_potentially_dangerous_file, get_directory_contents_with_ls
+    search_files, sanitize_path, get_system_info, format_system_sample,
+    encode_cursor, decode_cursor,
+    is_potentially_dangerous_file, scan_directory, enrich_items, detect_mime_type,
+    sort_items, SORT_FIELDS
 )
+from app.files.cache import listing_cache
+from app.files.usage import storage_usage
+from app.files.sampler import system_sampler
+from app.files.search_index import search_index
+from app.files.content_index import content_index
+from app.files.catalog import catalog
+from app.files.watcher import file_watcher
+from app.files.downloads import download_manager
+from app.files.serving import serve_file, serve_data, make_etag, file_last_modified, not_modified_response
+from app.files.compression import response_compressor, is_compressible
+from app.files.hotcache import hot_cache
+from app.files.zipstream import ZipStream, collect_entries
+from app.files.uploads import upload_manager, UploadError
+from app.files.dedup import dedup_index
 from app.auth.models import SharedLink
 from werkzeug.utils import secure_filename
 import os
+import re
+import errno
+import json
+from itertools import islice
 from app.auth.models import get_utc_now
-import mimetypes
-# Try to import magic, but provide fallback if not available
-try:
-    import magic
-    MAGIC_AVAILABLE = True
-except ImportError:
-    MAGIC_AVAILABLE = False
 import shutil
 
 files = Blueprint('files', __name__)
 
+SHA256_RE = re.compile(r'[0-9a-f]{64}')
+
+@files.before_app_request
+def start_file_watcher():
+    """Start watching STORAGE_PATH once the app serves requests"""
+    file_watcher.start()
+
+@files.before_app_request
+def start_upload_collector():
+    """Start removing expired and abandoned uploads once the app serves requests"""
+    upload_manager.start()
+
 @files.route('/')
 @files.route('/browse')
 @files.route('/browse/<path:subpath>')
@@ -42,39 +67,164 @@ def index(subpath=''):
         # If it's a file, redirect to preview
         return redirect(url_for('files.preview', subpath=subpath))
 
-    # Get pagination parameters
+    # Get pagination and sorting parameters
+    page, per_page, sort, order = get_listing_args()
+
+    try:
+        items, pagination = get_listing_page(current_path, subpath, page, per_page, sort, order)
+    except OSError as e:
+        current_app.logger.error(f"Error listing directory: {e}")
+        flash(f"Error listing directory: {str(e)}", 'danger')
+        return redirect(url_for('files.index'))
+
+    # Get storage info
+    storage_info = get_storage_info()
+
+    # Breadcrumb navigation
+    breadcrumbs = []
+    if subpath:
+        parts = subpath.split('/')
+        path_so_far = ''
+        breadcrumbs.append({'name': 'Home', 'path': ''})
+        for i, part in enumerate(parts):
+            path_so_far = os.path.join(path_so_far, part)
+            breadcrumbs.append({'name': part, 'path': path_so_far})
+    else:
+        breadcrumbs.append({'name': 'Home', 'path': ''})
+
+    return render_template('files/browser.html',
+                          items=items,
+                          current_path=subpath,
+                          breadcrumbs=breadcrumbs,
+                          storage_info=storage_info,
+                          pagination=pagination,
+                          total_items=pagination['total_items'])
+
+@files.route('/list')
+@files.route('/list/<path:subpath>')
+@login_required
+def list_json(subpath=''):
+    """JSON variant of the directory listing, with recursive folder sizes"""
+    # Sanitize the path to prevent directory traversal
+    subpath = sanitize_path(subpath)
+
+    # Get the full path
+    storage_path = current_app.config['STORAGE_PATH']
+    current_path = os.path.join(storage_path, subpath)
+
+    if not os.path.isdir(current_path):
+        return jsonify({'error': 'Directory not found'}), 404
+
+    page, per_page, sort, order = get_listing_args()
+
+    try:
+        items, pagination = get_listing_page(current_path, subpath, page, per_page, sort, order)
+    except OSError as e:
+        current_app.logger.error(f"Error listing directory: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({'path': subpath, 'items': items, 'pagination': pagination})
+
+@files.route('/catalog')
+@files.route('/catalog/<path:subpath>')
+@login_required
+def catalog_json(subpath=''):
+    """
+    Sorted and filtered view of the file catalog.
+
+    Lists the children of a directory, or with ?recursive=1 everything below
+    it. Filters: kind (file or dir), type (MIME type prefix, e.g. image/),
+    min_size and max_size in bytes, modified_after as a Unix timestamp.
+    Paging and sorting take the same arguments as the directory listing.
+    """
+    # Sanitize the path to prevent directory traversal
+    subpath = sanitize_path(subpath)
+
+    page, per_page, sort, order = get_listing_args()
+    total_items, items = catalog.query(
+        parent=subpath,
+        recursive=request.args.get('recursive', '').lower() in ('1', 'true', 'yes'),
+        kind=request.args.get('kind'),
+        mime_prefix=request.args.get('type'),
+        min_size=request.args.get('min_size', type=int),
+        max_size=request.args.get('max_size', type=int),
+        modified_after=request.args.get('modified_after', type=float),
+        sort=sort,
+        reverse=order == 'desc',
+        offset=(page - 1) * per_page,
+        limit=per_page
+    )
+
+    # Pagination info
+    total_pages = (total_items + per_page - 1) // per_page  # Ceiling division
+    pagination = {
+        'page': page,
+        'per_page': per_page,
+        'total_items': total_items,
+        'total_pages': total_pages,
+        'has_prev': page > 1,
+        'has_next': page < total_pages,
+        'sort': sort,
+        'order': order,
+    }
+
+    return jsonify({'path': subpath, 'items': items, 'pagination': pagination,
+                    'last_scan': catalog.last_scan})
+
+def get_listing_args():
+    """Get pagination and sorting parameters of a listing request"""
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)  # Default 50 items per page
 
     # Limit per_page to reasonable values
     per_page = max(10, min(per_page, 100))  # Between 10 and 100
 
-    # Try to get directory contents using ls command first (faster for large directories)
-    all_items = get_directory_contents_with_ls(current_path)
+    sort = request.args.get('sort', 'name')
+    if sort not in SORT_FIELDS:
+        sort = 'name'
 
-    # Fallback to os.listdir if ls command fails
-    if all_items is None:
-        all_items = []
-        try:
-            for item in os.listdir(current_path):
-                # Skip hidden files
-                if item.startswith('.'):
-                    continue
-
-                item_path = os.path.join(current_path, item)
-                relative_path = os.path.join(subpath, item) if subpath else item
-                all_items.append(get_file_info(item_path, relative_path))
-        except Exception as e:
-            current_app.logger.error(f"Error listing directory: {e}")
-            flash(f"Error listing directory: {str(e)}", 'danger')
-            return redirect(url_for('files.index'))
-    else:
-        # Add relative path to each item from ls command
-        for item in all_items:
-            item['path'] = os.path.join(subpath, item['name']) if subpath else item['name']
+    # Names sort ascending by default, sizes and dates largest/newest first
+    order = request.args.get('order', 'asc' if sort == 'name' else 'desc')
+    if order not in ('asc', 'desc'):
+        order = 'asc'
+
+    return page, per_page, sort, order
+
+def get_listing_page(current_path, subpath, page, per_page, sort, order):
+    """
+    Get one page of a directory listing.
+
+    The sorted listing comes from the listing cache, so only the requested
+    page is enriched with MIME types and folder sizes.
+
+    Returns:
+        tuple: (items, pagination)
 
-    # Sort items: directories first, then by name
-    all_items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    Raises:
+        OSError: If the directory cannot be listed
+    """
+    storage_path = current_app.config['STORAGE_PATH']
+
+    def load_listing():
+        # List the directory in-process (no ls subprocess, real modification times)
+        # Sort items: directories first, then by name
+        return sort_items(scan_directory(current_path, subpath))
+
+    if sort == 'name' and order == 'asc':
+        all_items = listing_cache.get(current_path, load_listing)
+    else:
+        def sorter(items):
+            folder_totals = None
+            if sort == 'size':
+                folder_totals = storage_usage.get_many(
+                    [item['path'] for item in items if item['is_dir']]
+                )
+            return sort_items(items, sort, order == 'desc', folder_totals)
+
+        # Folder sizes change without the directory's mtime changing, so the
+        # size order is cached per generation of the usage totals
+        variant = (sort, order, storage_usage.generation if sort == 'size' else None)
+        all_items = listing_cache.get(current_path, load_listing, variant, sorter)
 
     # Calculate pagination
     total_items = len(all_items)
@@ -83,25 +233,14 @@ def index(subpath=''):
     # Ensure page is within valid range
     page = max(1, min(page, total_pages)) if total_pages > 0 else 1
 
-    # Get the items for the current page
+    # Get the items for the current page, with full metadata only for these
     start_idx = (page - 1) * per_page
     end_idx = min(start_idx + per_page, total_items)
-    items = all_items[start_idx:end_idx]
-
-    # Get storage info
-    storage_info = get_storage_info()
-
-    # Breadcrumb navigation
-    breadcrumbs = []
-    if subpath:
-        parts = subpath.split('/')
-        path_so_far = ''
-        breadcrumbs.append({'name': 'Home', 'path': ''})
-        for i, part in enumerate(parts):
-            path_so_far = os.path.join(path_so_far, part)
-            breadcrumbs.append({'name': part, 'path': path_so_far})
-    else:
-        breadcrumbs.append({'name': 'Home', 'path': ''})
+    page_items = all_items[start_idx:end_idx]
+    folder_totals = storage_usage.get_many(
+        [item['path'] for item in page_items if item['is_dir']]
+    )
+    items = enrich_items(page_items, storage_path, folder_totals)
 
     # Pagination info
     pagination = {
@@ -113,15 +252,11 @@ def index(subpath=''):
         'has_next': page < total_pages,
         'showing_start': start_idx + 1 if total_items > 0 else 0,
         'showing_end': end_idx,
+        'sort': sort,
+        'order': order,
     }
 
-    return render_template('files/browser.html',
-                          items=items,
-                          current_path=subpath,
-                          breadcrumbs=breadcrumbs,
-                          storage_info=storage_info,
-                          pagination=pagination,
-                          total_items=total_items)
+    return items, pagination
 
 @files.route('/preview/<path:subpath>')
 @login_required
@@ -159,105 +294,161 @@ def preview(subpath):
                           breadcrumbs=breadcrumbs,
                           share_link=share_link)
 
-@files.route('/download/<path:subpath>')
-@login_required
-def download(subpath):
-    # Sanitize the path to prevent directory traversal
-    subpath = sanitize_path(subpath)
-
-    # Get the full path
-    storage_path = current_app.config['STORAGE_PATH']
-    file_path = os.path.join(storage_path, subpath)
+def open_download_stream(name, share_link=None):
+    """
+    Wait for a download slot, rate limited by the share link the download
+    comes through, or by the logged-in user.
+
+    Returns:
+        DownloadStream: The stream, or None if no slot freed up in time
+    """
+    if share_link is not None:
+        limit = share_link.bandwidth_limit
+        rate = limit.rate if limit else current_app.config.get('DOWNLOAD_SHARE_RATE_LIMIT', 0)
+        bucket = download_manager.get_bucket(('link', share_link.id), rate)
+        owner = f"Share link of {share_link.user.username}" if share_link.user else "Share link"
+    else:
+        limit = current_user.bandwidth_limit
+        rate = limit.rate if limit else current_app.config.get('DOWNLOAD_USER_RATE_LIMIT', 0)
+        bucket = download_manager.get_bucket(('user', current_user.id), rate)
+        owner = current_user.username
 
-    # Check if file exists
-    if not os.path.exists(file_path) or os.path.isdir(file_path):
-        flash('File not found', 'danger')
-        return redirect(url_for('files.index'))
+    return download_manager.open_stream(name, owner, [bucket])
 
-    # Get file size and name
-    file_size = os.path.getsize(file_path)
-    file_name = os.path.basename(file_path)
+def too_many_downloads():
+    response = Response('Too many downloads in progress, try again later', status=503)
+    response.headers['Retry-After'] = '30'
+    return response
 
-    # Get file type
-    if MAGIC_AVAILABLE:
-        try:
-            mime = magic.Magic(mime=True)
-            file_type = mime.from_file(file_path)
-        except:
-            file_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-    else:
-        # Fallback to mimetypes if magic is not available
-        file_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+def send_download(file_path, share_link=None):
+    """
+    Send a file as an attachment.
 
-    # Check for Range header to support resumable downloads
-    range_header = request.headers.get('Range', None)
+    Supports ranges (including several at once), ETag and Last-Modified
+    validators and If-Range, so clients can resume and revalidate. The
+    download waits for a slot of the download manager and is rate limited
+    by the share link it comes through, or by the logged-in user. Popular
+    files are served from the hot file cache.
+    """
+    file_name = os.path.basename(file_path)
+    stat = os.stat(file_path)
 
-    # Default chunk size (1MB - optimized for mobile networks)
-    chunk_size = 1024 * 1024
+    # Get file type (cached per file version)
+    file_type = detect_mime_type(file_path, stat)
 
-    # If no range header, send entire file with optimized streaming
-    if not range_header:
-        # Use our optimized file reading function
-        def generate():
-            yield from read_file_in_chunks(file_path, chunk_size=chunk_size)
+    # For potentially dangerous files, send a generic content type
+    dangerous = is_potentially_dangerous_file(file_name)
+    if dangerous:
+        file_type = 'application/octet-stream'
 
-        response = Response(generate(), mimetype=file_type)
-        response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
-        response.headers['Content-Length'] = str(file_size)
-        response.headers['Accept-Ranges'] = 'bytes'
+    stream = None
+    if request.method == 'GET':
+        stream = open_download_stream(file_name, share_link)
+        if stream is None:
+            return too_many_downloads()
 
-        # Add security headers to prevent Chrome warnings
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        response.headers['Content-Security-Policy'] = "default-src 'self'"
+    try:
+        # Text files sent compressed come from the compressed variant cache instead
+        entry = None
+        if not (is_compressible(file_type) and response_compressor.negotiate()):
+            entry = hot_cache.get(file_path, stat)
+        if entry is not None:
+            response = serve_data(entry.data, file_type, entry.etag, entry.last_modified, stream=stream)
+        else:
+            # Clients are told apart per address, a user may play on several devices
+            client = ('link', share_link.id) if share_link is not None else ('user', current_user.id)
+            response = serve_file(file_path, file_type, stream=stream, compress=True,
+                                  client=client + (request.remote_addr,))
+    except BaseException:
+        if stream is not None:
+            stream.close()
+        raise
 
-        # For potentially dangerous files, set the correct content type
-        if is_potentially_dangerous_file(file_name):
-            response.headers['Content-Type'] = 'application/octet-stream'
-            # Add header to indicate this is a safe download
-            response.headers['X-Download-Options'] = 'noopen'
+    response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
 
-        return response
+    # Add security headers to prevent Chrome warnings
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = "default-src 'self'"
+    if dangerous:
+        # Add header to indicate this is a safe download
+        response.headers['X-Download-Options'] = 'noopen'
 
-    # Parse range header
-    ranges = range_header.replace('bytes=', '').split(',')
-    range_tuple = ranges[0].split('-')
+    return response
 
-    # Get start and end positions
-    range_start = int(range_tuple[0]) if range_tuple[0] else 0
-    range_end = int(range_tuple[1]) if len(range_tuple) > 1 and range_tuple[1] else file_size - 1
+@files.route('/download/<path:subpath>')
+@login_required
+def download(subpath):
+    # Sanitize the path to prevent directory traversal
+    subpath = sanitize_path(subpath)
 
-    # Ensure range is valid
-    if range_start >= file_size:
-        # Return 416 Range Not Satisfiable
-        return Response(status=416)
+    # Get the full path
+    storage_path = current_app.config['STORAGE_PATH']
+    file_path = os.path.join(storage_path, subpath)
 
-    # Adjust end if it's beyond file size
-    if range_end >= file_size:
-        range_end = file_size - 1
+    # Check if file exists
+    if not os.path.exists(file_path) or os.path.isdir(file_path):
+        flash('File not found', 'danger')
+        return redirect(url_for('files.index'))
 
-    # Calculate content length
-    content_length = range_end - range_start + 1
+    return send_download(file_path)
 
-    # Create partial response using our optimized file reading function
-    def generate_partial():
-        yield from read_file_in_chunks(file_path, chunk_size=chunk_size, start_pos=range_start, end_pos=range_end)
+@files.route('/download_zip', methods=['GET', 'POST'])
+@login_required
+def download_zip():
+    """
+    Download a folder, or several selected files and folders, as a ZIP.
+
+    The archive is streamed from disk as it is sent, see ZipStream. Takes
+    a folder as 'path', or the selection as repeated 'paths' values, which
+    the browser posts so long selections don't hit URL length limits.
+    """
+    storage_path = current_app.config['STORAGE_PATH']
 
-    response = Response(generate_partial(), mimetype=file_type, status=206)
-    response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
-    response.headers['Content-Length'] = str(content_length)
-    response.headers['Content-Range'] = f'bytes {range_start}-{range_end}/{file_size}'
-    response.headers['Accept-Ranges'] = 'bytes'
+    # Sanitize the paths to prevent directory traversal
+    paths = [sanitize_path(path).rstrip('/') for path in request.values.getlist('paths')]
+    if not paths:
+        paths = [sanitize_path(request.values.get('path', '')).rstrip('/')]
+
+    # Drop duplicates and paths inside another selected folder
+    selected = []
+    for path in sorted(set(paths)):
+        if not any(parent == '' or path.startswith(parent + '/') for parent in selected):
+            selected.append(path)
+
+    # Check the paths exist
+    for path in selected:
+        if not os.path.exists(os.path.join(storage_path, path)):
+            flash('File not found', 'danger')
+            return redirect(url_for('files.index'))
 
-    # Add security headers to prevent Chrome warnings
+    # Name the archive after the folder, or after the folder the selection is in
+    if len(selected) == 1 and os.path.isdir(os.path.join(storage_path, selected[0])):
+        zip_name = os.path.basename(selected[0]) or 'NAS'
+    else:
+        parent = os.path.dirname(selected[0])
+        zip_name = os.path.basename(parent) if all(os.path.dirname(path) == parent for path in selected) else ''
+        zip_name = zip_name or 'download'
+    zip_name += '.zip'
+
+    compress_level = current_app.config.get('ZIP_COMPRESSION_LEVEL', 6)
+    entries = collect_entries(storage_path, selected, compress=compress_level > 0)
+
+    stream = open_download_stream(zip_name)
+    if stream is None:
+        return too_many_downloads()
+
+    chunk_size = current_app.config.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+    if stream.throttled:
+        chunk_size = stream.chunk_size
+    archive = ZipStream(entries, compress_level, chunk_size, current_app.logger)
+
+    response = Response(stream.paced(archive), mimetype='application/zip')
+    # Exact when every entry is stored, otherwise the archive is sent chunked
+    response.content_length = archive.content_length
+    response.call_on_close(stream.close)
+    response.headers['Content-Disposition'] = f'attachment; filename="{zip_name}"'
     response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['Content-Security-Policy'] = "default-src 'self'"
-
-    # For potentially dangerous files, set the correct content type
-    if is_potentially_dangerous_file(file_name):
-        response.headers['Content-Type'] = 'application/octet-stream'
-        # Add header to indicate this is a safe download
-        response.headers['X-Download-Options'] = 'noopen'
-
+    response.cache_control.no_store = True
     return response
 
 @files.route('/thumbnail/<path:subpath>')
@@ -274,27 +465,33 @@ def thumbnail(subpath):
     if not os.path.exists(file_path) or os.path.isdir(file_path):
         abort(404)
 
-    # Get file type
-    if MAGIC_AVAILABLE:
-        try:
-            mime = magic.Magic(mime=True)
-            file_type = mime.from_file(file_path)
-        except:
-            file_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-    else:
-        # Fallback to mimetypes if magic is not available
-        file_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    # Get file type (cached per file version)
+    stat = os.stat(file_path)
+    file_type = detect_mime_type(file_path, stat)
 
     # Only create thumbnails for images
     if not file_type.startswith('image/'):
         abort(400)
 
+    # Revalidations are answered without rendering the thumbnail again
+    etag = make_etag(stat, 'thumb')
+    last_modified = file_last_modified(stat)
+    response = not_modified_response(etag, last_modified)
+    if response is None and is_compressible(file_type):
+        # Compressed thumbnails (SVG, BMP) go out tagged with their encoding
+        encoding = response_compressor.negotiate()
+        if encoding:
+            response = not_modified_response(f'{etag}-{encoding}', last_modified)
+    if response is not None:
+        return response
+
     # Create thumbnail
     thumb_io = create_thumbnail(file_path)
     if not thumb_io:
         abort(500)
 
-    response = Response(thumb_io.getvalue(), mimetype=file_type)
+    response = serve_data(thumb_io.getvalue(), file_type, etag, last_modified,
+                          max_age=current_app.config.get('THUMBNAIL_MAX_AGE', 3600))
 
     # Add security headers to prevent Chrome warnings
     response.headers['X-Content-Type-Options'] = 'nosniff'
@@ -305,19 +502,30 @@ def thumbnail(subpath):
 @files.route('/upload', methods=['POST'])
 @login_required
 def upload():
-    # Check if the post request has the file part
-    if 'file' not in request.files:
+    # The body is parsed as it arrives and the file written straight to disk
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
         return jsonify({'error': 'No file part'}), 400
 
-    file = request.files['file']
+    try:
+        form, file = upload_manager.receive_form(request.stream, boundary.encode('latin-1'),
+                                                 sanitize_path(request.args.get('path', '')),
+                                                 request.content_length)
+    except UploadError as e:
+        return upload_error(e)
+
+    # Check if the post request has the file part
+    if file is None:
+        return jsonify({'error': 'No file part'}), 400
 
     # If user does not select file, browser also
     # submit an empty part without filename
     if file.filename == '':
+        file.discard()
         return jsonify({'error': 'No selected file'}), 400
 
     # Get the target directory
-    target_dir = request.form.get('path', '')
+    target_dir = form.get('path', request.args.get('path', ''))
     target_dir = sanitize_path(target_dir)
 
     # Get the full path
@@ -326,18 +534,293 @@ def upload():
 
     # Check if directory exists
     if not os.path.exists(upload_path) or not os.path.isdir(upload_path):
+        file.discard()
         return jsonify({'error': 'Directory not found'}), 400
 
     # Save the file
     filename = secure_filename(file.filename)
     file_path = os.path.join(upload_path, filename)
-    file.save(file_path)
+    if not filename or os.path.isdir(file_path):
+        file.discard()
+        return jsonify({'error': 'Invalid file name'}), 400
 
-    # Get file info
     relative_path = os.path.join(target_dir, filename) if target_dir else filename
-    file_info = get_file_info(file_path, relative_path)
 
-    return jsonify({'success': True, 'file': file_info})
+    # Remember the size of a file we are about to overwrite
+    old_size = os.path.getsize(file_path) if os.path.isfile(file_path) else None
+
+    # Link to a stored copy of the same content instead of keeping another
+    deduplicated = dedup_index.link_duplicate(file.sha256, file.size, file_path)
+    if deduplicated:
+        file.discard()
+    else:
+        # Rename the received file over it, so downloads still sending the
+        # old version finish with intact data
+        try:
+            os.replace(file.path, file_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                file.discard()
+                raise
+            # Received into STORAGE_PATH, which is on another filesystem
+            shutil.move(file.path, file_path)
+    if old_size is not None:
+        hot_cache.invalidate(file_path)
+    dedup_index.record(relative_path, file.sha256)
+    file_info = file_uploaded(target_dir, filename, old_size)
+
+    return jsonify({'success': True, 'file': file_info, 'sha256': file.sha256, 'deduplicated': deduplicated})
+
+def file_uploaded(target_dir, filename, old_size):
+    """
+    Update caches and indexes for a file that was just uploaded.
+
+    Args:
+        target_dir (str): Directory of the file relative to STORAGE_PATH
+        filename (str): Name of the file
+        old_size (int): Size of the file it replaced, None if it is new
+
+    Returns:
+        dict: Info about the uploaded file
+    """
+    storage_path = current_app.config['STORAGE_PATH']
+    upload_path = os.path.join(storage_path, target_dir)
+    file_path = os.path.join(upload_path, filename)
+    relative_path = os.path.join(target_dir, filename) if target_dir else filename
+
+    listing_cache.invalidate(upload_path)
+    storage_usage.file_changed(relative_path, old_size, os.path.getsize(file_path))
+    search_index.add(relative_path)
+    content_index.file_changed(relative_path)
+    catalog.rescan_later(target_dir)
+
+    return get_file_info(file_path, relative_path)
+
+@files.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Start a resumable upload, or resume an unfinished one of the same file"""
+    filename = secure_filename(request.form.get('filename', ''))
+    if not filename:
+        return jsonify({'error': 'No selected file'}), 400
+
+    try:
+        size = int(request.form.get('size', ''))
+    except ValueError:
+        return jsonify({'error': 'Invalid size'}), 400
+    if size < 0:
+        return jsonify({'error': 'Invalid size'}), 400
+    if size > current_app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'File too large'}), 413
+
+    # Get the target directory
+    target_dir = sanitize_path(request.form.get('path', ''))
+    upload_path = os.path.join(current_app.config['STORAGE_PATH'], target_dir)
+
+    # Check if directory exists
+    if not os.path.isdir(upload_path):
+        return jsonify({'error': 'Directory not found'}), 400
+    if os.path.isdir(os.path.join(upload_path, filename)):
+        return jsonify({'error': 'A folder with this name already exists'}), 400
+
+    # A client that sends the hash of the file skips the transfer if the
+    # content is already stored
+    sha256 = request.form.get('sha256', '').lower()
+    if sha256:
+        if not SHA256_RE.fullmatch(sha256):
+            return jsonify({'error': 'Invalid sha256'}), 400
+        if size and dedup_index.enabled:
+            response = link_stored_copy(target_dir, filename, sha256, size)
+            if response is not None:
+                return response
+
+    try:
+        upload = upload_manager.create(current_user.id, target_dir, filename, size,
+                                       request.form.get('fingerprint') or None)
+    except UploadError as e:
+        return upload_error(e)
+    if size == 0:
+        # Nothing to send, finish right away
+        return finish_upload(upload, status=201)
+    return upload_status(upload, status=201)
+
+@files.route('/uploads/lookup')
+@login_required
+def lookup_upload():
+    """Check whether content with the given sha256 and size is already stored"""
+    sha256 = request.args.get('sha256', '').lower()
+    size = request.args.get('size', type=int)
+    if not SHA256_RE.fullmatch(sha256) or size is None:
+        return jsonify({'error': 'Invalid sha256 or size'}), 400
+    return jsonify({'enabled': dedup_index.enabled, 'exists': dedup_index.find(sha256, size) is not None})
+
+def link_stored_copy(target_dir, filename, sha256, size):
+    """
+    Save an upload by linking to a stored file with the same content.
+
+    Returns:
+        Response: The finished upload, or None if no such file is stored
+    """
+    file_path = os.path.join(current_app.config['STORAGE_PATH'], target_dir, filename)
+    relative_path = os.path.join(target_dir, filename) if target_dir else filename
+    old_size = os.path.getsize(file_path) if os.path.isfile(file_path) else None
+
+    if not dedup_index.link_duplicate(sha256, size, file_path):
+        return None
+    if old_size is not None:
+        hot_cache.invalidate(file_path)
+    dedup_index.record(relative_path, sha256)
+    file_info = file_uploaded(target_dir, filename, old_size)
+
+    response = jsonify({'success': True, 'size': size, 'complete': True, 'deduplicated': True,
+                        'sha256': sha256, 'file': file_info})
+    response.status_code = 201
+    return response
+
+@files.route('/uploads/<token>', methods=['GET'])
+@login_required
+def get_upload(token):
+    """Get the chunks received of a resumable upload (HEAD works too)"""
+    upload = upload_manager.get(token, current_user.id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return upload_status(upload)
+
+@files.route('/uploads/<token>', methods=['PATCH'])
+@login_required
+def write_upload(token):
+    """Write the request body to a resumable upload, from the chunk at the Upload-Offset header"""
+    upload = upload_manager.get(token, current_user.id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Missing Upload-Offset header'}), 400
+    if request.content_length is None:
+        return jsonify({'error': 'Missing Content-Length header'}), 411
+
+    try:
+        written = upload_manager.write(upload, offset, request.stream, request.content_length)
+    except UploadError as e:
+        return upload_error(e)
+
+    response = upload_status(upload, chunks=False)
+    response.headers['Upload-Written'] = str(written)
+    return response
+
+@files.route('/uploads/<token>/complete', methods=['POST'])
+@login_required
+def complete_upload(token):
+    """Finish a resumable upload once every chunk was received"""
+    upload = upload_manager.get(token, current_user.id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    try:
+        return finish_upload(upload)
+    except UploadError as e:
+        if e.status == 409:
+            # Tell the client which chunks to send again
+            return upload_status(upload, status=409, error=str(e))
+        return upload_error(e)
+
+@files.route('/uploads/<token>', methods=['DELETE'])
+@login_required
+def delete_upload(token):
+    """Cancel a resumable upload"""
+    upload = upload_manager.get(token, current_user.id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    upload_manager.remove(upload)
+    return jsonify({'success': True})
+
+def upload_status(upload, status=200, chunks=True, error=None):
+    """
+    Response describing an unfinished upload.
+
+    Args:
+        upload (UploadSession): The upload
+        status (int): HTTP status of the response
+        chunks (bool): Whether to list the received chunks, a string of
+            '0' and '1' with one character per chunk
+        error (str): Why the request failed, if it did
+
+    Returns:
+        Response: JSON with the upload's offset (bytes received without a
+            gap from the start) and chunk size
+    """
+    chunk_map = upload_manager.get_chunk_map(upload)
+    if chunk_map is None:
+        # Completed, cancelled or expired in the meantime
+        response = jsonify({'error': 'Upload not found'})
+        response.status_code = 404
+        return response
+    offset = chunk_map.offset(upload.size)
+    body = {
+        'id': upload.token,
+        'url': url_for('files.get_upload', token=upload.token),
+        'complete_url': url_for('files.complete_upload', token=upload.token),
+        'size': upload.size,
+        'chunk_size': chunk_map.chunk_size,
+        'offset': offset,
+        'received': chunk_map.received_bytes(upload.size),
+        'complete': False
+    }
+    if chunks:
+        body['chunks'] = chunk_map.encode()
+    if error:
+        body['error'] = error
+    response = jsonify(body)
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(upload.size)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def upload_error(error):
+    """Response for an UploadError"""
+    response = jsonify({'error': str(error), 'offset': error.offset})
+    response.status_code = error.status
+    if error.offset is not None:
+        response.headers['Upload-Offset'] = str(error.offset)
+    return response
+
+def finish_upload(upload, status=200):
+    """
+    Move a completely received upload into place and respond with its info.
+
+    Raises:
+        UploadError: If chunks are missing
+    """
+    target_dir, filename, size = upload.target_dir, upload.filename, upload.size
+    file_path = upload_manager.final_path(upload)
+
+    # Remember the size of a file we are about to overwrite. The rename
+    # replaces it, downloads still sending the old version keep their data.
+    old_size = os.path.getsize(file_path) if os.path.isfile(file_path) else None
+
+    # Hashed while the chunks came in
+    sha256 = upload_manager.received_hash(upload)
+    upload_manager.finish(upload)
+
+    deduplicated = False
+    if sha256 is not None:
+        deduplicated = dedup_index.link_duplicate(sha256, size, file_path)
+        dedup_index.record(os.path.join(target_dir, filename) if target_dir else filename, sha256)
+    elif dedup_index.enabled:
+        # Not reading the whole file again in this request
+        dedup_index.hash_later()
+
+    if old_size is not None:
+        hot_cache.invalidate(file_path)
+    file_info = file_uploaded(target_dir, filename, old_size)
+
+    response = jsonify({'success': True, 'size': size, 'complete': True, 'file': file_info,
+                        'sha256': sha256, 'deduplicated': deduplicated})
+    response.status_code = status
+    return response
 
 @files.route('/create_folder', methods=['POST'])
 @login_required
@@ -371,6 +854,10 @@ def create_folder():
 
     # Create the folder
     os.makedirs(new_folder_path)
+    listing_cache.invalidate(parent_path)
+    storage_usage.add_directory(os.path.join(target_dir, folder_name))
+    search_index.add(os.path.join(target_dir, folder_name), is_dir=True)
+    catalog.rescan_later(target_dir)
     flash('Folder created successfully', 'success')
 
     if target_dir:
@@ -400,13 +887,32 @@ def delete(subpath):
     try:
         if os.path.isdir(path):
             shutil.rmtree(path)
+            storage_usage.remove_tree(subpath)
+            search_index.remove(subpath)
+            content_index.remove(subpath)
             flash('Directory deleted successfully', 'success')
         else:
+            size = os.path.getsize(path)
             os.remove(path)
+            storage_usage.file_changed(subpath, size, None)
+            search_index.remove(subpath)
+            content_index.remove(subpath)
             flash('File deleted successfully', 'success')
     except Exception as e:
+        # Part of a tree may be gone, let the tracker recount it
+        storage_usage.rescan_later(subpath)
+        search_index.rescan_later(subpath)
+        content_index.file_changed(subpath)
         flash(f'Error deleting: {str(e)}', 'danger')
 
+    # Invalidate even after a partial failure, some entries may be gone
+    listing_cache.invalidate(path, recursive=True)
+    listing_cache.invalidate(os.path.join(storage_path, parent_dir))
+    hot_cache.invalidate(path, recursive=True)
+    if not os.path.exists(path):
+        dedup_index.forget(subpath)
+    catalog.rescan_later(parent_dir)
+
     if parent_dir:
         return redirect(url_for('files.index', subpath=parent_dir))
     else:
@@ -448,17 +954,58 @@ def rename(subpath):
         return redirect(url_for('files.index', subpath=parent_dir))
 
     # Rename the file or directory
+    new_subpath = os.path.join(parent_dir, new_name)
     try:
+        size = None if os.path.isdir(old_path) else os.path.getsize(old_path)
         os.rename(old_path, new_path)
-        flash('Renamed successfully', 'success')
     except Exception as e:
         flash(f'Error renaming: {str(e)}', 'danger')
+    else:
+        update_indexes([
+            ('storage usage', lambda: storage_usage.move(subpath, new_subpath, size),
+             lambda: storage_usage.rescan_later(parent_dir)),
+            ('search index', lambda: search_index.move(subpath, new_subpath),
+             lambda: search_index.rescan_later(parent_dir)),
+            ('content index', lambda: content_index.move(subpath, new_subpath),
+             lambda: (content_index.remove(subpath), content_index.file_changed(new_subpath))),
+            ('deduplication index', lambda: dedup_index.move(subpath, new_subpath),
+             lambda: dedup_index.forget(subpath)),
+        ])
+        flash('Renamed successfully', 'success')
+
+    listing_cache.invalidate(old_path, recursive=True)
+    listing_cache.invalidate(parent_path)
+    hot_cache.invalidate(old_path, recursive=True)
+    catalog.rescan_later(parent_dir)
 
     if parent_dir:
         return redirect(url_for('files.index', subpath=parent_dir))
     else:
         return redirect(url_for('files.index'))
 
+def update_indexes(updates):
+    """
+    Bring caches and indexes in line with a change already made on disk.
+
+    Each update runs on its own. One that fails is logged and its
+    fallback (usually a rescan) runs instead, so a broken index neither
+    fails the request nor leaves the others stale.
+
+    Args:
+        updates (list): (name, update, fallback) tuples, the last two callables
+    """
+    for name, update, fallback in updates:
+        try:
+            update()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error updating {name}, rescanning instead: {e}")
+            try:
+                fallback()
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"Error rescanning {name}: {e}")
+
 @files.route('/share/<path:subpath>', methods=['POST'])
 @login_required
 def share(subpath):
@@ -546,140 +1093,107 @@ def download_shared(token):
     share_link.access_count += 1
     db.session.commit()
 
-    # Get file size and name
-    file_size = os.path.getsize(file_path)
-    file_name = os.path.basename(file_path)
+    return send_download(file_path, share_link)
 
-    # Get file type
-    if MAGIC_AVAILABLE:
-        try:
-            mime = magic.Magic(mime=True)
-            file_type = mime.from_file(file_path)
-        except:
-            file_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-    else:
-        # Fallback to mimetypes if magic is not available
-        file_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-
-    # Check for Range header to support resumable downloads
-    range_header = request.headers.get('Range', None)
-
-    # Default chunk size (1MB - optimized for mobile networks)
-    chunk_size = 1024 * 1024
-
-    # If no range header, send entire file with optimized streaming
-    if not range_header:
-        # Use our optimized file reading function
-        def generate():
-            yield from read_file_in_chunks(file_path, chunk_size=chunk_size)
-
-        response = Response(generate(), mimetype=file_type)
-        response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
-        response.headers['Content-Length'] = str(file_size)
-        response.headers['Accept-Ranges'] = 'bytes'
-
-        # Add security headers to prevent Chrome warnings
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        response.headers['Content-Security-Policy'] = "default-src 'self'"
-
-        # For potentially dangerous files, set the correct content type
-        if is_potentially_dangerous_file(file_name):
-            response.headers['Content-Type'] = 'application/octet-stream'
-            # Add header to indicate this is a safe download
-            response.headers['X-Download-Options'] = 'noopen'
-
-        return response
-
-    # Parse range header
-    ranges = range_header.replace('bytes=', '').split(',')
-    range_tuple = ranges[0].split('-')
-
-    # Get start and end positions
-    range_start = int(range_tuple[0]) if range_tuple[0] else 0
-    range_end = int(range_tuple[1]) if len(range_tuple) > 1 and range_tuple[1] else file_size - 1
-
-    # Ensure range is valid
-    if range_start >= file_size:
-        # Return 416 Range Not Satisfiable
-        return Response(status=416)
+@files.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '')
 
-    # Adjust end if it's beyond file size
-    if range_end >= file_size:
-        range_end = file_size - 1
+    if not query:
+        return redirect(url_for('files.index'))
 
-    # Calculate content length
-    content_length = range_end - range_start + 1
+    # Results are streamed by search_stream, the page only carries the arguments
+    mode, per_page, cursor = get_search_args()
 
-    # Create partial response using our optimized file reading function
-    def generate_partial():
-        yield from read_file_in_chunks(file_path, chunk_size=chunk_size, start_pos=range_start, end_pos=range_end)
+    return render_template('files/search.html',
+                          query=query,
+                          mode=mode,
+                          per_page=per_page,
+                          cursor=cursor,
+                          content_search=content_index.enabled)
 
-    response = Response(generate_partial(), mimetype=file_type, status=206)
-    response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
-    response.headers['Content-Length'] = str(content_length)
-    response.headers['Content-Range'] = f'bytes {range_start}-{range_end}/{file_size}'
-    response.headers['Accept-Ranges'] = 'bytes'
+@files.route('/search/stream')
+@login_required
+def search_stream():
+    """
+    Stream one page of search results as newline-delimited JSON.
+
+    Each match is sent as {"item": {...}} as soon as it is found, followed by
+    {"done": true, "count": N, "next_cursor": ...}. Pass next_cursor back as
+    ?cursor= to get the following page; it is null after the last page.
+
+    With ?mode=content, files are matched by their text instead of their
+    name, best match first, and each item carries the matching lines as
+    "snippets".
+    """
+    query = request.args.get('q', '')
+    if not query:
+        return jsonify({'error': 'No search query'}), 400
 
-    # Add security headers to prevent Chrome warnings
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['Content-Security-Policy'] = "default-src 'self'"
+    mode, per_page, cursor = get_search_args()
+    storage_path = current_app.config['STORAGE_PATH']
 
-    # For potentially dangerous files, set the correct content type
-    if is_potentially_dangerous_file(file_name):
-        response.headers['Content-Type'] = 'application/octet-stream'
-        # Add header to indicate this is a safe download
-        response.headers['X-Download-Options'] = 'noopen'
+    if mode == 'content':
+        # Ranked hits are paged by offset, the cursor is the offset of the next page
+        offset = decode_cursor(cursor)
+        offset = int(offset) if offset.isdigit() else 0
+        matches = content_index.search(query, offset, per_page)
+        if matches is None:
+            return jsonify({'error': 'Content search is not available yet'}), 503
+        next_cursor = encode_cursor(str(offset + per_page))
+    else:
+        matches = iter_search_results(query, decode_cursor(cursor))
+        next_cursor = None
+
+    def generate():
+        count = 0
+        last_path = None
+        # Stop as soon as the page is full, the rest is never looked at
+        for match in islice(matches, per_page):
+            item = enrich_items([match], storage_path)[0]
+            item = dict(item, modified=item['modified'].isoformat())
+            if 'snippets' in match:
+                item['snippets'] = match['snippets']
+            yield json.dumps({'item': item}) + '\n'
+            count += 1
+            last_path = match['path']
+
+        if count < per_page:
+            page_cursor = None
+        else:
+            page_cursor = next_cursor or encode_cursor(last_path)
+        yield json.dumps({'done': True, 'count': count, 'next_cursor': page_cursor}) + '\n'
 
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
     return response
 
-@files.route('/search')
-@login_required
-def search():
-    query = request.args.get('q', '')
+def get_search_args():
+    """Get the mode, page size and cursor of a search request"""
+    mode = request.args.get('mode', 'name')
+    if mode != 'content' or not content_index.enabled:
+        mode = 'name'
 
-    if not query:
-        return redirect(url_for('files.index'))
-
-    # Get pagination parameters
-    page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)  # Default 50 items per page
 
     # Limit per_page to reasonable values
     per_page = max(10, min(per_page, 100))  # Between 10 and 100
 
-    # Search for files
-    storage_path = current_app.config['STORAGE_PATH']
-    all_results = search_files(query, storage_path)
+    return mode, per_page, request.args.get('cursor', '')
 
-    # Calculate pagination
-    total_items = len(all_results)
-    total_pages = (total_items + per_page - 1) // per_page  # Ceiling division
-
-    # Ensure page is within valid range
-    page = max(1, min(page, total_pages)) if total_pages > 0 else 1
+def iter_search_results(query, after=''):
+    """
+    Get the matches of a search query in path order.
 
-    # Get the items for the current page
-    start_idx = (page - 1) * per_page
-    end_idx = min(start_idx + per_page, total_items)
-    results = all_results[start_idx:end_idx]
-
-    # Pagination info
-    pagination = {
-        'page': page,
-        'per_page': per_page,
-        'total_items': total_items,
-        'total_pages': total_pages,
-        'has_prev': page > 1,
-        'has_next': page < total_pages,
-        'showing_start': start_idx + 1 if total_items > 0 else 0,
-        'showing_end': end_idx,
-    }
-
-    return render_template('files/search.html',
-                          query=query,
-                          results=results,
-                          pagination=pagination,
-                          total_items=total_items)
+    Answers from the filename index, or walks the tree while it is being built.
+    Both are generators, so only as many matches as are consumed are looked up.
+    """
+    matches = search_index.iter_matches(query, after)
+    if matches is None:
+        matches = search_files(query, current_app.config['STORAGE_PATH'], after)
+    return matches
 
 @files.route('/system_info')
 @login_required
@@ -698,3 +1212,65 @@ def system_info():
             'memory_total': 'N/A',
             'error': str(e)
         }), 500
+
+# Seconds between keep-alive comments on an idle event stream
+SYSTEM_STREAM_KEEPALIVE = 15
+
+# Last serialized sample, shared by all event stream subscribers
+system_event_cache = (None, None, None)
+
+def get_system_event(sample, event=None):
+    """
+    Serialize a sample as a Server-Sent Event.
+
+    Live events are serialized once per sample and shared by all streams.
+    Samples from the ring buffer are sent with event type 'history', so
+    clients can tell a sparkline backfill from live updates.
+    """
+    global system_event_cache
+    if event is not None:
+        return f"id: {sample['seq']}\nevent: {event}\ndata: {json.dumps(format_system_sample(sample))}\n\n"
+
+    key = (sample['seq'], storage_usage.generation)
+    if system_event_cache[:2] != key:
+        data = json.dumps(format_system_sample(sample))
+        system_event_cache = key + (f"id: {sample['seq']}\ndata: {data}\n\n",)
+    return system_event_cache[2]
+
+@files.route('/system_info/stream')
+@login_required
+def system_info_stream():
+    """Stream system information as Server-Sent Events"""
+    # Send up to this many samples from the ring buffer first
+    history = request.args.get('history', 0, type=int)
+    # Reconnecting clients resume after the last sample they have seen
+    last_seq = request.headers.get('Last-Event-ID', 0, type=int)
+
+    def generate():
+        seq = last_seq
+        latest = system_sampler.get_latest()
+        if latest is None or seq > latest['seq']:
+            # The server was restarted since the client's last event
+            seq = 0
+        backlog = system_sampler.get_history(after=seq)
+        if not seq:
+            backlog = backlog[-history:] if history > 0 else []
+        for sample in backlog:
+            seq = sample['seq']
+            yield get_system_event(sample, event='history')
+
+        # Tell the client how long to wait before reconnecting
+        yield f"retry: {int(system_sampler.interval * 1000) + 1000}\n\n"
+
+        while True:
+            sample = system_sampler.wait_for_sample(seq, timeout=SYSTEM_STREAM_KEEPALIVE)
+            if sample is None:
+                yield ": keep-alive\n\n"
+                continue
+            seq = sample['seq']
+            yield get_system_event(sample)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
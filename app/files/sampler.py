@@ -0,0 +1,230 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+
+def read_cpu_times():
+    """
+    Read the aggregate CPU counters from /proc/stat.
+
+    Returns:
+        tuple: (busy, total) jiffies since boot, or None if unavailable
+    """
+    try:
+        with open('/proc/stat', 'r') as f:
+            fields = f.readline().split()
+    except OSError:
+        # Android 8+ denies /proc/stat to apps, including Termux
+        return None
+
+    if not fields or fields[0] != 'cpu':
+        return None
+    values = [int(x) for x in fields[1:]]
+    # user nice system idle iowait irq softirq steal (guest is part of user)
+    total = sum(values[:8])
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return total - idle, total
+
+
+def read_memory_info():
+    """
+    Read memory usage from /proc/meminfo.
+
+    Returns:
+        tuple: (used, total) in bytes, or None if unavailable
+    """
+    meminfo = {}
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                parts = value.split()
+                if parts:
+                    meminfo[key] = int(parts[0]) * 1024
+    except (OSError, ValueError):
+        return None
+
+    total = meminfo.get('MemTotal')
+    if not total:
+        return None
+    if 'MemAvailable' in meminfo:
+        used = total - meminfo['MemAvailable']
+    else:
+        # Kernels before 3.14
+        used = total - meminfo.get('MemFree', 0) - meminfo.get('Buffers', 0) - meminfo.get('Cached', 0)
+    return used, total
+
+
+class SystemSampler:
+    """
+    Background sampler of CPU, memory and disk usage.
+
+    A single thread reads /proc/stat, /proc/meminfo and statvfs() of
+    STORAGE_PATH at a fixed interval and keeps the recent samples in a ring
+    buffer, so requests only read the latest sample no matter how many
+    clients are polling. CPU usage is computed from the difference between
+    two readings of /proc/stat, i.e. the load over the last interval.
+
+    Any number of subscribers can wait for the next sample with
+    wait_for_sample(); they are all woken by the same notification, so the
+    cost of sampling doesn't grow with the number of clients.
+
+    The thread starts on first use and pauses when nobody has asked for a
+    sample for a while, so an idle server doesn't keep waking up.
+    """
+
+    def __init__(self, interval=2.0, history=150, idle_timeout=60.0):
+        self.root = None
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._new_sample = threading.Condition(self._lock)
+        self._samples = deque(maxlen=history)
+        self._seq = 0
+        self._last_cpu = None
+        self._last_access = 0
+        self._first_sample = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        self.root = app.config['STORAGE_PATH']
+        self.interval = app.config.get('SYSTEM_SAMPLE_INTERVAL', self.interval)
+        self._samples = deque(maxlen=app.config.get('SYSTEM_SAMPLE_HISTORY', self._samples.maxlen))
+        self.logger = app.logger
+        app.extensions['system_sampler'] = self
+
+    def start(self):
+        """Start the sampler thread if it isn't running yet"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='system-sampler', daemon=True)
+            self._thread.start()
+
+    def get_latest(self, timeout=1.0):
+        """
+        Get the most recent sample.
+
+        Args:
+            timeout (float): How long to wait for the first sample
+
+        Returns:
+            dict: The sample, or None if none has been taken yet
+        """
+        self._last_access = time.time()
+        self.start()
+        self._wakeup.set()
+        self._first_sample.wait(timeout)
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def get_history(self, after=0):
+        """
+        Get the samples in the ring buffer, oldest first.
+
+        Args:
+            after (int): Only return samples with a higher sequence number
+
+        Returns:
+            list: The samples
+        """
+        self._last_access = time.time()
+        self.start()
+        self._wakeup.set()
+        with self._lock:
+            return [sample for sample in self._samples if sample['seq'] > after]
+
+    def wait_for_sample(self, after, timeout=None):
+        """
+        Wait until a sample newer than the given sequence number is taken.
+
+        Args:
+            after (int): Sequence number of the last sample the caller has seen
+            timeout (float): Maximum time to wait in seconds
+
+        Returns:
+            dict: The newest sample, or None if the wait timed out
+        """
+        self._last_access = time.time()
+        self.start()
+        self._wakeup.set()
+        with self._new_sample:
+            if not self._new_sample.wait_for(lambda: self._seq > after, timeout):
+                return None
+            return self._samples[-1]
+
+    def sample(self):
+        """Take a sample now and add it to the ring buffer"""
+        sample = {
+            'seq': None,
+            'time': time.time(),
+            'cpu_percent': None,
+            'memory_used': None,
+            'memory_total': None,
+            'disk_free': None,
+            'disk_total': None
+        }
+
+        cpu = read_cpu_times()
+        if cpu is not None:
+            last, self._last_cpu = self._last_cpu, cpu
+            if last is not None and cpu[1] > last[1]:
+                sample['cpu_percent'] = min(max((cpu[0] - last[0]) / (cpu[1] - last[1]) * 100, 0), 100)
+        else:
+            # Without /proc/stat, approximate with the load average per core
+            try:
+                load = os.getloadavg()[0]
+                sample['cpu_percent'] = min(load / (os.cpu_count() or 1) * 100, 100)
+            except OSError:
+                pass
+
+        memory = read_memory_info()
+        if memory is not None:
+            sample['memory_used'], sample['memory_total'] = memory
+
+        try:
+            stat = os.statvfs(self.root)
+            sample['disk_free'] = stat.f_bavail * stat.f_frsize
+            sample['disk_total'] = stat.f_blocks * stat.f_frsize
+        except (OSError, TypeError):
+            pass
+
+        with self._new_sample:
+            self._seq += 1
+            sample['seq'] = self._seq
+            self._samples.append(sample)
+            self._new_sample.notify_all()
+        self._first_sample.set()
+        return sample
+
+    def _run(self):
+        while True:
+            if self._last_cpu is None:
+                # CPU usage needs two readings, take the first one shortly
+                # before the sample so it doesn't come out empty
+                self._last_cpu = read_cpu_times()
+                if self._last_cpu is not None:
+                    time.sleep(min(self.interval, 0.5))
+
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f"Error sampling system info: {e}")
+                self._first_sample.set()
+
+            self._wakeup.clear()
+            if time.time() - self._last_access > self.idle_timeout:
+                # Nobody is looking, sleep until the next request. The CPU
+                # reading from before the pause is stale.
+                self._wakeup.wait()
+                self._last_cpu = None
+            else:
+                time.sleep(self.interval)
+
+
+system_sampler = SystemSampler()
@@ -0,0 +1,370 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from app.files.usage import is_hidden, normalize_relative_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name_lower TEXT NOT NULL,
+    is_dir INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trigrams (
+    gram TEXT NOT NULL,
+    entry_id INTEGER NOT NULL,
+    PRIMARY KEY (gram, entry_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trigrams_entry ON trigrams (entry_id);
+"""
+
+# Rows written per transaction while rebuilding the index
+BATCH_SIZE = 5000
+
+# Postings counted per trigram when looking for the rarest one in a query
+POSTINGS_PROBE_LIMIT = 2000
+
+
+def get_trigrams(text):
+    """Get the set of three-character substrings of a string"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def subtree_condition(relative_path, children_only=False):
+    """
+    Build a WHERE clause matching a path and everything below it.
+
+    Uses a range on the path so SQLite can answer it from the unique index:
+    all paths below 'a/b' sort between 'a/b/' and 'a/b0', '0' being the
+    character after '/'.
+    """
+    where = "(path > ? AND path < ?)"
+    params = (relative_path + '/', relative_path + '0')
+    if children_only:
+        return where, params
+    return f"(path = ? OR {where})", (relative_path,) + params
+
+
+class SearchIndex:
+    """
+    Persistent filename index for substring search.
+
+    Every file and directory under STORAGE_PATH is stored in a sidecar
+    SQLite database together with the trigrams of its lowercased name, so a
+    search only reads the postings of the query's trigrams and checks the
+    few candidates they leave, instead of walking the tree. Queries shorter
+    than three characters fall back to a scan of the names table.
+
+    The index is built by a full scan on a background thread, kept current
+    by the routes that upload, delete, rename or create files and by the
+    file watcher, and reconciled with the disk periodically. Hidden files and everything
+    inside hidden directories are not indexed.
+    """
+
+    def __init__(self, rescan_interval=3600):
+        self.root = None
+        self.db_path = None
+        self.rescan_interval = rescan_interval
+        self.logger = logging.getLogger(__name__)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ready = False
+        self._scanning = False
+        self._pending = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # Time of the last completed full scan
+        self.scanned_at = None
+
+    def init_app(self, app):
+        self.root = app.config['STORAGE_PATH']
+        self.db_path = app.config.get('SEARCH_INDEX_PATH') or os.path.join(app.instance_path, 'search_index.db')
+        self.rescan_interval = app.config.get('SEARCH_INDEX_RESCAN_INTERVAL', self.rescan_interval)
+        self.logger = app.logger
+        app.extensions['search_index'] = self
+
+    def start(self):
+        """Start the background scanner if it isn't running yet"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='search-index', daemon=True)
+            self._thread.start()
+
+    @property
+    def ready(self):
+        self.start()
+        return self._ready
+
+    def iter_matches(self, query, after='', batch_size=100):
+        """
+        Find entries whose name contains the query, in path order.
+
+        Matches are read from the database in batches as the caller consumes
+        them, so a caller that stops after one page doesn't pay for the rest.
+
+        Args:
+            query (str): Case-insensitive substring of the name
+            after (str): Only yield paths that sort after this one
+            batch_size (int): Number of rows fetched per query
+
+        Returns:
+            generator: {name, path} records like search_files(), or None
+                       while the index is being built
+        """
+        if not self.ready:
+            return None
+        return self._iter_matches(query.lower(), after, batch_size)
+
+    def _iter_matches(self, query, after, batch_size):
+        conn = self._connect()
+        sql, params = self._match_sql(conn, query)
+        while True:
+            rows = conn.execute(f"{sql} AND path > ? ORDER BY path LIMIT ?", params + [after, batch_size]).fetchall()
+            for path, in rows:
+                yield {'name': os.path.basename(path), 'path': path}
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def add(self, relative_path, is_dir=False):
+        """Record that a file or directory was created"""
+        relative_path = normalize_relative_path(relative_path)
+        if not relative_path or is_hidden(relative_path):
+            return
+        self._mark_changed(relative_path)
+        conn = self._connect()
+        with conn:
+            self._insert(conn, relative_path, is_dir)
+
+    def remove(self, relative_path):
+        """Record that a file or directory, and everything below it, was removed"""
+        relative_path = normalize_relative_path(relative_path)
+        if not relative_path:
+            return
+        self._mark_changed(relative_path)
+        conn = self._connect()
+        with conn:
+            self._delete_tree(conn, relative_path)
+
+    def move(self, old_relative_path, new_relative_path):
+        """Record a rename or move of a file or directory"""
+        old_relative_path = normalize_relative_path(old_relative_path)
+        new_relative_path = normalize_relative_path(new_relative_path)
+        self._mark_changed(old_relative_path)
+        self._mark_changed(new_relative_path)
+
+        conn = self._connect()
+        with conn:
+            row = conn.execute("SELECT is_dir FROM entries WHERE path = ?", (old_relative_path,)).fetchone()
+            if is_hidden(new_relative_path) or not row:
+                # Moved out of (or into) view, the subtree has to be dropped or indexed
+                self._delete_tree(conn, old_relative_path)
+                if not is_hidden(new_relative_path):
+                    self.rescan_later(new_relative_path)
+                return
+
+            # Only the moved entry's own name changes, entries below it
+            # keep their names and just get a new path prefix
+            self._delete_tree(conn, old_relative_path, children=False)
+            self._insert(conn, new_relative_path, row[0])
+            if row[0]:
+                where, params = subtree_condition(old_relative_path, children_only=True)
+                conn.execute(
+                    f"UPDATE entries SET path = ? || substr(path, ?) WHERE {where}",
+                    (new_relative_path, len(old_relative_path) + 1) + params
+                )
+
+    def handle_changes(self, events):
+        """Apply a batch of file watcher ChangeEvents"""
+        for event in events:
+            if event.action == 'created':
+                self.add(event.path, event.is_dir)
+                if event.is_dir:
+                    # It may have been moved in with its contents
+                    self.rescan_later(event.path)
+            elif event.action == 'deleted':
+                self.remove(event.path)
+            elif event.action in ('changed', 'rescan'):
+                self.rescan_later(event.path)
+
+    def rescan_later(self, relative_path=''):
+        """Queue a re-index of a subtree on the background thread"""
+        with self._lock:
+            self._pending.add(normalize_relative_path(relative_path))
+        self._wakeup.set()
+
+    def rescan(self, relative_path=''):
+        """Bring the index of a subtree in line with the disk"""
+        relative_path = normalize_relative_path(relative_path)
+        with self._lock:
+            self._scanning = True
+        try:
+            on_disk = {}
+            if relative_path and not is_hidden(relative_path):
+                full_path = os.path.join(self.root, relative_path)
+                if os.path.lexists(full_path):
+                    on_disk[relative_path] = os.path.isdir(full_path) and not os.path.islink(full_path)
+            path = os.path.join(self.root, relative_path) if relative_path else self.root
+            if not relative_path or on_disk.get(relative_path):
+                self._scan(path, relative_path, on_disk)
+
+            conn = self._connect()
+            if relative_path:
+                where, params = subtree_condition(relative_path)
+                rows = conn.execute(f"SELECT path, is_dir FROM entries WHERE {where}", params)
+            else:
+                rows = conn.execute("SELECT path, is_dir FROM entries")
+            indexed = {path: bool(is_dir) for path, is_dir in rows}
+
+            removed = [path for path in indexed if path not in on_disk or on_disk[path] != indexed[path]]
+            added = [path for path in on_disk if path not in indexed or on_disk[path] != indexed[path]]
+            for start in range(0, max(len(removed), len(added)), BATCH_SIZE):
+                batch = [(path, on_disk[path]) for path in added[start:start + BATCH_SIZE]]
+                with conn:
+                    for path in removed[start:start + BATCH_SIZE]:
+                        self._delete_tree(conn, path, children=False)
+                    # A savepoint, so a failed bulk insert doesn't roll back
+                    # the batch's deletes along with it
+                    conn.execute("SAVEPOINT insert_batch")
+                    try:
+                        self._insert_many(conn, batch)
+                    except sqlite3.IntegrityError:
+                        # A route indexed some of these paths in the meantime
+                        conn.execute("ROLLBACK TO insert_batch")
+                        for path, is_dir in batch:
+                            self._insert(conn, path, is_dir)
+                    conn.execute("RELEASE insert_batch")
+        finally:
+            with self._lock:
+                self._scanning = False
+
+    def _run(self):
+        next_rescan = 0
+        while True:
+            if time.time() >= next_rescan:
+                try:
+                    self.rescan()
+                    self.scanned_at = time.time()
+                    self._ready = True
+                except Exception as e:
+                    self.logger.error(f"Error building search index: {e}")
+                next_rescan = time.time() + self.rescan_interval
+
+            # Paths changed while a scan was running, or queued by callers
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            for relative_path in sorted(pending):
+                try:
+                    self.rescan(relative_path)
+                except Exception as e:
+                    self.logger.error(f"Error re-indexing {relative_path}: {e}")
+
+            self._wakeup.wait(max(0, next_rescan - time.time()))
+            self._wakeup.clear()
+
+    def _scan(self, path, relative_dir, found):
+        # Symlinks are indexed but not followed
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    relative_path = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    found[relative_path] = is_dir
+                    if is_dir:
+                        self._scan(entry.path, relative_path, found)
+        except OSError as e:
+            self.logger.warning(f"Cannot index {path}: {e}")
+
+    def _match_sql(self, conn, query):
+        # Candidates come from the postings of the query's rarest trigram,
+        # the substring check then removes the ones that don't match
+        grams = get_trigrams(query)
+        postings = {
+            gram: conn.execute(
+                "SELECT COUNT(*) FROM (SELECT 1 FROM trigrams WHERE gram = ? LIMIT ?)",
+                (gram, POSTINGS_PROBE_LIMIT)
+            ).fetchone()[0]
+            for gram in grams
+        }
+        rarest = min(postings, key=postings.get) if postings else None
+
+        if rarest is None or postings[rarest] >= POSTINGS_PROBE_LIMIT:
+            # Short or very common queries match densely, walking the names
+            # in path order finds a page sooner than sorting all candidates
+            return "SELECT path FROM entries WHERE instr(name_lower, ?) > 0", [query]
+
+        sql = (
+            "SELECT path FROM entries WHERE id IN (SELECT entry_id FROM trigrams WHERE gram = ?) "
+            "AND instr(name_lower, ?) > 0"
+        )
+        return sql, [rarest, query]
+
+    def _insert(self, conn, relative_path, is_dir):
+        name_lower = os.path.basename(relative_path).lower()
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO entries (path, name_lower, is_dir) VALUES (?, ?, ?)",
+            (relative_path, name_lower, int(is_dir))
+        )
+        if cursor.rowcount:
+            conn.executemany(
+                "INSERT OR IGNORE INTO trigrams (gram, entry_id) VALUES (?, ?)",
+                [(gram, cursor.lastrowid) for gram in get_trigrams(name_lower)]
+            )
+        else:
+            # Already indexed, the name and its trigrams are the same
+            conn.execute("UPDATE entries SET is_dir = ? WHERE path = ?", (int(is_dir), relative_path))
+
+    def _insert_many(self, conn, entries):
+        # Bulk version of _insert() for new paths, with ids assigned here so
+        # the trigrams can be written in the same executemany()
+        next_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM entries").fetchone()[0]
+        rows = []
+        postings = []
+        for entry_id, (relative_path, is_dir) in enumerate(entries, next_id):
+            name_lower = os.path.basename(relative_path).lower()
+            rows.append((entry_id, relative_path, name_lower, int(is_dir)))
+            postings.extend((gram, entry_id) for gram in get_trigrams(name_lower))
+        conn.executemany("INSERT INTO entries (id, path, name_lower, is_dir) VALUES (?, ?, ?, ?)", rows)
+        conn.executemany("INSERT OR IGNORE INTO trigrams (gram, entry_id) VALUES (?, ?)", postings)
+
+    def _delete_tree(self, conn, relative_path, children=True):
+        if children:
+            where, params = subtree_condition(relative_path)
+        else:
+            where, params = "path = ?", (relative_path,)
+        conn.execute(f"DELETE FROM trigrams WHERE entry_id IN (SELECT id FROM entries WHERE {where})", params)
+        conn.execute(f"DELETE FROM entries WHERE {where}", params)
+
+    def _mark_changed(self, relative_path):
+        # A scan in progress may or may not have seen this change,
+        # re-index the path once it has finished
+        with self._lock:
+            if self._scanning:
+                self._pending.add(relative_path)
+                self._wakeup.set()
+
+    def _connect(self):
+        # One connection per thread, SQLite connections can't be shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+
+search_index = SearchIndex()
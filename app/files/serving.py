@@ -0,0 +1,514 @@
+import io
+import os
+import uuid
+from datetime import datetime, timezone
+
+from flask import Response, current_app, request
+from werkzeug.http import is_resource_modified, parse_date
+
+from app.files.compression import response_compressor, is_compressible
+from app.files.prefetch import prefetcher, is_media
+
+# More ranges than this in one request are answered with the whole file,
+# which RFC 9110 allows and keeps tiny-range requests from being abused
+MAX_RANGES = 50
+
+
+class FileRange:
+    """
+    Iterator over a byte range of an open file, closing it when done.
+
+    Used as the response body on servers without wsgi.file_wrapper. The file
+    should be opened unbuffered, so every chunk is read straight into the
+    bytes object handed to the server.
+    """
+
+    def __init__(self, file, length, chunk_size=1024*1024):
+        self.file = file
+        self.remaining = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        chunk = self.file.read(min(self.chunk_size, self.remaining))
+        if not chunk:
+            raise StopIteration
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+
+class StreamFile(io.FileIO):
+    """
+    Unbuffered file that ends its download stream when closed.
+
+    WSGI servers close the body they were given, and a body built by
+    file_body() closes its file, so this is the one hook every response
+    path (including sendfile) goes through.
+    """
+
+    def __init__(self, path, stream):
+        super().__init__(path, 'rb')
+        self.stream = stream
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.stream.close()
+
+
+class BufferRange:
+    """Iterator over a byte range of bytes, in chunks"""
+
+    def __init__(self, data, start, stop, chunk_size=1024*1024):
+        self.data = data
+        self.position = start
+        self.stop = stop
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= self.stop:
+            raise StopIteration
+        end = min(self.position + self.chunk_size, self.stop)
+        chunk = self.data[self.position:end]
+        self.position = end
+        return chunk
+
+
+def sendfile_available(stream=None):
+    """Check if a file body for the current request would be sent with sendfile(), see file_body()"""
+    if stream is not None and stream.throttled:
+        return False
+    return request.environ.get('wsgi.file_wrapper') is not None and current_app.config.get('DOWNLOAD_SENDFILE', True)
+
+
+def file_body(file, start, length, stream=None, prefetch=None):
+    """
+    Wrap a byte range of an open file as the body of a WSGI response.
+
+    Servers that provide wsgi.file_wrapper (gunicorn, waitress, uWSGI) get
+    the file positioned at start, so they can send it with os.sendfile()
+    instead of copying it through Python. The response's Content-Length is
+    what limits them to the range, so callers must set it. Other servers,
+    any server with DOWNLOAD_SENDFILE off, and rate limited streams get a
+    FileRange that reads the range in chunks.
+
+    The response must be created with direct_passthrough=True, otherwise
+    Werkzeug wraps the body and the server no longer recognizes it. The
+    body owns the file and closes it.
+
+    Ranges of media streams are tracked by the prefetcher, which reads
+    ahead of sequential ones, see Prefetcher.
+
+    Args:
+        file: File opened unbuffered
+        start (int): Offset of the first byte to send
+        length (int): Number of bytes to send
+        stream (DownloadStream): Download the body is counted and paced for
+        prefetch (tuple): (client, path) of a media stream to read ahead for
+    """
+    file.seek(start)
+    sequential = prefetch is not None and prefetcher.track(prefetch[0], prefetch[1], file, start, length)
+
+    def read_range(chunk_size):
+        if sequential:
+            return prefetcher.reader(file, start, length, chunk_size)
+        return FileRange(file, length, chunk_size)
+
+    if stream is not None and stream.throttled:
+        return stream.paced(read_range(stream.chunk_size))
+
+    chunk_size = current_app.config.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+    if sendfile_available(stream):
+        if stream is not None:
+            stream.expect(length)
+        return request.environ['wsgi.file_wrapper'](file, chunk_size)
+
+    body = read_range(chunk_size)
+    return stream.paced(body) if stream is not None else body
+
+
+def make_etag(stat, variant=''):
+    """
+    Build a strong entity tag for a file version.
+
+    The inode, size and mtime change whenever the content does, so the tag
+    can be trusted for If-Range without hashing the file. Representations
+    derived from the file, like thumbnails, pass a variant.
+    """
+    etag = f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+    return f"{etag}-{variant}" if variant else etag
+
+
+def file_last_modified(stat):
+    """Last-Modified date of a file, at the one second precision of HTTP dates"""
+    return datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+
+
+def parse_byte_ranges(header, size):
+    """
+    Parse a Range header against a representation of the given size.
+
+    Suffix ranges (bytes=-500) and open ranges (bytes=500-) are resolved,
+    ranges past the end are dropped and overlapping or adjacent ranges are
+    merged.
+
+    Returns:
+        list: Sorted (start, stop) pairs with stop exclusive, empty if no
+              range can be satisfied, or None if the header is malformed or
+              should be ignored
+    """
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for item in spec.split(','):
+        first, dash, last = item.strip().partition('-')
+        if not dash or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            start, stop = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            stop = int(last) + 1 if last else size
+        stop = min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def get_requested_ranges(size, etag, last_modified):
+    """
+    Get the ranges to serve for the current request.
+
+    A Range header is only honored for GET, and only if an If-Range
+    validator, when sent, still matches (a strong ETag, or the exact
+    Last-Modified date). Otherwise the client would splice bytes of a newer
+    file version into its copy of an older one.
+
+    Returns:
+        list: (start, stop) pairs, empty if unsatisfiable, or None to send
+              the whole representation
+    """
+    header = request.headers.get('Range')
+    if not header or request.method not in ('GET', 'HEAD'):
+        return None
+
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            if if_range != f'"{etag}"':
+                return None
+        else:
+            date = parse_date(if_range)
+            if date is None or int(date.timestamp()) != int(last_modified.timestamp()):
+                return None
+
+    return parse_byte_ranges(header, size)
+
+
+def not_modified_response(etag, last_modified):
+    """
+    Answer If-None-Match and If-Modified-Since.
+
+    Checked before producing the representation, so a revalidation doesn't
+    open the file or render a thumbnail.
+
+    Returns:
+        Response: A 304 response if the client's copy is current, else None
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    response = Response(status=304)
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified, max_age=None):
+    """Set the ETag, Last-Modified and Cache-Control headers of a response"""
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    # Files are private to the logged-in user. Without a max_age clients
+    # keep them but revalidate on every use, which costs a 304.
+    response.cache_control.private = True
+    if max_age is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.max_age = max_age
+
+
+def multipart_ranges(ranges, size, mimetype, read):
+    """
+    Build a multipart/byteranges body.
+
+    Args:
+        ranges (list): (start, stop) pairs
+        size (int): Size of the complete representation
+        mimetype (str): Content type of the parts
+        read (callable): read(start, stop) yields the bytes of a range
+
+    Returns:
+        tuple: (body iterator, Content-Type, Content-Length)
+    """
+    boundary = uuid.uuid4().hex
+    heads = [
+        (f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode('latin-1')
+        for start, stop in ranges
+    ]
+    tail = f"\r\n--{boundary}--\r\n".encode('latin-1')
+    length = sum(len(head) for head in heads) + sum(stop - start for start, stop in ranges) + len(tail)
+
+    def generate():
+        for head, (start, stop) in zip(heads, ranges):
+            yield head
+            yield from read(start, stop)
+        yield tail
+
+    return generate(), f'multipart/byteranges; boundary={boundary}', length
+
+
+def range_not_satisfiable(size):
+    """416 response telling the client the size of the representation"""
+    response = Response(status=416)
+    response.headers['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+def open_file(file_path, stream=None):
+    """Open a file unbuffered, as one that ends the download stream when closed if given"""
+    return StreamFile(file_path, stream) if stream is not None else open(file_path, 'rb', buffering=0)
+
+
+def serve_file(file_path, mimetype, max_age=None, stream=None, compress=False, client=None):
+    """
+    Serve a file with validators, conditional requests and byte ranges.
+
+    A single range (or the whole file) is sent through wsgi.file_wrapper,
+    see file_body(). Several ranges are sent as multipart/byteranges.
+
+    Args:
+        file_path (str): Path to the file
+        mimetype (str): Content type of the file
+        max_age (int): Seconds clients may use the file without revalidating
+        stream (DownloadStream): Download the body is counted and paced
+                                 for, closed together with the file
+        compress (bool): Whether text files may be sent compressed, see
+                         serve_compressed()
+        client (hashable): Who downloads the file, to read ahead of the
+                           ranges they play if it is video or audio
+
+    Returns:
+        Response: 200, 206, 304 or 416 response
+
+    Raises:
+        OSError: If the file cannot be opened
+    """
+    if compress and is_compressible(mimetype):
+        response = serve_compressed(file_path, mimetype, max_age, stream)
+        if response is not None:
+            return response
+
+    file = open_file(file_path, stream)
+    try:
+        stat = os.fstat(file.fileno())
+    except BaseException:
+        file.close()
+        raise
+    prefetch = (client, file_path) if client is not None and is_media(mimetype) else None
+    return serve_open_file(file, stat.st_size, mimetype, make_etag(stat), file_last_modified(stat),
+                           max_age, stream, prefetch)
+
+
+def serve_open_file(file, size, mimetype, etag, last_modified, max_age=None, stream=None, prefetch=None):
+    """Serve an open file as the representation with the given validators, closing it when done"""
+    try:
+        response = not_modified_response(etag, last_modified)
+        if response is not None:
+            file.close()
+            return response
+
+        ranges = get_requested_ranges(size, etag, last_modified)
+        if ranges == []:
+            file.close()
+            return range_not_satisfiable(size)
+
+        if ranges is None or len(ranges) == 1:
+            start, stop = ranges[0] if ranges else (0, size)
+            response = Response(file_body(file, start, stop - start, stream, prefetch), mimetype=mimetype,
+                                status=206 if ranges else 200, direct_passthrough=True)
+            response.content_length = stop - start
+            if ranges:
+                response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        else:
+            chunk_size = current_app.config.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+            if stream is not None and stream.throttled:
+                chunk_size = stream.chunk_size
+
+            def read(start, stop):
+                file.seek(start)
+                yield from FileRange(file, stop - start, chunk_size)
+
+            body, content_type, length = multipart_ranges(ranges, size, mimetype, read)
+            if stream is not None:
+                body = stream.paced(body)
+            response = Response(body, status=206, content_type=content_type)
+            response.content_length = length
+            response.call_on_close(file.close)
+    except BaseException:
+        file.close()
+        raise
+
+    set_validators(response, etag, last_modified, max_age)
+    return response
+
+
+def serve_compressed(file_path, mimetype, max_age=None, stream=None):
+    """
+    Serve a text file compressed, if the client accepts an encoding.
+
+    The compressed representation has its own ETag. A cached variant (see
+    ResponseCompressor) is sent like a file of its own, ranges included.
+    Otherwise the file is compressed as it is sent, and since the size of
+    that isn't known up front, Range requests get the uncompressed file.
+
+    Returns:
+        Response: 200, 206, 304 or 416 response, or None to serve the file
+                  uncompressed
+    """
+    encoding = response_compressor.negotiate()
+    if encoding is None:
+        return None
+    stat = os.stat(file_path)
+    if stat.st_size < response_compressor.min_size:
+        return None
+    etag = make_etag(stat, encoding)
+    last_modified = file_last_modified(stat)
+
+    cached_path = response_compressor.get_cached(stat, encoding)
+    if cached_path is not None:
+        try:
+            file = open_file(cached_path, stream)
+        except OSError:
+            # Evicted in the meantime
+            file = None
+        if file is not None:
+            response = serve_open_file(file, os.fstat(file.fileno()).st_size, mimetype,
+                                       etag, last_modified, max_age, stream)
+            if response.status_code in (200, 206):
+                response.headers['Content-Encoding'] = encoding
+            return response
+
+    if request.headers.get('Range'):
+        return None
+
+    response = not_modified_response(etag, last_modified)
+    if response is not None:
+        if stream is not None:
+            stream.close()
+        return response
+
+    file = open_file(file_path, stream)
+    try:
+        chunk_size = current_app.config.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+        if stream is not None and stream.throttled:
+            chunk_size = stream.chunk_size
+        body = response_compressor.compress_file(FileRange(file, stat.st_size, chunk_size), file, stat, encoding)
+    except BaseException:
+        file.close()
+        raise
+    if stream is not None:
+        body = stream.paced(body)
+
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Encoding'] = encoding
+    set_validators(response, etag, last_modified, max_age)
+    return response
+
+
+def buffer_body(data, start, stop, stream=None):
+    """
+    Body of a byte range of bytes, counted and paced for stream.
+
+    Unpaced bytes are sent in one piece, paced ones in chunks.
+    """
+    if stream is None:
+        return data[start:stop]
+    chunk_size = current_app.config.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+    if stream is not None and stream.throttled:
+        chunk_size = stream.chunk_size
+    body = BufferRange(data, start, stop, chunk_size)
+    return stream.paced(body) if stream is not None else body
+
+
+def serve_data(data, mimetype, etag, last_modified, max_age=None, stream=None):
+    """
+    Serve generated or cached content, like a thumbnail, the way serve_file() does.
+
+    Args:
+        data (bytes): The representation
+        mimetype (str): Its content type
+        etag (str): Strong entity tag of the representation
+        last_modified (datetime): When its source last changed
+        max_age (int): Seconds clients may use it without revalidating
+        stream (DownloadStream): Download the body is counted and paced
+                                 for, closed together with the response
+
+    Returns:
+        Response: 200, 206, 304 or 416 response
+    """
+    size = len(data)
+    ranges = None
+    response = not_modified_response(etag, last_modified)
+    if response is None:
+        ranges = get_requested_ranges(size, etag, last_modified)
+        if ranges == []:
+            response = range_not_satisfiable(size)
+    if response is not None:
+        if stream is not None:
+            stream.close()
+        return response
+
+    if ranges is None or len(ranges) == 1:
+        start, stop = ranges[0] if ranges else (0, size)
+        response = Response(buffer_body(data, start, stop, stream), mimetype=mimetype,
+                            status=206 if ranges else 200)
+        response.content_length = stop - start
+        if ranges:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    else:
+        body, content_type, length = multipart_ranges(ranges, size, mimetype, lambda start, stop: (data[start:stop],))
+        if stream is not None:
+            body = stream.paced(body)
+        response = Response(body, status=206, content_type=content_type)
+        response.content_length = length
+    if stream is not None:
+        response.call_on_close(stream.close)
+
+    set_validators(response, etag, last_modified, max_age)
+    return response
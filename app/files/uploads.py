@@ -0,0 +1,711 @@
+import errno
+import hashlib
+import logging
+import os
+import re
+import secrets
+import struct
+import threading
+import time
+from datetime import timedelta
+
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
+
+from app import db
+from app.auth.models import UploadSession, get_utc_now
+from app.files.utils import sanitize_path
+
+# Bytes read from the request body per write
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+# Seconds between sweeps for expired uploads
+GARBAGE_COLLECT_INTERVAL = 600
+
+# Seconds between walks of STORAGE_PATH for upload files no upload owns
+ORPHAN_SWEEP_INTERVAL = 6 * 3600
+
+# Hidden files of uploads: partial files and chunk maps of resumable
+# uploads (named after their token), temporary files of form uploads
+UPLOAD_FILE_RE = re.compile(r'\.upload-(.+)\.(part|chunks|tmp)')
+
+# Header of the chunk map: the upload's chunk size
+CHUNK_MAP_HEADER = struct.Struct('>Q')
+
+# Largest form field accepted next to a streamed file
+MAX_FIELD_SIZE = 64 * 1024
+
+# Bytes of a resumable upload still to hash when it is completed, above
+# which hashing is left to the background hasher
+MAX_FINISH_HASH = 64 * 1024 * 1024
+
+# Errors of a full disk
+NO_SPACE = (errno.ENOSPC, errno.EDQUOT)
+
+# Errors of filesystems that can't preallocate (FAT, sdcardfs, FUSE mounts)
+PREALLOCATE_UNSUPPORTED = (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS)
+
+
+class UploadError(Exception):
+    """An upload request that can't be applied, with the HTTP status to answer"""
+
+    def __init__(self, message, status, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class ReceivedFile:
+    """The file part of a streamed form, saved to a temporary file"""
+
+    def __init__(self, filename, path, declared_size=0):
+        self.filename = filename
+        self.path = path
+        self.declared_size = declared_size  # bytes admitted for it, 0 if unknown
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    @property
+    def sha256(self):
+        return self.hash.hexdigest()
+
+    def discard(self):
+        """Delete the temporary file"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class UploadHash:
+    """SHA-256 of a resumable upload, hashed from the start as far as its chunks arrived"""
+
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.offset = 0
+        self.lock = threading.Lock()
+
+
+class ChunkMap:
+    """Which chunks of an upload were received"""
+
+    def __init__(self, chunk_size, received):
+        self.chunk_size = chunk_size
+        self.received = received  # one byte per chunk, 1 once it was received
+
+    @property
+    def complete(self):
+        return 0 not in self.received
+
+    def offset(self, size):
+        """Bytes received from the start of the file without a gap"""
+        first_missing = self.received.find(0)
+        if first_missing == -1:
+            return size
+        return first_missing * self.chunk_size
+
+    def received_bytes(self, size):
+        """Bytes received in all chunks"""
+        count = self.received.count(1)
+        if count and self.received[-1]:
+            # The last chunk is usually shorter
+            return (count - 1) * self.chunk_size + (size - (len(self.received) - 1) * self.chunk_size)
+        return count * self.chunk_size
+
+    def encode(self):
+        """The map as a string of '0' and '1', one per chunk"""
+        return self.received.translate(bytes.maketrans(b'\x00\x01', b'01')).decode('ascii')
+
+
+class UploadManager:
+    """
+    Resumable uploads for files too large to send in one request.
+
+    Follows the tus protocol in spirit. The client creates an upload and
+    gets its chunk size. It sends the file as PATCH requests, each starting
+    at a chunk boundary, in any order and several at once. After a dropped
+    connection it asks which chunks arrived (HEAD or GET) and sends the
+    rest, then asks for the upload to be completed.
+
+    Bytes go straight into a hidden partial file in the target directory,
+    preallocated to the full size and written with pwrite() at each chunk's
+    offset. Nothing is spooled to a temporary file first, and finishing is
+    an atomic rename on the same filesystem. A chunk is marked as received
+    in the upload's chunk map once all of its bytes are written. The chunk
+    map is a hidden file next to it, the chunk size followed by one byte per
+    chunk, so the state is shared by all worker processes and survives
+    restarts. Completing checks that every chunk arrived.
+
+    The upload is hashed with SHA-256 as its chunks arrive: the process
+    that receives the first chunk hashes on after each write, as far as
+    the chunks received go without a gap, reading them back while they are
+    still in the page cache. Completing only hashes what is left, up to
+    MAX_FINISH_HASH bytes.
+
+    Uploads nobody wrote to for UPLOAD_EXPIRY seconds are removed, along
+    with their files, by a background thread. It also deletes upload files
+    older than that which no upload owns, left by a crash.
+
+    Uploads are admitted only if their size fits in the free space of the
+    disk, less UPLOAD_DISK_RESERVE bytes kept free and the bytes other
+    uploads still have to write, and are rejected with 507 otherwise. The
+    space is then reserved with posix_fallocate(), which also keeps the
+    file in few extents on SD cards. Preallocated space is already gone
+    from the free space every worker process sees, so concurrent uploads
+    can't promise the same bytes twice. Where the filesystem can't
+    preallocate, files are sparse and the bytes still to come are counted
+    from the resumable uploads' table and, for form uploads, per process.
+    """
+
+    def __init__(self, chunk_size=8 * 1024 * 1024, expiry=86400, disk_reserve=256 * 1024 * 1024):
+        self.app = None
+        self.root = None
+        self.chunk_size = chunk_size
+        self.expiry = expiry
+        self.disk_reserve = disk_reserve
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._admission_lock = threading.Lock()
+        self._receiving = set()  # ReceivedFiles of this process without preallocated space
+        self._hashes = {}  # token -> UploadHash of uploads whose first chunk this process received
+        self._collected_at = 0
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.root = app.config['STORAGE_PATH']
+        self.chunk_size = app.config.get('UPLOAD_CHUNK_SIZE', self.chunk_size)
+        self.expiry = app.config.get('UPLOAD_EXPIRY', self.expiry)
+        self.disk_reserve = app.config.get('UPLOAD_DISK_RESERVE', self.disk_reserve)
+        self.logger = app.logger
+        app.extensions['upload_manager'] = self
+
+    def start(self):
+        """Start the background garbage collector if it isn't running yet"""
+        with self._lock:
+            if self._thread is not None or self.app is None:
+                return
+            self._thread = threading.Thread(target=self._run, name='upload-gc', daemon=True)
+            self._thread.start()
+
+    def partial_path(self, upload):
+        """Get the path of the file an upload is received into"""
+        return os.path.join(self.root, upload.target_dir, f'.upload-{upload.token}.part')
+
+    def chunk_map_path(self, upload):
+        """Get the path of the upload's chunk map"""
+        return os.path.join(self.root, upload.target_dir, f'.upload-{upload.token}.chunks')
+
+    def final_path(self, upload):
+        """Get the path the finished upload is saved to"""
+        return os.path.join(self.root, upload.target_dir, upload.filename)
+
+    def create(self, user_id, target_dir, filename, size, fingerprint=None):
+        """
+        Start an upload, or pick up an unfinished one of the same file.
+
+        Args:
+            user_id (int): Who uploads it
+            target_dir (str): Directory relative to STORAGE_PATH
+            filename (str): Name of the file in that directory
+            size (int): Total size of the file in bytes
+            fingerprint (str): Set by the client to recognize the file, so
+                an upload interrupted by a page reload can be resumed
+
+        Returns:
+            UploadSession: The upload
+
+        Raises:
+            UploadError: If there isn't enough free space for it
+        """
+        self.collect_garbage()
+
+        if fingerprint:
+            upload = UploadSession.query.filter_by(
+                user_id=user_id, target_dir=target_dir, filename=filename,
+                size=size, fingerprint=fingerprint
+            ).first()
+            if upload is not None and self.get_chunk_map(upload) is not None:
+                return upload
+
+        upload = UploadSession(
+            token=secrets.token_urlsafe(24), user_id=user_id, target_dir=target_dir,
+            filename=filename, size=size, fingerprint=fingerprint
+        )
+        # Create the files before the row, so a row never points to a
+        # directory they can't be created in
+        chunks = -(-size // self.chunk_size)
+        partial_path = self.partial_path(upload)
+        with open(partial_path, 'xb') as f:
+            try:
+                if not self._reserve(f.fileno(), os.path.dirname(partial_path), size):
+                    f.truncate(size)
+            except BaseException:
+                f.close()
+                os.remove(partial_path)
+                raise
+        with open(self.chunk_map_path(upload), 'xb') as f:
+            f.write(CHUNK_MAP_HEADER.pack(self.chunk_size) + bytes(chunks))
+        db.session.add(upload)
+        db.session.commit()
+        return upload
+
+    def get(self, token, user_id):
+        """Get an upload of a user, or None if it doesn't exist (any more)"""
+        upload = UploadSession.query.filter_by(token=token, user_id=user_id).first()
+        if upload is None:
+            return None
+        if not os.path.isfile(self.partial_path(upload)) or self.get_chunk_map(upload) is None:
+            # Its directory was deleted or renamed
+            self.remove(upload)
+            return None
+        return upload
+
+    def get_chunk_map(self, upload):
+        """Get the chunks received so far, None if the chunk map is gone"""
+        try:
+            with open(self.chunk_map_path(upload), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < CHUNK_MAP_HEADER.size:
+            return None
+        chunk_size, = CHUNK_MAP_HEADER.unpack_from(data)
+        return ChunkMap(chunk_size, data[CHUNK_MAP_HEADER.size:])
+
+    def write(self, upload, offset, stream, length):
+        """
+        Write a request body to an upload.
+
+        The body starts at a chunk boundary and may span several chunks.
+        Chunks are marked as received as soon as they are written whole, so
+        those that arrived before a dropped connection are kept.
+
+        Args:
+            upload (UploadSession): The upload
+            offset (int): Offset the client sends the body from
+            stream: The request body
+            length (int): Length of the request body
+
+        Returns:
+            int: Number of bytes written
+
+        Raises:
+            UploadError: If the upload is gone, the offset isn't at a chunk
+                boundary, the body runs past the declared size or the disk
+                is full
+        """
+        chunk_map = self.get_chunk_map(upload)
+        if chunk_map is None:
+            # Completed, cancelled or expired since it was looked up
+            raise UploadError('Upload not found', 404)
+        chunk_size = chunk_map.chunk_size
+        if offset < 0 or offset % chunk_size or (offset >= upload.size and length):
+            raise UploadError('Offset is not at a chunk boundary', 409, chunk_map.offset(upload.size))
+        if offset + length > upload.size:
+            raise UploadError('Upload exceeds its declared size', 413)
+
+        if offset == 0 and length:
+            with self._lock:
+                self._hashes.setdefault(upload.token, UploadHash())
+
+        fd = os.open(self.partial_path(upload), os.O_WRONLY)
+        map_fd = os.open(self.chunk_map_path(upload), os.O_WRONLY)
+        chunks = len(chunk_map.received)
+        next_chunk = offset // chunk_size  # first chunk not marked yet
+        position = offset
+        end = offset + length
+        try:
+            while position < end:
+                data = stream.read(min(WRITE_CHUNK_SIZE, end - position))
+                if not data:
+                    break
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(fd, view, position)
+                    view = view[written:]
+                    position += written
+                    # Mark the chunks written whole
+                    while next_chunk < chunks and min((next_chunk + 1) * chunk_size, upload.size) <= position:
+                        os.pwrite(map_fd, b'\x01', CHUNK_MAP_HEADER.size + next_chunk)
+                        next_chunk += 1
+        except OSError as e:
+            if e.errno not in NO_SPACE:
+                raise
+            # Only where the file couldn't be preallocated. The chunks
+            # written so far are kept for when space is freed.
+            raise UploadError('Not enough free space', 507, chunk_map.offset(upload.size)) from e
+        finally:
+            os.close(map_fd)
+            os.close(fd)
+            upload.updated_at = get_utc_now()
+            db.session.commit()
+
+        # Another request hashing this upload takes these chunks with it
+        self._hash_received(upload, wait=False)
+        return position - offset
+
+    def received_hash(self, upload):
+        """
+        Get the SHA-256 of a completely received upload, hashing what is left.
+
+        Call it before finish(), the hash is dropped once it is returned.
+
+        Returns:
+            str: Hex digest, or None if the upload wasn't hashed while it
+                 was received (its first chunk went to another process, or
+                 more than MAX_FINISH_HASH bytes are left to hash)
+        """
+        if not self._hash_received(upload, wait=True, limit=MAX_FINISH_HASH):
+            return None
+        with self._lock:
+            state = self._hashes.pop(upload.token, None)
+        return state.hash.hexdigest() if state is not None else None
+
+    def finish(self, upload):
+        """
+        Move a completely received upload to its final path.
+
+        Returns:
+            str: The final path
+
+        Raises:
+            UploadError: If the upload is gone or chunks are missing
+        """
+        chunk_map = self.get_chunk_map(upload)
+        if chunk_map is None:
+            raise UploadError('Upload not found', 404)
+        if not chunk_map.complete:
+            raise UploadError('Chunks are missing', 409, chunk_map.offset(upload.size))
+
+        partial_path = self.partial_path(upload)
+        final_path = self.final_path(upload)
+        with open(partial_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != upload.size:
+                raise UploadError('Upload has the wrong size', 409)
+            os.fsync(f.fileno())
+        try:
+            os.replace(partial_path, final_path)
+        except FileNotFoundError:
+            # Completed by a concurrent request
+            raise UploadError('Upload not found', 404)
+        self._remove_chunk_map(upload)
+        db.session.delete(upload)
+        db.session.commit()
+        return final_path
+
+    def remove(self, upload):
+        """Cancel an upload, deleting what was received"""
+        with self._lock:
+            self._hashes.pop(upload.token, None)
+        try:
+            os.remove(self.partial_path(upload))
+        except OSError:
+            pass
+        self._remove_chunk_map(upload)
+        db.session.delete(upload)
+        db.session.commit()
+
+    def receive_form(self, stream, boundary, target_dir='', length=None):
+        """
+        Parse a multipart/form-data upload as it arrives, saving its file.
+
+        Werkzeug's form parser spools files to the system temp directory,
+        often another filesystem on Termux, and saving them copies every
+        byte again. Here the first file part goes straight into a hidden
+        temporary file in its target directory (taken from a 'path' field
+        sent before the file, else from target_dir), or in STORAGE_PATH if
+        that doesn't exist or resolves to outside of it, so moving it into
+        place is a rename. It is
+        hashed with SHA-256 on the way, and only the buffers being parsed
+        are held in memory. Space for the whole body is admitted and
+        preallocated before the file is written, and given back once it
+        ends.
+
+        Args:
+            stream: The request body
+            boundary (bytes): Boundary from the Content-Type header
+            target_dir (str): Directory relative to STORAGE_PATH to write
+                to if no 'path' field comes before the file
+            length (int): Length of the request body, None if unknown
+
+        Returns:
+            tuple: (dict of form fields, ReceivedFile or None if there was
+                   no file part)
+
+        Raises:
+            UploadError: If the body isn't a valid form, a field is too
+                large or there isn't enough free space for it
+        """
+        decoder = MultipartDecoder(boundary)
+        fields = {}
+        received = None
+        output = None  # file the file part is written to while it is read
+        field = None  # (name, bytearray) of the field being read
+        try:
+            while True:
+                event = decoder.next_event()
+                if isinstance(event, NeedData):
+                    if decoder.complete:
+                        raise UploadError('Incomplete form data', 400)
+                    decoder.receive_data(stream.read(WRITE_CHUNK_SIZE) or None)
+                elif isinstance(event, Epilogue):
+                    break
+                elif isinstance(event, Field):
+                    field = (event.name, bytearray())
+                elif isinstance(event, File):
+                    field = None
+                    if received is None:
+                        received, output = self._open_received(
+                            event.filename, sanitize_path(fields.get('path', target_dir)), length or 0)
+                elif isinstance(event, Data):
+                    if field is not None:
+                        field[1].extend(event.data)
+                        if len(field[1]) > MAX_FIELD_SIZE:
+                            raise UploadError('Form field too large', 413)
+                        if not event.more_data:
+                            fields[field[0]] = field[1].decode('utf-8', 'replace')
+                            field = None
+                    elif output is not None:
+                        output.write(event.data)
+                        received.hash.update(event.data)
+                        received.size += len(event.data)
+                        if not event.more_data:
+                            # Give back the space preallocated past the file
+                            output.truncate()
+                            output.close()
+                            output = None
+        except ValueError as e:
+            self._discard(received, output)
+            raise UploadError(f'Invalid form data: {e}', 400) from e
+        except OSError as e:
+            self._discard(received, output)
+            if e.errno not in NO_SPACE:
+                raise
+            raise UploadError('Not enough free space', 507) from e
+        except BaseException:
+            self._discard(received, output)
+            raise
+        finally:
+            self._receiving.discard(received)
+        return fields, received
+
+    def free_space(self, directory):
+        """Get the bytes available to uploads in a directory's filesystem, None if unknown"""
+        try:
+            stat = os.statvfs(directory)
+        except (AttributeError, OSError):
+            # statvfs not available or path not accessible
+            return None
+        return stat.f_bavail * stat.f_frsize
+
+    def pending_bytes(self):
+        """Get the bytes admitted uploads still have to write and haven't preallocated"""
+        pending = 0
+        # Expired uploads are about to be removed, their files don't count
+        cutoff = get_utc_now() - timedelta(seconds=self.expiry)
+        for upload in UploadSession.query.filter(UploadSession.updated_at >= cutoff).all():
+            try:
+                allocated = os.stat(self.partial_path(upload)).st_blocks * 512
+            except (AttributeError, OSError):
+                continue
+            pending += max(upload.size - allocated, 0)
+        for received in list(self._receiving):
+            pending += max(received.declared_size - received.size, 0)
+        return pending
+
+    def admit(self, directory, size):
+        """
+        Check that an upload fits on the disk next to the uploads in flight.
+
+        Args:
+            directory (str): Full path of the directory it is written to
+            size (int): Bytes it will write, 0 to only check that the disk
+                isn't already filled up to the reserve
+
+        Raises:
+            UploadError: With status 507 if it doesn't fit
+        """
+        # Abandoned uploads give back their preallocated space first
+        self.collect_garbage()
+        free = self.free_space(directory)
+        if free is None:
+            return
+        available = free - self.disk_reserve - self.pending_bytes()
+        if size > available or available < 0:
+            self.logger.info("Rejecting upload of %d bytes, %d bytes available", size, max(available, 0))
+            raise UploadError('Not enough free space', 507)
+
+    def collect_garbage(self, force=False):
+        """Remove uploads nobody wrote to for UPLOAD_EXPIRY seconds"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._collected_at < GARBAGE_COLLECT_INTERVAL:
+                return 0
+            self._collected_at = now
+
+        cutoff = get_utc_now() - timedelta(seconds=self.expiry)
+        expired = UploadSession.query.filter(UploadSession.updated_at < cutoff).all()
+        for upload in expired:
+            self.logger.info("Removing expired upload of %s", os.path.join(upload.target_dir, upload.filename))
+            self.remove(upload)
+
+        # Hashes of uploads finished or removed by other processes
+        with self._lock:
+            tokens = list(self._hashes)
+        if tokens:
+            live = set(db.session.execute(
+                db.select(UploadSession.token).where(UploadSession.token.in_(tokens))).scalars())
+            with self._lock:
+                for token in tokens:
+                    if token not in live:
+                        self._hashes.pop(token, None)
+        return len(expired)
+
+    def remove_orphans(self):
+        """
+        Delete hidden upload files older than UPLOAD_EXPIRY that no upload owns.
+
+        Returns:
+            int: Number of files deleted
+        """
+        cutoff = time.time() - self.expiry
+        tokens = set(db.session.execute(db.select(UploadSession.token)).scalars())
+        removed = 0
+        for directory, _, filenames in os.walk(self.root):
+            for name in filenames:
+                match = UPLOAD_FILE_RE.fullmatch(name)
+                if match is None or match.group(1) in tokens:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if os.lstat(path).st_mtime >= cutoff:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.logger.info("Removing abandoned upload file %s", path)
+                removed += 1
+        return removed
+
+    def _run(self):
+        with self.app.app_context():
+            next_sweep = 0
+            while True:
+                try:
+                    self.collect_garbage(force=True)
+                    if time.time() >= next_sweep:
+                        self.remove_orphans()
+                        next_sweep = time.time() + ORPHAN_SWEEP_INTERVAL
+                except Exception as e:
+                    db.session.rollback()
+                    self.logger.error(f"Error collecting uploads: {e}")
+                finally:
+                    db.session.remove()
+                time.sleep(GARBAGE_COLLECT_INTERVAL)
+
+    def _open_received(self, filename, target_dir, length):
+        # Returns (ReceivedFile, open file). Not mkstemp(), the file keeps
+        # the permissions set by the umask like any other saved upload.
+        directory = os.path.join(self.root, target_dir)
+        if not os.path.isdir(directory) or not self._is_within_root(directory):
+            directory = self.root
+        path = os.path.join(directory, f'.upload-{secrets.token_hex(12)}.tmp')
+        received = ReceivedFile(filename, path, length)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            if not self._reserve(fd, directory, length):
+                self._receiving.add(received)
+        except BaseException:
+            os.close(fd)
+            received.discard()
+            raise
+        return received, os.fdopen(fd, 'wb')
+
+    def _reserve(self, fd, directory, size):
+        # Admits an upload and preallocates its file. Returns False if the
+        # filesystem can't preallocate, the caller removes the file on errors.
+        # Only in STORAGE_PATH: space is never checked or taken on another
+        # filesystem picked by the client (symlinks placed in it are fine).
+        if not self._is_within_root(directory, resolve=False):
+            raise UploadError('Invalid path', 400)
+        with self._admission_lock:
+            self.admit(directory, size)
+            if not self._preallocate(fd, size):
+                return False
+            # Another worker process may have been admitted at the same
+            # time. Both see each other's space taken now, so at worst both
+            # give up rather than eating into the reserve.
+            free = self.free_space(directory)
+            if free is not None and free - self.pending_bytes() < self.disk_reserve:
+                raise UploadError('Not enough free space', 507)
+        return True
+
+    def _preallocate(self, fd, size):
+        # Returns False if the filesystem can't preallocate
+        if not size or not hasattr(os, 'posix_fallocate'):
+            return False
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno in NO_SPACE:
+                raise UploadError('Not enough free space', 507) from e
+            if e.errno in PREALLOCATE_UNSUPPORTED:
+                return False
+            raise
+        return True
+
+    def _hash_received(self, upload, wait, limit=None):
+        # Hashes the upload on as far as its chunks arrived without a gap.
+        # Returns True once all of it is hashed. Without wait it leaves the
+        # chunks to a request already hashing, with a limit it gives up if
+        # more bytes than that are left.
+        with self._lock:
+            state = self._hashes.get(upload.token)
+        if state is None or not state.lock.acquire(blocking=wait):
+            return False
+        try:
+            chunk_map = self.get_chunk_map(upload)
+            if chunk_map is None:
+                return False
+            end = chunk_map.offset(upload.size)
+            if limit is not None and end - state.offset > limit:
+                return False
+            if end > state.offset:
+                with open(self.partial_path(upload), 'rb') as f:
+                    f.seek(state.offset)
+                    while state.offset < end:
+                        data = f.read(min(WRITE_CHUNK_SIZE, end - state.offset))
+                        if not data:
+                            break
+                        state.hash.update(data)
+                        state.offset += len(data)
+            return state.offset == upload.size
+        except OSError:
+            return False
+        finally:
+            state.lock.release()
+
+    def _is_within_root(self, path, resolve=True):
+        # The form is parsed before the route checks its fields, so the
+        # directory is resolved here and must stay under STORAGE_PATH
+        if resolve:
+            root, path = os.path.realpath(self.root), os.path.realpath(path)
+        else:
+            root, path = os.path.abspath(self.root), os.path.abspath(path)
+        return path == root or path.startswith(root + os.sep)
+
+    def _discard(self, received, output):
+        if output is not None:
+            output.close()
+        if received is not None:
+            received.discard()
+
+    def _remove_chunk_map(self, upload):
+        try:
+            os.remove(self.chunk_map_path(upload))
+        except OSError:
+            pass
+
+
+upload_manager = UploadManager()
@@ -0,0 +1,336 @@
+import logging
+import os
+import threading
+import time
+
+
+def normalize_relative_path(path):
+    """Normalize a path relative to STORAGE_PATH, '' being the root"""
+    path = os.path.normpath(path) if path else ''
+    return '' if path == '.' else path
+
+
+def is_hidden(relative_path):
+    """Check whether a path or any directory above it is a dotfile"""
+    return any(part.startswith('.') for part in relative_path.split('/'))
+
+
+class StorageUsageTracker:
+    """
+    Background aggregator of storage usage under STORAGE_PATH.
+
+    Keeps recursive size and file-count totals for every directory, keyed by
+    its path relative to STORAGE_PATH ('' is the root). The totals are built
+    once by a full scan on a background thread and then kept current by the
+    routes that upload, delete, rename or create files, and by the file
+    watcher for changes made outside the web UI. A periodic full scan
+    reconciles anything both missed.
+    """
+
+    def __init__(self, reconcile_interval=3600):
+        self.root = None
+        self.reconcile_interval = reconcile_interval
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._dirs = {}  # relative dir -> [size, files], recursive totals
+        self._ready = False
+        self._scanning = False
+        self._pending = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # Time of the last completed full scan
+        self.reconciled_at = None
+        # Bumped on every change, so callers can tell when totals moved
+        self.generation = 0
+
+    def init_app(self, app):
+        self.root = app.config['STORAGE_PATH']
+        self.reconcile_interval = app.config.get('USAGE_RECONCILE_INTERVAL', self.reconcile_interval)
+        self.logger = app.logger
+        app.extensions['storage_usage'] = self
+
+    def start(self):
+        """Start the background scanner if it isn't running yet"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='storage-usage', daemon=True)
+            self._thread.start()
+
+    def get_totals(self, relative_dir=''):
+        """
+        Get the recursive usage of a directory.
+
+        Returns:
+            tuple: (size, files), or None while the first scan is running
+                   or if the directory is unknown
+        """
+        self.start()
+        relative_dir = normalize_relative_path(relative_dir)
+        with self._lock:
+            if not self._ready:
+                return None
+            totals = self._dirs.get(relative_dir)
+            return (totals[0], totals[1]) if totals else None
+
+    def get_many(self, relative_dirs):
+        """
+        Get the recursive usage of several directories with one lock round-trip.
+
+        Returns:
+            dict: relative dir -> (size, files) for the directories that are known
+        """
+        self.start()
+        result = {}
+        with self._lock:
+            if not self._ready:
+                return result
+            for relative_dir in relative_dirs:
+                totals = self._dirs.get(normalize_relative_path(relative_dir))
+                if totals:
+                    result[relative_dir] = (totals[0], totals[1])
+        return result
+
+    def get_age(self):
+        """Seconds since the totals were last reconciled with a full scan"""
+        if self.reconciled_at is None:
+            return None
+        return time.time() - self.reconciled_at
+
+    def file_changed(self, relative_path, old_size=None, new_size=None):
+        """
+        Record that a file was created, replaced or removed.
+
+        Args:
+            relative_path (str): Path of the file relative to STORAGE_PATH
+            old_size (int): Size before the change, None if it didn't exist
+            new_size (int): Size after the change, None if it was removed
+        """
+        relative_path = normalize_relative_path(relative_path)
+        size_delta = (new_size or 0) - (old_size or 0)
+        files_delta = (new_size is not None) - (old_size is not None)
+        with self._lock:
+            self._apply_delta(os.path.dirname(relative_path), size_delta, files_delta)
+
+    def add_directory(self, relative_dir):
+        """Record that an empty directory was created"""
+        relative_dir = normalize_relative_path(relative_dir)
+        with self._lock:
+            self._dirs.setdefault(relative_dir, [0, 0])
+            self._mark_changed(relative_dir)
+
+    def remove_tree(self, relative_dir):
+        """Record that a directory and everything below it was removed"""
+        relative_dir = normalize_relative_path(relative_dir)
+        with self._lock:
+            totals = self._pop_subtree(relative_dir)
+            if totals:
+                self._apply_delta(os.path.dirname(relative_dir), -totals[0], -totals[1])
+
+    def move(self, old_relative_path, new_relative_path, size=None):
+        """
+        Record a rename or move.
+
+        Args:
+            old_relative_path (str): Old path relative to STORAGE_PATH
+            new_relative_path (str): New path relative to STORAGE_PATH
+            size (int): Size of the file, if a file was moved
+        """
+        old_relative_path = normalize_relative_path(old_relative_path)
+        new_relative_path = normalize_relative_path(new_relative_path)
+        with self._lock:
+            if old_relative_path not in self._dirs:
+                self._apply_delta(os.path.dirname(old_relative_path), -(size or 0), -1)
+                self._apply_delta(os.path.dirname(new_relative_path), size or 0, 1)
+                return
+
+            prefix = old_relative_path + '/'
+            moved = {}
+            for key in [k for k in self._dirs if k == old_relative_path or k.startswith(prefix)]:
+                moved[new_relative_path + key[len(old_relative_path):]] = self._dirs.pop(key)
+            self._dirs.update(moved)
+
+            totals = moved[new_relative_path]
+            self._apply_delta(os.path.dirname(old_relative_path), -totals[0], -totals[1])
+            self._apply_delta(os.path.dirname(new_relative_path), totals[0], totals[1])
+
+    def refresh_directory(self, relative_dir):
+        """
+        Recount the files directly inside a directory.
+
+        Subdirectories keep their totals, those not known yet are queued for
+        a rescan.
+        """
+        relative_dir = normalize_relative_path(relative_dir)
+        path = os.path.join(self.root, relative_dir) if relative_dir else self.root
+        size = 0
+        files = 0
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(os.path.join(relative_dir, entry.name) if relative_dir else entry.name)
+                        else:
+                            size += entry.stat(follow_symlinks=False).st_size
+                            files += 1
+                    except OSError:
+                        continue
+        except FileNotFoundError:
+            self.remove_tree(relative_dir)
+            return
+        except OSError as e:
+            self.logger.warning(f"Cannot scan {path}: {e}")
+            return
+
+        with self._lock:
+            old = self._dirs.get(relative_dir)
+            if not self._ready or self._scanning or old is None:
+                # The totals around it are not settled, count it from scratch
+                self._pending.add(relative_dir)
+                self._wakeup.set()
+                return
+            for child in subdirs:
+                totals = self._dirs.get(child)
+                if totals is None:
+                    self._pending.add(child)
+                    self._wakeup.set()
+                else:
+                    size += totals[0]
+                    files += totals[1]
+            self._apply_delta(relative_dir, size - old[0], files - old[1])
+
+    def handle_changes(self, events):
+        """Apply a batch of file watcher ChangeEvents"""
+        refresh = set()
+        for event in events:
+            if event.action == 'deleted' and event.is_dir:
+                self.remove_tree(event.path)
+            elif event.action == 'rescan' or (event.action == 'created' and event.is_dir):
+                self.rescan_later(event.path)
+            elif event.action == 'changed':
+                refresh.add(event.path)
+            else:
+                refresh.add(os.path.dirname(event.path))
+        # After the removals, so a removed subdirectory isn't subtracted twice
+        for relative_dir in sorted(refresh):
+            self.refresh_directory(relative_dir)
+
+    def rescan_later(self, relative_dir=''):
+        """Queue a rescan of a subtree on the background thread"""
+        relative_dir = normalize_relative_path(relative_dir)
+        with self._lock:
+            self._pending.add(relative_dir)
+        self._wakeup.set()
+
+    def rescan(self, relative_dir=''):
+        """Recompute the totals of a subtree from disk and swap them in"""
+        relative_dir = normalize_relative_path(relative_dir)
+        with self._lock:
+            self._scanning = True
+        try:
+            totals = {}
+            path = os.path.join(self.root, relative_dir) if relative_dir else self.root
+            self._scan(path, relative_dir, totals)
+        except BaseException:
+            with self._lock:
+                self._scanning = False
+            raise
+
+        with self._lock:
+            self._scanning = False
+            old = self._pop_subtree(relative_dir) or [0, 0]
+            self._dirs.update(totals)
+            new = totals[relative_dir]
+            if relative_dir:
+                self._apply_delta(os.path.dirname(relative_dir), new[0] - old[0], new[1] - old[1])
+            self.generation += 1
+
+    def _run(self):
+        next_reconcile = 0
+        while True:
+            if time.time() >= next_reconcile:
+                try:
+                    self.rescan()
+                    self.reconciled_at = time.time()
+                    with self._lock:
+                        self._ready = True
+                except Exception as e:
+                    self.logger.error(f"Error scanning storage usage: {e}")
+                next_reconcile = time.time() + self.reconcile_interval
+
+            # Targeted rescans queued by callers
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            for relative_dir in sorted(pending):
+                try:
+                    if os.path.isdir(os.path.join(self.root, relative_dir)):
+                        self.rescan(relative_dir)
+                    else:
+                        self.remove_tree(relative_dir)
+                except Exception as e:
+                    self.logger.error(f"Error rescanning {relative_dir}: {e}")
+
+            self._wakeup.wait(max(0, next_reconcile - time.time()))
+            self._wakeup.clear()
+
+    def _scan(self, path, relative_dir, totals):
+        # Symlinks are not followed, so loops and double counting can't happen
+        size = 0
+        files = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            child = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+                            child_size, child_files = self._scan(entry.path, child, totals)
+                            size += child_size
+                            files += child_files
+                        else:
+                            size += entry.stat(follow_symlinks=False).st_size
+                            files += 1
+                    except OSError:
+                        continue
+        except OSError as e:
+            self.logger.warning(f"Cannot scan {path}: {e}")
+
+        totals[relative_dir] = [size, files]
+        return size, files
+
+    def _apply_delta(self, relative_dir, size_delta, files_delta):
+        # Caller must hold the lock. Adds to the directory and all its ancestors.
+        self._mark_changed(relative_dir)
+        while True:
+            totals = self._dirs.setdefault(relative_dir, [0, 0])
+            totals[0] += size_delta
+            totals[1] += files_delta
+            if not relative_dir:
+                break
+            relative_dir = os.path.dirname(relative_dir)
+
+    def _pop_subtree(self, relative_dir):
+        # Caller must hold the lock. Returns the subtree's old totals.
+        totals = self._dirs.get(relative_dir)
+        if not relative_dir:
+            self._dirs.clear()
+            return totals
+        prefix = relative_dir + '/'
+        for key in [k for k in self._dirs if k == relative_dir or k.startswith(prefix)]:
+            del self._dirs[key]
+        return totals
+
+    def _mark_changed(self, relative_dir):
+        # Caller must hold the lock
+        self.generation += 1
+        if self._scanning:
+            # A scan in progress may or may not have seen this change,
+            # rescan the directory once it has finished
+            self._pending.add(relative_dir)
+            self._wakeup.set()
+
+
+storage_usage = StorageUsageTracker()
@@ -2,12 +2,19 @@ import os
 import shutil
 import mimetypes
 import re
-import subprocess
 from datetime import datetime
 from flask import current_app
 import uuid
+import base64
+import heapq
+import queue
+import threading
+from collections import OrderedDict
 from app.auth.models import SharedLink
 from app import db
+from app.files.usage import storage_usage
+from app.files.sampler import system_sampler
+from app.files.dedup import dedup_index
 from PIL import Image
 from io import BytesIO
 
@@ -23,73 +30,249 @@ except ImportError:
     humanize = None
 # No duplicate imports needed
 
+# Extensions whose mimetypes guess is reliable enough to skip sniffing the file
+TRUSTED_MIME_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.heic',
+    '.mp4', '.m4v', '.webm', '.mov', '.avi', '.mkv', '.3gp',
+    '.mp3', '.m4a', '.aac', '.flac', '.wav', '.ogg', '.opus',
+    '.pdf', '.zip', '.7z', '.rar', '.gz', '.tgz', '.apk', '.epub',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp'
+))
+
+# Fields a listing can be sorted by
+SORT_FIELDS = ('name', 'size', 'modified')
+
+# libmagic handles are expensive to create (each loads the magic database),
+# so a few are kept and shared between request threads
+MAGIC_POOL_SIZE = 2
+magic_pool = queue.LifoQueue()
+magic_pool_lock = threading.Lock()
+magic_pool_created = 0
+
+# Detected MIME types by (device, inode, size, mtime_ns)
+MIME_CACHE_SIZE = 4096
+mime_cache = OrderedDict()
+mime_cache_lock = threading.Lock()
+
 def get_file_info(path, relative_path):
     """Get file information"""
     try:
         stat = os.stat(path)
-        file_size = stat.st_size
-        modified_time = datetime.fromtimestamp(stat.st_mtime)
-
-        # Get file type
-        if magic:
-            try:
-                mime = magic.Magic(mime=True)
-                file_type = mime.from_file(path)
-            except:
-                file_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
-        else:
-            file_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
-
-        # Get file icon based on type
         is_dir = os.path.isdir(path)
-        if is_dir:
-            icon = 'bi-folder'
-        else:
-            icon = get_file_icon(file_type, path)
-
-        # Format human-readable size
-        if humanize:
-            size_human = humanize.naturalsize(file_size)
-            modified_human = humanize.naturaltime(modified_time)
-        else:
-            # Simple fallback if humanize is not available
-            size_human = format_size(file_size)
-            modified_human = modified_time.strftime('%Y-%m-%d %H:%M:%S')
-
-        return {
-            'name': os.path.basename(path),
-            'path': relative_path,
-            'size': file_size,
-            'size_human': size_human,
-            'modified': modified_time,
-            'modified_human': modified_human,
-            'type': file_type,
-            'icon': icon,
-            'is_dir': is_dir
-        }
+        return build_file_info(path, relative_path, stat.st_size, stat.st_mtime, is_dir)
     except (PermissionError, FileNotFoundError) as e:
         # Handle inaccessible files
         current_app.logger.warning(f"Cannot access file {path}: {e}")
+        return get_inaccessible_file_info(path, relative_path)
+
+def build_file_info(path, relative_path, file_size, mtime, is_dir):
+    """Build full file information from stat data the caller already has"""
+    modified_time = datetime.fromtimestamp(mtime)
+
+    # Get file type and icon
+    if is_dir:
+        file_type = 'directory'
+        icon = 'bi-folder'
+    else:
+        file_type = detect_mime_type(path)
+        icon = get_file_icon(file_type, path)
+
+    # Format human-readable size
+    if humanize:
+        size_human = humanize.naturalsize(file_size)
+        modified_human = humanize.naturaltime(modified_time)
+    else:
+        # Simple fallback if humanize is not available
+        size_human = format_size(file_size)
+        modified_human = modified_time.strftime('%Y-%m-%d %H:%M:%S')
+
+    return {
+        'name': os.path.basename(path),
+        'path': relative_path,
+        'size': file_size,
+        'size_human': size_human,
+        'modified': modified_time,
+        'modified_human': modified_human,
+        'type': file_type,
+        'icon': icon,
+        'is_dir': is_dir
+    }
+
+def detect_mime_type(path, stat_result=None):
+    """
+    Detect the MIME type of a file.
 
-        # Create a basic entry with limited information
-        is_dir = False
+    Unambiguous extensions are answered by mimetypes without touching the
+    file. Everything else is sniffed with libmagic (when installed) and the
+    result is memoized by (device, inode, size, mtime_ns), so repeated
+    downloads and thumbnails of the same file don't read its header again.
+
+    Args:
+        path (str): Path to the file
+        stat_result (os.stat_result): Stat of the file if the caller has one
+
+    Returns:
+        str: MIME type, 'application/octet-stream' if unknown
+    """
+    guessed = mimetypes.guess_type(path)[0]
+    if guessed and os.path.splitext(path)[1].lower() in TRUSTED_MIME_EXTENSIONS:
+        return guessed
+
+    fallback = guessed or 'application/octet-stream'
+    if not magic:
+        return fallback
+
+    try:
+        stat = stat_result or os.stat(path)
+    except OSError:
+        return fallback
+
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with mime_cache_lock:
+        file_type = mime_cache.get(key)
+        if file_type is not None:
+            mime_cache.move_to_end(key)
+            return file_type
+
+    try:
+        handle = acquire_magic_handle()
+    except Exception:
+        # libmagic is installed but its database could not be loaded
+        return fallback
+
+    try:
+        file_type = handle.from_file(path)
+    except Exception:
+        file_type = fallback
+    finally:
+        magic_pool.put(handle)
+
+    with mime_cache_lock:
+        mime_cache[key] = file_type
+        if len(mime_cache) > MIME_CACHE_SIZE:
+            mime_cache.popitem(last=False)
+
+    return file_type
+
+def acquire_magic_handle():
+    """Take a libmagic handle from the pool, creating one if the pool isn't full yet"""
+    global magic_pool_created
+
+    try:
+        return magic_pool.get_nowait()
+    except queue.Empty:
+        pass
+
+    with magic_pool_lock:
+        if magic_pool_created < MAGIC_POOL_SIZE:
+            magic_pool_created += 1
+            create = True
+        else:
+            create = False
+
+    if create:
         try:
-            is_dir = os.path.isdir(path)
-        except:
-            pass
+            return magic.Magic(mime=True)
+        except Exception:
+            with magic_pool_lock:
+                magic_pool_created -= 1
+            raise
+
+    # All handles are busy, wait for one to be returned
+    return magic_pool.get()
+
+def enrich_items(items, base_path, folder_totals=None):
+    """
+    Turn lightweight listing records into full file information.
+
+    Listings and search results are sorted and paginated on cheap records;
+    only the items on the requested page go through the MIME sniff and
+    humanize formatting here.
+
+    Args:
+        items (list): Records from scan_directory or search_files
+        base_path (str): Path the records' relative paths are based on
+        folder_totals (dict): relative path -> (size, files) from the storage
+                              usage tracker, shown as the size of folders
+
+    Returns:
+        list: List of dictionaries with full file information
+    """
+    enriched = []
+    for item in items:
+        full_path = os.path.join(base_path, item['path'])
+        if item.get('inaccessible'):
+            enriched.append(item)
+            continue
+
+        if 'mtime' in item:
+            info = build_file_info(full_path, item['path'], item['size'],
+                                   item['mtime'], item['is_dir'])
+        else:
+            # Search hits only carry a path, stat them now
+            info = get_file_info(full_path, item['path'])
+
+        if info['is_dir'] and folder_totals and item['path'] in folder_totals:
+            info['size'], info['item_count'] = folder_totals[item['path']]
+            info['size_human'] = humanize.naturalsize(info['size']) if humanize else format_size(info['size'])
+
+        enriched.append(info)
+    return enriched
+
+def sort_items(items, sort='name', reverse=False, folder_totals=None):
+    """
+    Sort listing records, keeping directories before files.
+
+    Args:
+        items (list): Records from scan_directory
+        sort (str): 'name', 'size' or 'modified'
+        reverse (bool): Sort in descending order
+        folder_totals (dict): relative path -> (size, files), used as the
+                              size of directories when sorting by size
 
-        return {
-            'name': os.path.basename(path),
-            'path': relative_path,
-            'size': 0,
-            'size_human': '-',
-            'modified': datetime.now(),
-            'modified_human': 'Unknown',
-            'type': 'directory' if is_dir else 'unknown',
-            'icon': 'bi-folder' if is_dir else 'bi-file-lock',
-            'is_dir': is_dir,
-            'inaccessible': True
-        }
+    Returns:
+        list: New sorted list
+    """
+    if sort == 'size':
+        folder_totals = folder_totals or {}
+
+        def key(item):
+            if item['is_dir']:
+                return folder_totals.get(item['path'], (0, 0))[0]
+            return item['size']
+    elif sort == 'modified':
+        def key(item):
+            return item.get('mtime', 0)
+    else:
+        def key(item):
+            return item['name'].lower()
+
+    # Python's sort is stable, so the second pass keeps the order within
+    # directories and within files
+    result = sorted(items, key=key, reverse=reverse)
+    result.sort(key=lambda item: not item['is_dir'])
+    return result
+
+def get_inaccessible_file_info(path, relative_path):
+    """Create a basic entry with limited information for an inaccessible file"""
+    is_dir = False
+    try:
+        is_dir = os.path.isdir(path)
+    except:
+        pass
+
+    return {
+        'name': os.path.basename(path),
+        'path': relative_path,
+        'size': 0,
+        'size_human': '-',
+        'modified': datetime.now(),
+        'modified_human': 'Unknown',
+        'type': 'directory' if is_dir else 'unknown',
+        'icon': 'bi-folder' if is_dir else 'bi-file-lock',
+        'is_dir': is_dir,
+        'inaccessible': True
+    }
 
 def format_size(size_bytes):
     """Format bytes to human-readable size (fallback for when humanize is not available)"""
@@ -129,25 +312,24 @@ def get_file_icon(file_type, path):
 
     return 'bi-file'
 
-def get_directory_size(path):
-    """Get the size of a directory and its contents"""
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            if os.path.exists(fp):
-                total_size += os.path.getsize(fp)
-    return total_size
-
 def get_storage_info():
-    """Get storage usage information"""
+    """
+    Get storage usage information.
+
+    The size of the NAS files comes from the background usage tracker, so
+    this doesn't walk the storage tree. total_size is None until the first
+    scan has finished, and total_size_age tells how long ago the totals were
+    last reconciled with a full scan.
+    """
     storage_path = current_app.config['STORAGE_PATH']
-    total_size = get_directory_size(storage_path)
+    usage = storage_usage.get_totals()
+    total_size = usage[0] if usage else None
+    total_size_age = storage_usage.get_age()
 
     # Get disk usage
     free = 0
     total = 0
-    used = total_size
+    used = total_size or 0
 
     # Try to get actual disk usage on Linux/Unix/MacOS
     if os.name == 'posix':
@@ -161,13 +343,18 @@ def get_storage_info():
             pass
 
     # Format sizes
-    if humanize:
+    if total_size is None:
+        total_size_human = 'Calculating...'
+    elif humanize:
         total_size_human = humanize.naturalsize(total_size)
+    else:
+        total_size_human = format_size(total_size)
+
+    if humanize:
         disk_free_human = humanize.naturalsize(free) if free > 0 else 'Unknown'
         disk_total_human = humanize.naturalsize(total) if total > 0 else 'Unknown'
         disk_used_human = humanize.naturalsize(used) if used > 0 else 'Unknown'
     else:
-        total_size_human = format_size(total_size)
         disk_free_human = format_size(free) if free > 0 else 'Unknown'
         disk_total_human = format_size(total) if total > 0 else 'Unknown'
         disk_used_human = format_size(used) if used > 0 else 'Unknown'
@@ -177,16 +364,33 @@ def get_storage_info():
     if total > 0:
         disk_usage_percent = min((used / total * 100), 100)  # Cap at 100%
 
+    # Bytes saved by uploads that were linked to a stored copy
+    dedup = dedup_index.stats() if dedup_index.enabled else {'enabled': False, 'files': 0, 'saved': 0}
+    dedup_saved_human = humanize.naturalsize(dedup['saved']) if humanize else format_size(dedup['saved'])
+
+    if total_size_age is None:
+        total_size_updated_human = 'Not yet'
+    elif humanize:
+        total_size_updated_human = humanize.naturaltime(total_size_age)
+    else:
+        total_size_updated_human = f"{int(total_size_age // 60)} min ago"
+
     return {
         'total_size': total_size,
         'total_size_human': total_size_human,
+        'total_size_age': total_size_age,
+        'total_size_updated_human': total_size_updated_human,
         'disk_free': free,
         'disk_free_human': disk_free_human,
         'disk_total': total,
         'disk_total_human': disk_total_human,
         'disk_used': used,
         'disk_used_human': disk_used_human,
-        'disk_usage_percent': disk_usage_percent
+        'disk_usage_percent': disk_usage_percent,
+        'dedup_enabled': dedup['enabled'],
+        'dedup_files': dedup['files'],
+        'dedup_saved': dedup['saved'],
+        'dedup_saved_human': dedup_saved_human
     }
 
 def create_thumbnail(file_path, max_size=(200, 200)):
@@ -206,164 +410,51 @@ def create_thumbnail(file_path, max_size=(200, 200)):
         return None
 
 def get_system_info():
-    """Get system information (CPU, RAM usage)"""
-    import subprocess
-    import re
+    """Get system information (CPU, RAM usage) from the latest background sample"""
+    return format_system_sample(system_sampler.get_latest())
+
+def format_system_sample(sample):
+    """
+    Format a sample from the system sampler for display.
+
+    Args:
+        sample (dict): Sample from system_sampler, or None if there is none yet
 
-    # Initialize default values
+    Returns:
+        dict: CPU, memory and storage usage with human-readable sizes
+    """
     cpu_percent = 0
     memory_percent = 0
     memory_used = "0 MB"
     memory_total = "0 MB"
+    storage_free = "Unknown"
+    storage_total = "Unknown"
+    storage_percent = 0
+    sampled_at = None
+    seq = None
 
-    try:
-        # Try multiple methods to get CPU usage and use the most reasonable value
-        cpu_values = []
-
-        # Method 1: Use htop
-        try:
-            cpu_cmd = "htop -C -n1 | grep CPU | awk '{print $3}' | sed 's/[^0-9.]//g'"
-            cpu_output = subprocess.check_output(cpu_cmd, shell=True, text=True).strip()
-            try:
-                value = float(cpu_output)
-                if 0 <= value <= 100:
-                    cpu_values.append(value)
-            except ValueError:
-                pass
-        except:
-            pass
-
-        # Method 2: Alternative htop parsing
-        try:
-            cpu_cmd = "htop -C -n1 | head -n 3 | tail -n 1 | awk '{print $2}' | sed 's/[^0-9.]//g'"
-            cpu_output = subprocess.check_output(cpu_cmd, shell=True, text=True).strip()
-            try:
-                value = float(cpu_output)
-                if 0 <= value <= 100:
-                    cpu_values.append(value)
-            except ValueError:
-                pass
-        except:
-            pass
-
-        # Method 3: Use ps command
-        try:
-            cpu_cmd = "ps -o %cpu= -e | awk '{s+=$1} END {print s}'"
-            cpu_output = subprocess.check_output(cpu_cmd, shell=True, text=True).strip()
-            if cpu_output:
-                value = float(cpu_output)
-                if 0 <= value <= 400:  # Allow for multi-core systems
-                    cpu_values.append(min(value, 100))  # Cap at 100%
-        except:
-            pass
-
-        # Method 4: Parse /proc/stat
-        try:
-            with open('/proc/stat', 'r') as f:
-                cpu_line = f.readline().strip()
-                cpu_values_raw = cpu_line.split()[1:5]
-                cpu_total = sum(float(x) for x in cpu_values_raw)
-                cpu_idle = float(cpu_values_raw[3])
-                value = 100 * (1 - (cpu_idle / cpu_total))
-                if 0 <= value <= 100:
-                    cpu_values.append(value)
-        except:
-            pass
-
-        # Choose the most reasonable CPU value
-        if cpu_values:
-            # Filter out unreasonable values
-            reasonable_values = [v for v in cpu_values if 0 <= v <= 100]
-            if reasonable_values:
-                cpu_percent = round(sum(reasonable_values) / len(reasonable_values), 1)
-            else:
-                cpu_percent = 0
-        else:
-            cpu_percent = 0
+    if sample:
+        sampled_at = sample['time']
+        seq = sample['seq']
 
-        # Try to get memory info using free command
-        try:
-            mem_cmd = "free -m | grep 'Mem:'"
-            mem_output = subprocess.check_output(mem_cmd, shell=True, text=True).strip()
-            mem_parts = mem_output.split()
-
-            if len(mem_parts) >= 3:
-                mem_total = int(mem_parts[1])
-                mem_used = int(mem_parts[2])
-                memory_percent = (mem_used / mem_total) * 100 if mem_total > 0 else 0
-                memory_total = f"{mem_total} MB"
-                memory_used = f"{mem_used} MB"
-        except:
-            # Fallback to /proc/meminfo
-            try:
-                with open('/proc/meminfo', 'r') as f:
-                    meminfo = f.read()
-                    total_match = re.search(r'MemTotal:\s+(\d+)', meminfo)
-                    free_match = re.search(r'MemFree:\s+(\d+)', meminfo)
-                    buffers_match = re.search(r'Buffers:\s+(\d+)', meminfo)
-                    cached_match = re.search(r'Cached:\s+(\d+)', meminfo)
-
-                    if total_match and free_match and buffers_match and cached_match:
-                        total = int(total_match.group(1))
-                        free = int(free_match.group(1))
-                        buffers = int(buffers_match.group(1))
-                        cached = int(cached_match.group(1))
-
-                        used = total - free - buffers - cached
-                        mem_total = total // 1024  # Convert to MB
-                        mem_used = used // 1024    # Convert to MB
-
-                        memory_percent = (mem_used / mem_total) * 100 if mem_total > 0 else 0
-                        memory_total = f"{mem_total} MB"
-                        memory_used = f"{mem_used} MB"
-            except:
-                pass
-    except Exception as e:
-        # If commands fail, return default values
-        current_app.logger.error(f"Error getting system info: {e}")
+        if sample['cpu_percent'] is not None:
+            cpu_percent = round(sample['cpu_percent'], 1)
 
-    # Get storage info directly without calling get_storage_info to avoid recursion
-    storage_path = current_app.config['STORAGE_PATH']
-    storage_used = "0 MB"
-    storage_free = "0 MB"
-    storage_total = "0 MB"
-    storage_percent = 0
+        if sample['memory_total']:
+            memory_percent = sample['memory_used'] / sample['memory_total'] * 100
+            memory_used = f"{sample['memory_used'] // (1024 * 1024)} MB"
+            memory_total = f"{sample['memory_total'] // (1024 * 1024)} MB"
 
-    try:
-        # Get directory size for NAS files
-        total_size = get_directory_size(storage_path)
-        storage_used = format_size(total_size)
+        if sample['disk_total']:
+            free = sample['disk_free']
+            total = sample['disk_total']
+            storage_free = format_size(free)
+            storage_total = format_size(total)
+            storage_percent = min(((total - free) / total * 100), 100)
 
-        # Try to get disk usage using df command (most reliable in Termux)
-        try:
-            df_cmd = f"df -h {storage_path} | tail -1"
-            df_output = subprocess.check_output(df_cmd, shell=True, text=True).strip()
-            df_parts = df_output.split()
-
-            if len(df_parts) >= 5:
-                storage_total = df_parts[1]
-                disk_used = df_parts[2]  # This is total disk usage, not just NAS files
-                storage_free = df_parts[3]
-                storage_percent = float(df_parts[4].replace('%', ''))
-        except:
-            # Fallback to statvfs if df fails
-            try:
-                stat = os.statvfs(storage_path)
-                free = stat.f_bavail * stat.f_frsize
-                total = stat.f_blocks * stat.f_frsize
-
-                storage_free = format_size(free)
-                storage_total = format_size(total)
-
-                # Calculate percentage based on total disk usage
-                if total > 0:
-                    storage_percent = min(((total - free) / total * 100), 100)
-            except:
-                # Last resort - just use some default values
-                storage_free = "Unknown"
-                storage_total = "Unknown"
-    except Exception as e:
-        current_app.logger.error(f"Error getting storage info: {e}")
+    # Get size of NAS files from the background usage tracker
+    usage = storage_usage.get_totals()
+    storage_used = format_size(usage[0]) if usage else "Calculating..."
 
     return {
         'cpu_percent': cpu_percent,
@@ -373,7 +464,9 @@ def get_system_info():
         'storage_used': storage_used,
         'storage_free': storage_free,
         'storage_total': storage_total,
-        'storage_percent': storage_percent
+        'storage_percent': storage_percent,
+        'sampled_at': sampled_at,
+        'seq': seq
     }
 
 def create_share_link(user_id, file_path, expiry_days=7):
@@ -409,112 +502,84 @@ def create_share_link(user_id, file_path, expiry_days=7):
 
     return token
 
-def search_files(query, path):
-    """Search for files matching the query"""
-    results = []
-    query = query.lower()
+def search_files(query, path, after=''):
+    """
+    Search for files matching the query by walking the tree.
 
-    try:
-        # Try using find command for faster search
-        # -iname: case-insensitive name matching
-        # -type f: only files
-        # -o: logical OR
-        # -type d: only directories
-        # Use print0 and xargs to handle filenames with spaces
-        cmd = f"find '{path}' -type f -iname '*{query}*' -o -type d -iname '*{query}*' | sort"
-        output = subprocess.check_output(cmd, shell=True, text=True).strip()
-
-        if not output:
-            return []
-
-        # Split by newlines
-        file_list = output.split('\n')
-
-        # Process the results
-        for item_path in file_list:
-            if not item_path or item_path == path:  # Skip empty lines and the root path
-                continue
+    Used while the search index is being built. Matches are yielded as they
+    are found, in the same order as the index returns them (by relative
+    path), so a search can stop after one page and resume from a cursor.
+    Only names and relative paths are collected; pass the page being
+    displayed through enrich_items() to stat and type the hits.
 
-            # Skip hidden files and directories
-            basename = os.path.basename(item_path)
-            if basename.startswith('.'):
-                continue
+    Args:
+        query (str): Case-insensitive substring of the name
+        path (str): Root of the tree to search
+        after (str): Only yield paths that sort after this one
 
-            # Get relative path
-            rel_path = os.path.relpath(item_path, path)
+    Yields:
+        dict: {name, path} records
+    """
+    query = query.lower()
 
-            # Get file info
-            try:
-                # Try to get detailed file info
-                results.append(get_file_info(item_path, rel_path))
-            except Exception as file_info_error:
-                current_app.logger.error(f"Error getting file info: {file_info_error}")
-
-                # If we can't get file info, create a basic entry
-                try:
-                    is_dir = os.path.isdir(item_path)
-                    size = 0
-                    if not is_dir:
-                        try:
-                            size = os.path.getsize(item_path)
-                        except:
-                            pass
-
-                    results.append({
-                        'name': basename,
-                        'path': rel_path,
-                        'size': size,
-                        'size_human': format_size(size) if size > 0 else '-',
-                        'modified': datetime.now(),
-                        'modified_human': 'Unknown',
-                        'type': 'directory' if is_dir else 'unknown',
-                        'icon': 'bi-folder' if is_dir else get_file_icon_by_name(basename),
-                        'is_dir': is_dir
-                    })
-                except Exception as basic_info_error:
-                    current_app.logger.error(f"Error creating basic file info: {basic_info_error}")
-                    continue
-
-        return results
-    except Exception as e:
-        current_app.logger.error(f"Error using find command: {e}")
+    # Visit entries in path order with a heap of the paths seen but not
+    # visited yet. Everything below a directory sorts after it, so its
+    # children are pushed when it is popped.
+    pending = [('', True)]
+    while pending:
+        relative_path, is_dir = heapq.heappop(pending)
+        if relative_path:
+            name = os.path.basename(relative_path)
+            if relative_path > after and query in name.lower():
+                yield {'name': name, 'path': relative_path}
+            if not is_dir:
+                continue
 
-        # Fallback to os.walk if find command fails
-        results = []
         try:
-            for root, dirs, files in os.walk(path):
-                # Skip hidden directories
-                dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-                # Check directories
-                for dir_name in dirs:
-                    if query in dir_name.lower():
-                        full_path = os.path.join(root, dir_name)
-                        rel_path = os.path.relpath(full_path, path)
-                        try:
-                            results.append(get_file_info(full_path, rel_path))
-                        except Exception as dir_error:
-                            current_app.logger.error(f"Error getting directory info: {dir_error}")
-
-                # Check files
-                for file_name in files:
-                    if query in file_name.lower():
-                        full_path = os.path.join(root, file_name)
-                        rel_path = os.path.relpath(full_path, path)
-                        try:
-                            results.append(get_file_info(full_path, rel_path))
-                        except Exception as file_error:
-                            current_app.logger.error(f"Error getting file info: {file_error}")
-        except Exception as walk_error:
-            current_app.logger.error(f"Error walking directory: {walk_error}")
-
-        return results
+            with os.scandir(os.path.join(path, relative_path)) as entries:
+                for entry in entries:
+                    # Skip hidden files and directories
+                    if entry.name.startswith('.'):
+                        continue
+                    child = os.path.join(relative_path, entry.name) if relative_path else entry.name
+                    try:
+                        child_is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        child_is_dir = False
+                    # Skip subtrees that sort entirely before the cursor
+                    if child_is_dir and child + '0' <= after:
+                        continue
+                    if not child_is_dir and child <= after:
+                        continue
+                    heapq.heappush(pending, (child, child_is_dir))
+        except OSError as e:
+            current_app.logger.error(f"Error walking directory: {e}")
+
+def encode_cursor(relative_path):
+    """Encode the last path of a page as an opaque cursor for the next one"""
+    encoded = base64.urlsafe_b64encode(relative_path.encode('utf-8', 'surrogateescape'))
+    return encoded.decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor(), '' if it is missing or invalid"""
+    if not cursor:
+        return ''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8', 'surrogateescape')
+    except (ValueError, UnicodeError):
+        return ''
 
 def sanitize_path(path):
     """Sanitize and validate a path to prevent directory traversal attacks"""
-    # Remove any path traversal attempts
-    path = re.sub(r'\.\./', '', path)
-    path = re.sub(r'\.\.\\', '', path)
+    # Remove any path traversal attempts, until none is left ('....//'
+    # becomes '../' after one pass)
+    previous = None
+    while path != previous:
+        previous = path
+        path = re.sub(r'\.\./', '', path)
+        path = re.sub(r'\.\.\\', '', path)
+        path = re.sub(r'(^|/)\.\.$', r'\1', path)
     path = path.lstrip('/')
     path = path.lstrip('\\')
 
@@ -541,155 +606,53 @@ def is_potentially_dangerous_file(filename):
 
     return filename.lower().endswith(dangerous_extensions)
 
-def get_directory_contents_with_ls(path):
+def scan_directory(path, relative_dir=''):
     """
-    Get directory contents using the 'ls' command for better performance with large directories.
+    List a directory in-process using os.scandir.
+
+    Each DirEntry caches its stat result, so a listing costs one directory
+    read plus a single stat per entry instead of forking an 'ls' process.
+    Hidden files are skipped, like everywhere else in the browser.
+
+    The records only hold what is needed to sort and paginate (name, path,
+    size, mtime, is_dir); use enrich_items() for the page being displayed.
 
     Args:
         path (str): Path to the directory
+        relative_dir (str): Path of the directory relative to STORAGE_PATH
 
     Returns:
-        list: List of dictionaries with file information
-    """
-    try:
-        # Use ls -la with a null separator to handle filenames with spaces
-        # We'll use two commands:
-        # 1. First to get all files and their basic info
-        # 2. Second to get file types (for icons)
-
-        # Command 1: Get file listing with details
-        # Format: permissions links owner group size date time name
-        cmd = f"ls -la --time-style=long-iso '{path}'"
-        output = subprocess.check_output(cmd, shell=True, text=True).strip().split('\n')
-
-        # Skip the first line (total) and parse the rest
-        items = []
-        for line in output[1:]:  # Skip the "total" line
-            if not line.strip():
-                continue
+        list: List of dictionaries with basic file information
 
-            # The first 7 fields are fixed format, the rest is the filename
-            # We'll split by position rather than by spaces to handle filenames with spaces
-            try:
-                # Parse permissions field (first 10 characters)
-                permissions = line[0:10].strip()
-                is_dir = permissions.startswith('d')
-
-                # Find the position where the filename starts
-                # This is tricky with spaces, so we'll use a heuristic
-                # The format is typically: "permissions links owner group size date time filename"
-                parts = line.split(None, 7)  # Split into 8 parts max
-
-                if len(parts) < 7:
-                    continue  # Not enough parts
-
-                # Get the size, date, and time
-                try:
-                    size = int(parts[4])
-                except ValueError:
-                    size = 0
-
-                date_str = parts[5]
-                time_str = parts[6]
-
-                # Get the filename (last part, or everything after the 7th space-delimited field)
-                if len(parts) >= 8:
-                    name = parts[7]
-                else:
-                    # If we couldn't split properly, try another approach
-                    name = line.split()[-1]
-
-                # Skip . and .. entries
-                if name == '.' or name == '..':
-                    continue
-
-                # Create a basic file info object
-                file_info = {
-                    'name': name,
-                    'is_dir': is_dir,
-                    'size': size,
-                    'size_human': format_size(size),
-                    'modified': datetime.now(),  # Placeholder
-                    'modified_human': f"{date_str} {time_str}",
-                    'type': 'directory' if is_dir else mimetypes.guess_type(name)[0] or 'application/octet-stream',
-                    'icon': 'bi-folder' if is_dir else get_file_icon_by_name(name)
-                }
-
-                items.append(file_info)
-            except Exception as e:
-                current_app.logger.error(f"Error parsing ls output line: {e}")
-                continue
-
-        return items
-    except Exception as e:
-        current_app.logger.error(f"Error using ls command: {e}")
-        # Fallback to os.listdir if ls command fails
-        return None
-
-def get_file_icon_by_name(filename):
-    """Get file icon based on filename extension"""
-    _, ext = os.path.splitext(filename)
-    ext = ext.lower()
-
-    if ext in ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'):
-        return 'bi-file-image'
-    elif ext in ('.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm'):
-        return 'bi-file-play'
-    elif ext in ('.mp3', '.wav', '.ogg', '.flac', '.aac'):
-        return 'bi-file-music'
-    elif ext in ('.txt', '.log', '.md', '.csv'):
-        return 'bi-file-text'
-    elif ext == '.pdf':
-        return 'bi-file-pdf'
-    elif ext in ('.zip', '.rar', '.7z', '.tar', '.gz', '.tgz'):
-        return 'bi-file-zip'
-    elif ext in ('.doc', '.docx', '.rtf'):
-        return 'bi-file-word'
-    elif ext in ('.xls', '.xlsx'):
-        return 'bi-file-excel'
-    elif ext in ('.ppt', '.pptx'):
-        return 'bi-file-ppt'
-    else:
-        return 'bi-file'
-
-def read_file_in_chunks(file_path, chunk_size=1024*1024, start_pos=0, end_pos=None):
-    """
-    Read a file in chunks with optimized buffering for better performance.
-
-    Args:
-        file_path (str): Path to the file
-        chunk_size (int): Size of each chunk in bytes
-        start_pos (int): Starting position for reading
-        end_pos (int): Ending position for reading (None for end of file)
-
-    Yields:
-        bytes: Chunks of file data
+    Raises:
+        OSError: If the directory itself cannot be read
     """
-    # Calculate total bytes to read
-    file_size = os.path.getsize(file_path)
-
-    if end_pos is None:
-        end_pos = file_size - 1
+    items = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name = entry.name
 
-    # Ensure positions are valid
-    start_pos = max(0, min(start_pos, file_size - 1))
-    end_pos = max(start_pos, min(end_pos, file_size - 1))
-
-    # Calculate total bytes to read
-    bytes_to_read = end_pos - start_pos + 1
+            # Skip hidden files
+            if name.startswith('.'):
+                continue
 
-    # Open file with a larger buffer size for better performance
-    with open(file_path, 'rb', buffering=chunk_size*2) as f:
-        f.seek(start_pos)
-        bytes_read = 0
+            relative_path = os.path.join(relative_dir, name) if relative_dir else name
 
-        while bytes_read < bytes_to_read:
-            # Adjust chunk size for the last chunk
-            current_chunk_size = min(chunk_size, bytes_to_read - bytes_read)
-            chunk = f.read(current_chunk_size)
+            try:
+                # is_dir() follows symlinks, the same as os.path.isdir
+                is_dir = entry.is_dir()
+                stat = entry.stat()
+            except OSError:
+                # Broken symlinks and entries we are not allowed to stat
+                items.append(get_inaccessible_file_info(entry.path, relative_path))
+                continue
 
-            if not chunk:
-                break
+            items.append({
+                'name': name,
+                'path': relative_path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'is_dir': is_dir
+            })
 
-            bytes_read += len(chunk)
-            yield chunk
+    return items
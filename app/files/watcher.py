@@ -0,0 +1,419 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import queue
+import select
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from app.files.usage import is_hidden
+
+# A change under STORAGE_PATH, path being relative to it.
+#   created   a file or directory appeared (a directory may already have contents)
+#   modified  a file's content or metadata changed
+#   deleted   a file or directory, and everything below it, is gone
+#   changed   entries directly inside a directory changed, but which ones is unknown
+#   rescan    anything below the path may have changed (e.g. events were lost)
+ChangeEvent = namedtuple('ChangeEvent', ['action', 'path', 'is_dir'])
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyError(OSError):
+    """inotify is unavailable, or the watch limit was reached"""
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise InotifyError(errno.ENOSYS, f"inotify not available: {e}")
+
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise InotifyError(code, f"inotify_init1: {os.strerror(code)}")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise InotifyError(code, f"inotify_add_watch {path}: {os.strerror(code)}")
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds and read the queued events.
+
+        Returns:
+            list: (wd, mask, cookie, name) tuples
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """
+    Detects changes under STORAGE_PATH made outside the web UI.
+
+    Uses inotify where available, watching every non-hidden directory, and
+    otherwise (or when the watch limit is reached) polls the mtime of every
+    directory each WATCHER_POLL_INTERVAL seconds. Polling only sees entries
+    being added, removed or renamed; it reports those as 'changed' events on
+    the directory.
+
+    Events are coalesced per path and published in batches to subscribers
+    once no new event arrived for WATCHER_DEBOUNCE seconds, or at the latest
+    WATCHER_MAX_DELAY seconds after the first one. When the kernel queue
+    overflows, or inotify fails and polling takes over, a 'rescan' of the
+    whole tree is published instead, so subscribers can rebuild what they
+    derive from it.
+
+    Subscribers are called with a list of ChangeEvents on a dispatch thread
+    of their own, so a slow one doesn't keep the watcher from reading the
+    kernel queue. Batches published while they are busy are handed over
+    together in the next call.
+    """
+
+    def __init__(self, backend='auto', poll_interval=10, debounce=0.5, max_delay=2.0):
+        self.root = None
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._thread = None
+        self._dispatcher = None
+
+        # Published batches waiting for the dispatch thread
+        self._published = queue.Queue()
+
+        # Pending events of the next batch, keyed by path
+        self._batch = {}
+        self._first_event = None
+        self._last_event = None
+
+        # Backend that is actually running and counters, for the system page
+        self.active_backend = None
+        self.watched_dirs = 0
+        self.batches = 0
+        self.events = 0
+        self.overflows = 0
+
+    def init_app(self, app):
+        self.root = app.config['STORAGE_PATH']
+        self.backend = app.config.get('WATCHER_BACKEND', self.backend)
+        self.poll_interval = app.config.get('WATCHER_POLL_INTERVAL', self.poll_interval)
+        self.debounce = app.config.get('WATCHER_DEBOUNCE', self.debounce)
+        self.logger = app.logger
+        app.extensions['file_watcher'] = self
+
+    def subscribe(self, callback):
+        """Call callback(events) with every batch of ChangeEvents"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def start(self):
+        """Start watching if it isn't running yet and a backend is enabled"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None or self.backend == 'off':
+                return
+            self._dispatcher = threading.Thread(target=self._dispatch, name='file-watcher-dispatch', daemon=True)
+            self._dispatcher.start()
+            self._thread = threading.Thread(target=self._run, name='file-watcher', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        """Get the running backend and event counters"""
+        return {
+            'backend': self.active_backend,
+            'watched_dirs': self.watched_dirs,
+            'batches': self.batches,
+            'events': self.events,
+            'overflows': self.overflows,
+        }
+
+    def _run(self):
+        rescan = False
+        if self.backend in ('auto', 'inotify'):
+            try:
+                self._run_inotify()
+                return
+            except InotifyError as e:
+                self.logger.warning(f"File watcher falling back to polling: {e}")
+                # Changes made while switching would be lost otherwise
+                rescan = self.watched_dirs > 0
+        self._run_polling(rescan)
+
+    def _add_event(self, action, relative_path, is_dir):
+        if is_hidden(relative_path):
+            return
+        now = time.time()
+        previous = self._batch.get(relative_path)
+        root = self._batch.get('')
+        # A pending rescan covers any later change, and a new entry stays
+        # new to subscribers however often it is modified
+        covered = root is not None and root.action == 'rescan'
+        if previous is not None:
+            covered = covered or previous.action == 'rescan' or (previous.action == 'created' and action == 'modified')
+        if not covered:
+            self._batch[relative_path] = ChangeEvent(action, relative_path, is_dir)
+        if self._first_event is None:
+            self._first_event = now
+        self._last_event = now
+
+    def _add_rescan(self, relative_path=''):
+        # A rescan of the root supersedes everything else in the batch
+        if not relative_path:
+            self._batch.clear()
+            self._batch[''] = ChangeEvent('rescan', '', True)
+            now = time.time()
+            self._first_event = self._first_event or now
+            self._last_event = now
+        else:
+            self._add_event('rescan', relative_path, True)
+
+    def _flush_if_due(self):
+        if not self._batch:
+            return
+        now = time.time()
+        if now - self._last_event < self.debounce and now - self._first_event < self.max_delay:
+            return
+        self._flush()
+
+    def _flush(self):
+        # Hand the batch over to the dispatch thread
+        if not self._batch:
+            return
+        events = list(self._batch.values())
+        self._batch = {}
+        self._first_event = self._last_event = None
+        self.batches += 1
+        self.events += len(events)
+        self._published.put(events)
+
+    def _dispatch(self):
+        # Publish batches to every subscriber, off the watcher thread
+        while True:
+            events = self._published.get()
+            # Merge the batches that queued up meanwhile, a rescan of the
+            # root superseding everything before it
+            while True:
+                try:
+                    events = events + self._published.get_nowait()
+                except queue.Empty:
+                    break
+            for i in range(len(events) - 1, -1, -1):
+                if events[i].action == 'rescan' and not events[i].path:
+                    events = events[i:]
+                    break
+
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for callback in subscribers:
+                try:
+                    callback(events)
+                except Exception as e:
+                    self.logger.error(f"Error handling file changes in {callback!r}: {e}")
+
+    def _next_timeout(self, idle):
+        if not self._batch:
+            return idle
+        return max(0.05, min(self._last_event + self.debounce, self._first_event + self.max_delay) - time.time())
+
+    def _run_inotify(self):
+        inotify = Inotify()
+        self.active_backend = 'inotify'
+        watches = {}  # wd -> relative dir
+        paths = {}  # relative dir -> wd
+
+        def watch_tree(relative_dir):
+            # Watch a directory and everything below it
+            pending = [relative_dir]
+            while pending:
+                directory = pending.pop()
+                full_path = os.path.join(self.root, directory) if directory else self.root
+                try:
+                    wd = inotify.add_watch(full_path)
+                except InotifyError as e:
+                    if e.errno in (errno.ENOSPC, errno.ENOMEM):
+                        raise
+                    continue
+                watches[wd] = directory
+                paths[directory] = wd
+                self.watched_dirs = len(paths)
+                try:
+                    with os.scandir(full_path) as entries:
+                        for entry in entries:
+                            if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+                                pending.append(os.path.join(directory, entry.name) if directory else entry.name)
+                except OSError:
+                    continue
+
+        def unwatch_tree(relative_dir):
+            prefix = relative_dir + '/'
+            for directory in [p for p in paths if p == relative_dir or p.startswith(prefix)]:
+                wd = paths.pop(directory)
+                watches.pop(wd, None)
+                inotify.rm_watch(wd)
+            self.watched_dirs = len(paths)
+
+        try:
+            watch_tree('')
+            self.logger.info(f"File watcher using inotify on {len(watches)} directories")
+
+            while True:
+                for wd, mask, cookie, name in inotify.read_events(self._next_timeout(None)):
+                    if mask & IN_Q_OVERFLOW:
+                        self.logger.warning("inotify queue overflowed, scheduling a rescan")
+                        self.overflows += 1
+                        self._add_rescan()
+                        continue
+
+                    directory = watches.get(wd)
+                    if directory is None:
+                        continue
+                    if mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                        if paths.get(directory) == wd:
+                            paths.pop(directory)
+                            self.watched_dirs = len(paths)
+                        continue
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF) or not name:
+                        # Reported by the parent directory as well
+                        continue
+
+                    path = os.path.join(directory, name) if directory else name
+                    is_dir = bool(mask & IN_ISDIR)
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        if is_dir and not name.startswith('.'):
+                            watch_tree(path)
+                        self._add_event('created', path, is_dir)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        if is_dir:
+                            unwatch_tree(path)
+                        self._add_event('deleted', path, is_dir)
+                    elif not is_dir:
+                        self._add_event('modified', path, is_dir)
+
+                self._flush_if_due()
+        except InotifyError:
+            # Out of watches: polling covers the whole tree instead
+            self._flush_if_due()
+            inotify.close()
+            self.active_backend = None
+            raise
+
+    def _run_polling(self, rescan=False):
+        self.active_backend = 'poll'
+        known = {}  # relative dir -> (mtime_ns, inode)
+
+        def poll(report):
+            seen = set()
+            pending = ['']
+            while pending:
+                directory = pending.pop()
+                full_path = os.path.join(self.root, directory) if directory else self.root
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                seen.add(directory)
+                signature = (stat.st_mtime_ns, stat.st_ino)
+                previous = known.get(directory)
+                known[directory] = signature
+
+                if report and previous is None:
+                    self._add_event('created', directory, True)
+                elif report and previous != signature:
+                    self._add_event('changed', directory, True)
+
+                try:
+                    with os.scandir(full_path) as entries:
+                        for entry in entries:
+                            if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+                                pending.append(os.path.join(directory, entry.name) if directory else entry.name)
+                except OSError:
+                    continue
+
+            for directory in known.keys() - seen:
+                del known[directory]
+                if report:
+                    self._add_event('deleted', directory, True)
+            self.watched_dirs = len(known)
+
+        poll(report=False)
+        self.logger.info(f"File watcher polling {len(known)} directories every {self.poll_interval}s")
+        if rescan:
+            self._add_rescan()
+            self._flush()
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                poll(report=True)
+            except Exception as e:
+                self.logger.error(f"Error polling for file changes: {e}")
+            # A poll is already slower than the debounce window
+            self._flush()
+
+
+file_watcher = FileWatcher()
@@ -0,0 +1,351 @@
+import logging
+import os
+import stat
+import struct
+import time
+import zlib
+
+# Formats that are already compressed gain nothing from deflate, so they
+# are stored as-is and cost no CPU to pack
+STORED_EXTENSIONS = frozenset((
+    # Images
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif',
+    # Video
+    '.mp4', '.m4v', '.mkv', '.webm', '.mov', '.avi', '.wmv', '.flv', '.3gp', '.ts',
+    # Audio
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac', '.wma',
+    # Archives and packages
+    '.zip', '.rar', '.7z', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.apk', '.jar',
+    # Documents that are zip files themselves
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.pdf',
+))
+
+# Largest value the 32 bit size and offset fields of the classic format hold
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_MAX_ENTRIES = 0xFFFF
+
+# Versions needed to extract: 2.0 for deflate and data descriptors, 4.5 for ZIP64
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+# Made by Unix, so extractors apply the permissions in the external attributes
+VERSION_MADE_BY = (3 << 8) | VERSION_ZIP64
+
+# Flag bits: sizes and CRC follow the data, file names are UTF-8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<IIQI')
+
+
+class ZipEntry:
+    """A file or directory to put in the archive, as it was when listed"""
+
+    def __init__(self, path, arcname, size, mtime, is_dir, compress):
+        self.path = path
+        self.arcname = arcname + '/' if is_dir else arcname
+        self.name = self.arcname.encode('utf-8', 'surrogateescape')
+        self.size = size
+        self.mtime = mtime
+        self.is_dir = is_dir
+        self.method = METHOD_DEFLATED if compress and not is_dir and size else METHOD_STORED
+
+        # Deflate may grow incompressible data a little, so entries that
+        # come close to the limit are written as ZIP64 up front
+        limit = self.size + (self.size >> 8) + 1024 if self.method == METHOD_DEFLATED else self.size
+        self.zip64 = limit >= ZIP32_LIMIT
+
+    @property
+    def local_header_size(self):
+        return LOCAL_HEADER.size + len(self.name) + (20 if self.zip64 else 0)
+
+    @property
+    def descriptor_size(self):
+        if self.is_dir:
+            return 0
+        return DATA_DESCRIPTOR64.size if self.zip64 else DATA_DESCRIPTOR.size
+
+
+def collect_entries(storage_path, paths, compress=True):
+    """
+    List what goes into an archive of the given paths.
+
+    Folders are walked recursively and get an entry of their own, so empty
+    folders survive the round trip. Every path lands in the archive under
+    its own name, with the contents of folders below it. Hidden files and
+    symlinked folders are skipped, like in the browser, as are files that
+    cannot be read.
+
+    Args:
+        storage_path (str): Root of the storage
+        paths (list): Paths relative to storage_path, '' for all of it
+        compress (bool): Whether to deflate files that aren't compressed already
+
+    Returns:
+        list: ZipEntry objects, in archive order
+    """
+    entries = []
+    seen = set()
+
+    def add(path, arcname, st, is_dir):
+        if arcname in seen:
+            return
+        seen.add(arcname)
+        compressible = compress and os.path.splitext(arcname)[1].lower() not in STORED_EXTENSIONS
+        entries.append(ZipEntry(path, arcname, 0 if is_dir else st.st_size, st.st_mtime, is_dir, compressible))
+
+    def add_tree(path, arcname):
+        try:
+            with os.scandir(path) as it:
+                children = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in children:
+            # Skip hidden files
+            if entry.name.startswith('.'):
+                continue
+            child_arcname = f"{arcname}/{entry.name}" if arcname else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    add(entry.path, child_arcname, entry.stat(follow_symlinks=False), True)
+                    add_tree(entry.path, child_arcname)
+                elif entry.is_file() and os.access(entry.path, os.R_OK):
+                    add(entry.path, child_arcname, entry.stat(), False)
+            except OSError:
+                # Broken symlinks and entries we are not allowed to stat
+                continue
+
+    for relative_path in paths:
+        path = os.path.join(storage_path, relative_path) if relative_path else storage_path
+        arcname = os.path.basename(relative_path.rstrip('/'))
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if arcname:
+                add(path, arcname, st, True)
+            add_tree(path, arcname)
+        elif stat.S_ISREG(st.st_mode) and os.access(path, os.R_OK):
+            add(path, arcname, st, False)
+
+    return entries
+
+
+def dos_datetime(timestamp):
+    """DOS date and time fields of a timestamp, clamped to the years DOS can hold"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    if t.tm_year > 2107:
+        return (127 << 9) | (12 << 5) | 31, (23 << 11) | (59 << 5) | 29
+    date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    time_ = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return date, time_
+
+
+class ZipStream:
+    """
+    ZIP archive generated while it is sent.
+
+    Each file is read from disk in chunks, checksummed and (unless its
+    format is compressed already) deflated on the way to the socket, so
+    nothing is staged in a temporary archive and memory use doesn't grow
+    with file sizes. Only the central directory, around a hundred bytes per
+    entry, is held until the end.
+
+    Entries use data descriptors, so their CRC is written after the data
+    instead of needing a first pass over the file. ZIP64 records are added
+    for entries, offsets and entry counts past the limits of the classic
+    format. When every entry is stored, the archive size is known before
+    the first byte is sent and is available as content_length.
+
+    Files are archived at the size they had when listed: a file that grew
+    is cut off and one that shrank is padded with zeros, which keeps the
+    announced length right and is logged.
+    """
+
+    def __init__(self, entries, compress_level=6, chunk_size=1024*1024, logger=None):
+        self.entries = entries
+        self.compress_level = compress_level
+        self.chunk_size = chunk_size
+        self.logger = logger or logging.getLogger(__name__)
+        self._file = None
+        self._iterator = None
+
+    @property
+    def content_length(self):
+        """Size of the archive, or None if it depends on how well files deflate"""
+        if any(entry.method != METHOD_STORED for entry in self.entries):
+            return None
+
+        offset = 0
+        central_size = 0
+        for entry in self.entries:
+            extra, _ = self._central_extra(entry, entry.size, offset)
+            central_size += CENTRAL_HEADER.size + len(entry.name) + len(extra)
+            offset += entry.local_header_size + entry.size + entry.descriptor_size
+        return offset + central_size + self._end_size(len(self.entries), offset, central_size)
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = self._generate()
+        return self._iterator
+
+    def close(self):
+        """Close the file being read and stop the generator"""
+        if self._iterator is not None:
+            self._iterator.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _generate(self):
+        offset = 0
+        central = []
+        for entry in self.entries:
+            header_offset = offset
+            flags = FLAG_UTF8 if entry.is_dir else FLAG_UTF8 | FLAG_DATA_DESCRIPTOR
+            version = VERSION_ZIP64 if entry.zip64 else VERSION_DEFAULT
+            date, time_ = dos_datetime(entry.mtime)
+
+            header = LOCAL_HEADER.pack(
+                0x04034b50, version, flags, entry.method, time_, date, 0,
+                ZIP32_LIMIT if entry.zip64 else 0, ZIP32_LIMIT if entry.zip64 else 0,
+                len(entry.name), 20 if entry.zip64 else 0
+            ) + entry.name
+            if entry.zip64:
+                # Sizes follow in the data descriptor
+                header += struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            yield header
+            offset += len(header)
+
+            crc = 0
+            compressed_size = 0
+            if not entry.is_dir:
+                for chunk, crc in self._read_entry(entry):
+                    compressed_size += len(chunk)
+                    yield chunk
+                offset += compressed_size
+
+                if entry.zip64:
+                    descriptor = DATA_DESCRIPTOR64.pack(0x08074b50, crc, compressed_size, entry.size)
+                else:
+                    descriptor = DATA_DESCRIPTOR.pack(0x08074b50, crc, compressed_size, entry.size)
+                yield descriptor
+                offset += len(descriptor)
+
+            central.append((entry, flags, version, time_, date, crc, compressed_size, header_offset))
+
+        # Central directory, in chunks of about chunk_size
+        central_offset = offset
+        central_size = 0
+        buffer = []
+        buffered = 0
+        for entry, flags, version, time_, date, crc, compressed_size, header_offset in central:
+            extra, needs_zip64 = self._central_extra(entry, compressed_size, header_offset)
+            if needs_zip64:
+                version = VERSION_ZIP64
+            if entry.is_dir:
+                attributes = ((stat.S_IFDIR | 0o755) << 16) | 0x10
+            else:
+                attributes = (stat.S_IFREG | 0o644) << 16
+            record = CENTRAL_HEADER.pack(
+                0x02014b50, VERSION_MADE_BY, version, flags, entry.method, time_, date, crc,
+                min(compressed_size, ZIP32_LIMIT), min(entry.size, ZIP32_LIMIT),
+                len(entry.name), len(extra), 0, 0, 0, attributes, min(header_offset, ZIP32_LIMIT)
+            ) + entry.name + extra
+            buffer.append(record)
+            buffered += len(record)
+            central_size += len(record)
+            if buffered >= self.chunk_size:
+                yield b''.join(buffer)
+                buffer = []
+                buffered = 0
+
+        buffer.append(self._end_records(len(central), central_offset, central_size))
+        yield b''.join(buffer)
+
+    def _read_entry(self, entry):
+        """Yield (chunk, running CRC) pairs of the stored or deflated file data"""
+        compressor = None
+        if entry.method == METHOD_DEFLATED:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        crc = 0
+        remaining = entry.size
+        try:
+            self._file = open(entry.path, 'rb', buffering=0)
+        except OSError as e:
+            self.logger.error(f"Cannot read {entry.path} for ZIP download: {e}")
+        while remaining > 0:
+            chunk = self._file.read(min(self.chunk_size, remaining)) if self._file else b''
+            if not chunk:
+                # The file shrank (or vanished) since it was listed
+                if self._file is not None:
+                    self.logger.warning(f"{entry.path} is shorter than when listed, padding it in the ZIP download")
+                    self._file.close()
+                    self._file = None
+                chunk = bytes(min(self.chunk_size, remaining))
+            remaining -= len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk, crc
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if compressor is not None:
+            yield compressor.flush(), crc
+
+    @staticmethod
+    def _central_extra(entry, compressed_size, header_offset):
+        """ZIP64 extra field of a central directory record, if it needs one"""
+        fields = []
+        if entry.size >= ZIP32_LIMIT:
+            fields.append(entry.size)
+        if compressed_size >= ZIP32_LIMIT:
+            fields.append(compressed_size)
+        if header_offset >= ZIP32_LIMIT:
+            fields.append(header_offset)
+        if not fields:
+            return b'', False
+        return struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields), True
+
+    @staticmethod
+    def _needs_zip64_end(count, central_offset, central_size):
+        return count >= ZIP32_MAX_ENTRIES or central_offset >= ZIP32_LIMIT or central_size >= ZIP32_LIMIT
+
+    @classmethod
+    def _end_size(cls, count, central_offset, central_size):
+        size = END_RECORD.size
+        if cls._needs_zip64_end(count, central_offset, central_size):
+            size += END_RECORD64.size + END_LOCATOR64.size
+        return size
+
+    @classmethod
+    def _end_records(cls, count, central_offset, central_size):
+        records = b''
+        if cls._needs_zip64_end(count, central_offset, central_size):
+            end64_offset = central_offset + central_size
+            records += END_RECORD64.pack(
+                0x06064b50, END_RECORD64.size - 12, VERSION_MADE_BY, VERSION_ZIP64, 0, 0,
+                count, count, central_size, central_offset
+            )
+            records += END_LOCATOR64.pack(0x07064b50, 0, end64_offset, 1)
+        records += END_RECORD.pack(
+            0x06054b50, 0, 0, min(count, ZIP32_MAX_ENTRIES), min(count, ZIP32_MAX_ENTRIES),
+            min(central_size, ZIP32_LIMIT), min(central_offset, ZIP32_LIMIT), 0
+        )
+        return records
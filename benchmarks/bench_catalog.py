@@ -0,0 +1,93 @@
+"""
+Benchmark the file catalog scanner: a full scan against incremental scans of
+an unchanged tree and of a tree where a few directories changed.
+
+Usage:
+    python benchmarks/bench_catalog.py [--files 1000000] [--files-per-dir 100] [--changed-dirs 10]
+    python benchmarks/bench_catalog.py --tree /path/to/existing/tree
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config import Config
+from app import create_app
+
+
+def make_tree(path, files, files_per_dir):
+    """Create empty files spread over two levels of directories"""
+    dirs = max(1, files // files_per_dir)
+    per_group = 100
+    created = 0
+    for d in range(dirs):
+        directory = os.path.join(path, f'group {d // per_group:04d}', f'album {d:06d}')
+        os.makedirs(directory, exist_ok=True)
+        for i in range(min(files_per_dir, files - created)):
+            open(os.path.join(directory, f'IMG_{i:05d}.jpg'), 'wb').close()
+        created += files_per_dir
+        if d % 1000 == 0:
+            print(f"\rCreating tree: {min(created, files)}/{files} files", end='', flush=True)
+    print(f"\rCreating tree: {files}/{files} files")
+    return dirs
+
+
+def change_tree(path, changed_dirs):
+    """Add a file to some of the album directories"""
+    changed = 0
+    for group in sorted(os.listdir(path)):
+        for album in sorted(os.listdir(os.path.join(path, group))):
+            if changed >= changed_dirs:
+                return
+            open(os.path.join(path, group, album, f'new {time.time_ns()}.jpg'), 'wb').close()
+            changed += 1
+
+
+def report(label, stats):
+    print(f"{label:<22} {stats['duration']:8.2f} s  "
+          f"listed {stats['dirs_listed']:>7}  skipped {stats['dirs_skipped']:>7}  "
+          f"writes {stats['writes']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--changed-dirs', type=int, default=10)
+    parser.add_argument('--tree', help='Scan an existing tree instead of creating one (read-only)')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench-catalog-')
+    tree = args.tree or os.path.join(tmp, 'storage')
+
+    class BenchConfig(Config):
+        STORAGE_PATH = tree
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'catalog.db')
+        AUTH_REQUIRED = False
+
+    try:
+        if not args.tree:
+            os.makedirs(tree)
+            make_tree(tree, args.files, args.files_per_dir)
+
+        app = create_app(BenchConfig)
+        from app.files.catalog import catalog
+
+        with app.app_context():
+            report('Full scan (empty DB)', catalog.scan(full=True))
+            report('Full scan (in sync)', catalog.scan(full=True))
+            report('Incremental (no-op)', catalog.scan())
+            if not args.tree:
+                change_tree(tree, args.changed_dirs)
+                report(f'Incremental ({args.changed_dirs} dirs)', catalog.scan())
+            print(f"Catalog entries:       {catalog.stats()['entries']}")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark download throughput through gunicorn with sendfile() against the
+buffered fallback that copies the file through Python.
+
+Each mode starts a gunicorn server with one sync worker, downloads the test
+file through a share link (whole and as a Range request for its second half)
+and reports the throughput and the CPU time the server spent per GB.
+
+Usage:
+    python benchmarks/bench_download.py [--size-mb 1024] [--rounds 3] [--port 8765]
+"""
+import argparse
+import http.client
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+
+def make_file(path, size):
+    """Write size bytes of incompressible data"""
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(block[:size - written])
+            written += len(block)
+
+
+def create_share(env, file_name):
+    """Create the database and a share link, returns its token"""
+    os.environ.update(env)
+    from config import Config
+    from app import create_app, db
+    from app.auth.models import User
+    from app.files.utils import create_share_link
+
+    app = create_app(Config)
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+        return create_share_link(user.id, file_name, expiry_days=0)
+
+
+def download(port, token, headers=None):
+    """Download into a reused buffer, returns the number of bytes read"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    conn.request('GET', f'/shared/{token}/download', headers=headers or {})
+    response = conn.getresponse()
+    assert response.status in (200, 206), response.status
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    total = 0
+    while True:
+        read = response.readinto(view)
+        if not read:
+            break
+        total += read
+    conn.close()
+    return total
+
+
+def run_mode(label, sendfile, env, port, token, size, rounds):
+    server_env = dict(os.environ, **env, DOWNLOAD_SENDFILE=str(sendfile))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', '1', '--bind', f'127.0.0.1:{port}',
+         '--chdir', ROOT, '--log-level', 'warning', 'run:app'],
+        env=server_env
+    )
+    try:
+        # Wait for the server to accept connections
+        for _ in range(100):
+            try:
+                http.client.HTTPConnection('127.0.0.1', port, timeout=1).connect()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        transferred = 0
+        started = time.time()
+        for _ in range(rounds):
+            assert download(port, token) == size
+            half = size // 2
+            assert download(port, token, {'Range': f'bytes={half}-'}) == size - half
+            transferred += size + size - half
+        elapsed = time.time() - started
+    finally:
+        server.terminate()
+        # rusage of the master includes the worker it reaped on shutdown
+        _, _, usage = os.wait4(server.pid, 0)
+
+    cpu = usage.ru_utime + usage.ru_stime
+    gigabytes = transferred / 1024 ** 3
+    print(f"{label:<12} {transferred / elapsed / 1024 ** 2:9.1f} MB/s  "
+          f"server CPU {cpu / gigabytes:6.2f} s/GB  ({gigabytes:.1f} GB in {elapsed:.1f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench-download-')
+    storage = os.path.join(tmp, 'storage')
+    os.makedirs(storage)
+    env = {
+        'STORAGE_PATH': storage,
+        'DATABASE_URL': 'sqlite:///' + os.path.join(tmp, 'bench.db'),
+        'SEARCH_INDEX_PATH': os.path.join(tmp, 'search_index.db'),
+        'WATCHER_BACKEND': 'off',
+    }
+
+    try:
+        size = args.size_mb * 1024 * 1024
+        print(f"Creating {args.size_mb} MB test file")
+        make_file(os.path.join(storage, 'bench.bin'), size)
+        token = create_share(env, 'bench.bin')
+
+        run_mode('sendfile', True, env, args.port, token, size, args.rounds)
+        run_mode('buffered', False, env, args.port, token, size, args.rounds)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
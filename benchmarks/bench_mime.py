@@ -0,0 +1,67 @@
+"""
+Benchmark MIME detection: a new libmagic handle per call (what the download
+and thumbnail routes used to do) against the pooled, memoized
+detect_mime_type().
+
+Usage:
+    python benchmarks/bench_mime.py [--calls 200]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.files.utils import detect_mime_type
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+
+def per_call_handle(path):
+    return magic.Magic(mime=True).from_file(path)
+
+
+def time_calls(func, paths, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        func(paths[i % len(paths)])
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    if magic is None:
+        print("python-magic is not installed, nothing to compare")
+        return
+
+    tmp = tempfile.mkdtemp(prefix='bench-mime-')
+    try:
+        # A sniffed type (no extension) and a trusted extension
+        paths = []
+        for name, data in (('notes', b'plain text\n' * 10), ('photo.jpg', b'\xff\xd8\xff\xe0' + b'\0' * 64)):
+            path = os.path.join(tmp, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            paths.append(path)
+
+        old = time_calls(per_call_handle, paths, args.calls)
+        new = time_calls(detect_mime_type, paths, args.calls)
+
+        print(f"New handle per call:  {old * 1000:8.3f} ms/call")
+        print(f"detect_mime_type:     {new * 1000:8.3f} ms/call")
+        print(f"Speedup:              {old / new:8.1f}x")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
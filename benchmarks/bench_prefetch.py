@@ -0,0 +1,151 @@
+"""
+Benchmark media streaming with and without read-ahead prefetching.
+
+Gunicorn servers with one sync worker each (one per mode) serve a video
+through a share link to a simulated player, which fetches it as consecutive
+Range requests with a pause between them (the time it spends playing).
+Before each playback the file is dropped from the page cache, so reads hit
+the disk. Reports the
+time to first byte of each request and the throughput while fetching,
+for bodies sent with sendfile and for bodies read through Python.
+
+Usage:
+    python benchmarks/bench_prefetch.py [--size-mb 256] [--range-mb 2] [--think-ms 20] [--rounds 3] [--port 8766]
+"""
+import argparse
+import http.client
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from bench_download import make_file, create_share
+
+
+def drop_cache(path):
+    """Evict the file from the page cache"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def fetch_range(port, token, start, stop):
+    """Fetch a range, returns (time to first byte, bytes read)"""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    conn.request('GET', f'/shared/{token}/download', headers={'Range': f'bytes={start}-{stop - 1}'})
+    response = conn.getresponse()
+    assert response.status == 206, response.status
+    first = response.read(1)
+    ttfb = time.perf_counter() - started
+    total = len(first) + len(response.read())
+    conn.close()
+    return ttfb, total
+
+
+def start_server(env, port):
+    """Start a gunicorn server with the given environment"""
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', '1', '--bind', f'127.0.0.1:{port}',
+         '--chdir', ROOT, '--log-level', 'warning', 'run:app'],
+        env=dict(os.environ, **env)
+    )
+    # Wait for the server to accept connections
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection('127.0.0.1', port, timeout=1).connect()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return server
+
+
+def play(port, token, path, size, range_size, think):
+    """Play the file from a cold page cache, returns (TTFBs, seconds spent fetching)"""
+    drop_cache(path)
+    ttfbs = []
+    busy = 0
+    for start in range(0, size, range_size):
+        stop = min(start + range_size, size)
+        started = time.perf_counter()
+        ttfb, read = fetch_range(port, token, start, stop)
+        busy += time.perf_counter() - started
+        assert read == stop - start
+        ttfbs.append(ttfb)
+        time.sleep(think)
+    return ttfbs, busy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--range-mb', type=float, default=2)
+    parser.add_argument('--think-ms', type=float, default=20)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench-prefetch-')
+    storage = os.path.join(tmp, 'storage')
+    os.makedirs(storage)
+    env = {
+        'STORAGE_PATH': storage,
+        'DATABASE_URL': 'sqlite:///' + os.path.join(tmp, 'bench.db'),
+        'SEARCH_INDEX_PATH': os.path.join(tmp, 'search_index.db'),
+        'WATCHER_BACKEND': 'off',
+        # Keep the video out of the hot file cache
+        'HOT_CACHE_MAX_ENTRIES': '0',
+    }
+
+    try:
+        size = args.size_mb * 1024 * 1024
+        path = os.path.join(storage, 'bench.mp4')
+        print(f"Creating {args.size_mb} MB test video")
+        make_file(path, size)
+        token = create_share(env, 'bench.mp4')
+
+        range_size = int(args.range_mb * 1024 * 1024)
+        think = args.think_ms / 1000
+        modes = []
+        for sendfile in ('True', 'False'):
+            for prefetch in ('False', 'True'):
+                label = f"{'sendfile' if sendfile == 'True' else 'buffered'}, " \
+                        f"{'prefetch' if prefetch == 'True' else 'no prefetch'}"
+                mode_env = dict(env, DOWNLOAD_SENDFILE=sendfile, PREFETCH_ENABLED=prefetch)
+                modes.append((label, args.port + len(modes), mode_env))
+
+        # All servers run side by side and the modes take turns, so noise
+        # from the machine spreads over all of them
+        servers = [start_server(mode_env, port) for _, port, mode_env in modes]
+        results = {label: ([], []) for label, _, _ in modes}
+        try:
+            for _ in range(args.rounds):
+                for label, port, _ in modes:
+                    ttfbs, busy = play(port, token, path, size, range_size, think)
+                    results[label][0].extend(ttfbs)
+                    results[label][1].append(busy)
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+
+        for label, (ttfbs, busy) in results.items():
+            ttfbs.sort()
+            print(f"{label:<24} TTFB median {statistics.median(ttfbs) * 1000:7.2f} ms  "
+                  f"p95 {ttfbs[int(len(ttfbs) * 0.95)] * 1000:7.2f} ms  "
+                  f"throughput {size / statistics.median(busy) / 1024 ** 2:8.1f} MB/s (excluding pauses)")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
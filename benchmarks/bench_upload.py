@@ -0,0 +1,225 @@
+"""
+Benchmark upload wall-clock time of a single multipart POST to /upload
+against the chunked upload API with one and with several chunks in flight.
+
+A gunicorn server with several sync workers receives the test file in each
+mode, a fresh upload per round. Phones on Wi-Fi rarely get the whole link
+out of one TCP stream; --stream-mbps caps the rate of every connection to
+show how parallel chunks make up for that.
+
+Usage:
+    python benchmarks/bench_upload.py [--size-mb 256] [--chunk-mb 8] [--parallel 4]
+                                      [--workers 4] [--stream-mbps 0] [--rounds 3] [--port 8767]
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from bench_download import make_file
+
+BLOCK_SIZE = 64 * 1024
+
+
+class Client:
+    """HTTP client logged in as the default admin"""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+        response, body = self.request('GET', '/auth/login')
+        self.cookie = response.getheader('Set-Cookie').split(';')[0]
+        csrf_token = re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"', body).group(1).decode()
+        response, _ = self.request('POST', '/auth/login', urllib.parse.urlencode({
+            'username': 'admin', 'password': 'admin', 'csrf_token': csrf_token
+        }), {'Content-Type': 'application/x-www-form-urlencoded'})
+        assert response.status == 302, response.status
+        self.cookie = response.getheader('Set-Cookie').split(';')[0]
+
+    def request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        conn.request(method, url, body=body, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+
+def create_database(env):
+    """Create the database with the default admin before the workers start"""
+    os.environ.update(env)
+    from config import Config
+    from app import create_app
+    create_app(Config)
+
+
+def paced(blocks, rate):
+    """Yield blocks, sleeping to stay under rate bytes per second (0 is unlimited)"""
+    started = time.perf_counter()
+    sent = 0
+    for block in blocks:
+        yield block
+        sent += len(block)
+        if rate:
+            ahead = sent / rate - (time.perf_counter() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def file_blocks(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length:
+            block = f.read(min(BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def upload_single(client, path, name, rate):
+    """Send the file as one multipart POST"""
+    boundary = 'bench-upload-boundary'
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="path"\r\n\r\n\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    size = os.path.getsize(path)
+
+    def body():
+        yield head
+        yield from paced(file_blocks(path, 0, size), rate)
+        yield tail
+
+    response, data = client.request('POST', '/upload', body(), {
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Content-Length': str(len(head) + size + len(tail)),
+    })
+    assert response.status == 200, (response.status, data[:200])
+
+
+def upload_chunked(client, path, name, parallel, rate):
+    """Send the file through the chunked upload API, parallel chunks at a time"""
+    size = os.path.getsize(path)
+    response, data = client.request('POST', '/uploads', urllib.parse.urlencode({
+        'filename': name, 'size': size, 'path': ''
+    }), {'Content-Type': 'application/x-www-form-urlencoded'})
+    assert response.status == 201, (response.status, data[:200])
+    upload = json.loads(data)
+    chunk_size = upload['chunk_size']
+    chunks = list(range(len(upload['chunks'])))
+    lock = threading.Lock()
+    errors = []
+
+    def send():
+        while True:
+            with lock:
+                if not chunks or errors:
+                    return
+                index = chunks.pop(0)
+            offset = index * chunk_size
+            length = min(chunk_size, size - offset)
+            response, data = client.request('PATCH', upload['url'], paced(file_blocks(path, offset, length), rate), {
+                'Upload-Offset': str(offset),
+                'Content-Length': str(length),
+                'Content-Type': 'application/offset+octet-stream',
+            })
+            if response.status != 200:
+                errors.append((response.status, data[:200]))
+
+    threads = [threading.Thread(target=send) for _ in range(parallel)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+    response, data = client.request('POST', upload['complete_url'])
+    assert response.status == 200, (response.status, data[:200])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--chunk-mb', type=int, default=8)
+    parser.add_argument('--parallel', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--stream-mbps', type=float, default=0,
+                        help='cap on the send rate of each connection in MB/s, 0 is unlimited')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8767)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench-upload-')
+    storage = os.path.join(tmp, 'storage')
+    os.makedirs(storage)
+    env = dict(
+        STORAGE_PATH=storage,
+        DATABASE_URL='sqlite:///' + os.path.join(tmp, 'bench.db'),
+        SEARCH_INDEX_PATH=os.path.join(tmp, 'search_index.db'),
+        WATCHER_BACKEND='off',
+        UPLOAD_CHUNK_SIZE=str(args.chunk_mb * 1024 * 1024),
+    )
+    server = None
+
+    try:
+        size = args.size_mb * 1024 * 1024
+        source = os.path.join(tmp, 'source.bin')
+        print(f"Creating {args.size_mb} MB test file")
+        make_file(source, size)
+        create_database(env)
+
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}',
+             '--chdir', ROOT, '--log-level', 'warning', '--timeout', '600', 'run:app'],
+            env=dict(os.environ, **env)
+        )
+        # Wait for the server to accept connections
+        for _ in range(100):
+            try:
+                http.client.HTTPConnection('127.0.0.1', args.port, timeout=1).connect()
+                break
+            except OSError:
+                time.sleep(0.1)
+        client = Client(args.port)
+
+        rate = args.stream_mbps * 1024 * 1024
+        modes = [
+            ('single POST /upload', lambda name: upload_single(client, source, name, rate)),
+            ('chunked, 1 stream', lambda name: upload_chunked(client, source, name, 1, rate)),
+            (f'chunked, {args.parallel} streams', lambda name: upload_chunked(client, source, name, args.parallel, rate)),
+        ]
+        for label, upload in modes:
+            times = []
+            for round_number in range(args.rounds):
+                name = f'upload-{len(times)}-{round_number}.bin'
+                started = time.perf_counter()
+                upload(name)
+                times.append(time.perf_counter() - started)
+                assert os.path.getsize(os.path.join(storage, name)) == size
+                os.remove(os.path.join(storage, name))
+            best = min(times)
+            print(f"{label:<24} best {best:7.2f} s  {size / best / 1024 ** 2:8.1f} MB/s")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
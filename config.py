@@ -12,12 +12,127 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///termux_nas.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Seconds a request waits on SQLite while a background task (catalog
+    # scan, file hashing) is writing, before failing with "database is locked"
+    DATABASE_BUSY_TIMEOUT = float(os.environ.get('DATABASE_BUSY_TIMEOUT') or 30)
+    if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': DATABASE_BUSY_TIMEOUT}}
+
     # Storage configuration
     STORAGE_PATH = os.environ.get('STORAGE_PATH') or '/data/data/com.termux/files/home/nasmux'
 
     # File upload configuration
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_UPLOAD_SIZE') or 50 * 1024 * 1024 * 1024)  # 50GB default
 
+    # The browser sends files as resumable uploads in UPLOAD_CHUNK_SIZE
+    # requests, UPLOAD_PARALLEL_CHUNKS of them at once. Uploads nobody wrote
+    # to for UPLOAD_EXPIRY seconds are removed.
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE') or 8 * 1024 * 1024)  # 8MB default
+    UPLOAD_PARALLEL_CHUNKS = int(os.environ.get('UPLOAD_PARALLEL_CHUNKS') or 4)
+    UPLOAD_EXPIRY = int(os.environ.get('UPLOAD_EXPIRY') or 86400)  # 1 day default
+
+    # Uploads that would leave less than UPLOAD_DISK_RESERVE bytes free on
+    # the storage disk are rejected before they are sent
+    UPLOAD_DISK_RESERVE = int(os.environ.get('UPLOAD_DISK_RESERVE') or 256 * 1024 * 1024)  # 256MB default
+
+    # Uploads whose content is already stored become hardlinks to the
+    # existing file. Linked files share their content, so editing one in
+    # place (outside the web UI) changes all of them.
+    DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'False').lower() in ('true', 'yes', '1')
+    # Files stored before, or changed outside the web UI, are hashed in the
+    # background every DEDUP_HASH_INTERVAL seconds
+    DEDUP_HASH_INTERVAL = int(os.environ.get('DEDUP_HASH_INTERVAL') or 300)
+
+    # Downloads hand the open file to the server's wsgi.file_wrapper, which
+    # gunicorn sends with sendfile(). Servers without it, or with
+    # DOWNLOAD_SENDFILE off, get the file read in DOWNLOAD_CHUNK_SIZE chunks.
+    DOWNLOAD_SENDFILE = os.environ.get('DOWNLOAD_SENDFILE', 'True').lower() in ('true', 'yes', '1')
+    DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE') or 1024 * 1024)  # 1MB default
+
+    # At most DOWNLOAD_MAX_STREAMS downloads are sent at once, others wait up
+    # to DOWNLOAD_QUEUE_TIMEOUT seconds for a slot. Default rate limits in
+    # bytes per second (0 is unlimited) for users and share links without
+    # their own limit, which admins set on the Bandwidth page.
+    DOWNLOAD_MAX_STREAMS = int(os.environ.get('DOWNLOAD_MAX_STREAMS') or 8)
+    DOWNLOAD_QUEUE_TIMEOUT = float(os.environ.get('DOWNLOAD_QUEUE_TIMEOUT') or 30)
+    DOWNLOAD_USER_RATE_LIMIT = int(os.environ.get('DOWNLOAD_USER_RATE_LIMIT') or 0)
+    DOWNLOAD_SHARE_RATE_LIMIT = int(os.environ.get('DOWNLOAD_SHARE_RATE_LIMIT') or 0)
+
+    # Deflate level (1-9) of files in ZIP downloads that aren't compressed
+    # already. 0 stores everything, which lets the archive size be sent up front.
+    ZIP_COMPRESSION_LEVEL = int(os.environ.get('ZIP_COMPRESSION_LEVEL') or 6)
+
+    # Text responses (pages, JSON, text file downloads) of at least
+    # COMPRESS_MIN_SIZE bytes are compressed with gzip, or brotli and zstd
+    # when their packages are installed and the client accepts them
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', 'True').lower() in ('true', 'yes', '1')
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY') or 5)
+    COMPRESS_ZSTD_LEVEL = int(os.environ.get('COMPRESS_ZSTD_LEVEL') or 3)
+
+    # Text files downloaded COMPRESS_CACHE_MIN_HITS times keep their
+    # compressed copy on disk, in the instance folder by default
+    COMPRESS_CACHE_PATH = os.environ.get('COMPRESS_CACHE_PATH')
+    COMPRESS_CACHE_MAX_BYTES = int(os.environ.get('COMPRESS_CACHE_MAX_BYTES') or 256 * 1024 * 1024)  # 256MB default
+    COMPRESS_CACHE_MIN_HITS = int(os.environ.get('COMPRESS_CACHE_MIN_HITS') or 2)
+
+    # Files downloaded HOT_CACHE_MIN_HITS times are kept in memory (up to
+    # HOT_CACHE_MAX_FILE_SIZE each) by every worker process
+    HOT_CACHE_MAX_ENTRIES = int(os.environ.get('HOT_CACHE_MAX_ENTRIES') or 256)
+    HOT_CACHE_MAX_BYTES = int(os.environ.get('HOT_CACHE_MAX_BYTES') or 64 * 1024 * 1024)  # 64MB default
+    HOT_CACHE_MAX_FILE_SIZE = int(os.environ.get('HOT_CACHE_MAX_FILE_SIZE') or 1024 * 1024)  # 1MB default
+    HOT_CACHE_MIN_HITS = int(os.environ.get('HOT_CACHE_MIN_HITS') or 2)
+
+    # Video and audio played sequentially get the next PREFETCH_WINDOW bytes
+    # read ahead on PREFETCH_WORKERS background threads, and bodies read
+    # through Python keep PREFETCH_BUFFER_CHUNKS chunks in flight
+    PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', 'True').lower() in ('true', 'yes', '1')
+    PREFETCH_WINDOW = int(os.environ.get('PREFETCH_WINDOW') or 8 * 1024 * 1024)  # 8MB default
+    PREFETCH_BUFFER_CHUNKS = int(os.environ.get('PREFETCH_BUFFER_CHUNKS') or 4)
+    PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS') or 4)
+
+    # Seconds browsers may show a cached thumbnail before revalidating it
+    THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE') or 3600)
+
+    # Directory listing cache (per worker process)
+    LISTING_CACHE_MAX_ENTRIES = int(os.environ.get('LISTING_CACHE_MAX_ENTRIES') or 64)
+    LISTING_CACHE_MAX_BYTES = int(os.environ.get('LISTING_CACHE_MAX_BYTES') or 32 * 1024 * 1024)  # 32MB default
+
+    # Storage usage totals are kept up to date incrementally and reconciled
+    # with a full scan of STORAGE_PATH at this interval (seconds)
+    USAGE_RECONCILE_INTERVAL = int(os.environ.get('USAGE_RECONCILE_INTERVAL') or 3600)
+
+    # Filename search index, stored next to the database by default and
+    # reconciled with a full scan of STORAGE_PATH at this interval (seconds)
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH')
+    SEARCH_INDEX_RESCAN_INTERVAL = int(os.environ.get('SEARCH_INDEX_RESCAN_INTERVAL') or 3600)
+
+    # Optional full-text index of text files for content search. Files
+    # larger than CONTENT_INDEX_MAX_FILE_SIZE are not indexed.
+    CONTENT_INDEX_ENABLED = os.environ.get('CONTENT_INDEX_ENABLED', 'False').lower() in ('true', 'yes', '1')
+    CONTENT_INDEX_PATH = os.environ.get('CONTENT_INDEX_PATH')
+    CONTENT_INDEX_MAX_FILE_SIZE = int(os.environ.get('CONTENT_INDEX_MAX_FILE_SIZE') or 5 * 1024 * 1024)  # 5MB default
+    CONTENT_INDEX_RESCAN_INTERVAL = int(os.environ.get('CONTENT_INDEX_RESCAN_INTERVAL') or 3600)
+
+    # File catalog: directories whose mtime changed are re-listed at
+    # CATALOG_SCAN_INTERVAL, every directory at CATALOG_FULL_SCAN_INTERVAL (seconds)
+    CATALOG_SCAN_INTERVAL = int(os.environ.get('CATALOG_SCAN_INTERVAL') or 300)
+    CATALOG_FULL_SCAN_INTERVAL = int(os.environ.get('CATALOG_FULL_SCAN_INTERVAL') or 86400)
+
+    # Changes made outside the web UI are picked up by a file watcher:
+    # 'auto' uses inotify where available and polls directory mtimes every
+    # WATCHER_POLL_INTERVAL seconds otherwise, 'off' disables it. Events are
+    # published once none arrived for WATCHER_DEBOUNCE seconds.
+    WATCHER_BACKEND = os.environ.get('WATCHER_BACKEND') or 'auto'
+    WATCHER_POLL_INTERVAL = float(os.environ.get('WATCHER_POLL_INTERVAL') or 10)
+    WATCHER_DEBOUNCE = float(os.environ.get('WATCHER_DEBOUNCE') or 0.5)
+
+    # CPU, memory and disk usage are sampled in the background at this
+    # interval (seconds), keeping the last SYSTEM_SAMPLE_HISTORY samples
+    SYSTEM_SAMPLE_INTERVAL = float(os.environ.get('SYSTEM_SAMPLE_INTERVAL') or 2)
+    SYSTEM_SAMPLE_HISTORY = int(os.environ.get('SYSTEM_SAMPLE_HISTORY') or 150)
+
     # Sharing configuration
     SHARE_LINK_EXPIRY = int(os.environ.get('SHARE_LINK_EXPIRY') or 7)  # 7 days default
 
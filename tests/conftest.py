@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app
+from config import Config
+
+# Small chunks, so a few KB of test data make a multi-chunk upload
+CHUNK_SIZE = 4096
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """One application for the whole run, the file services are process-wide singletons"""
+    tmp = tmp_path_factory.mktemp('webstorage')
+
+    class TestConfig(Config):
+        TESTING = True
+        WTF_CSRF_ENABLED = False
+        STORAGE_PATH = str(tmp / 'storage')
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp / 'termux_nas.db')
+        SEARCH_INDEX_PATH = str(tmp / 'search_index.db')
+        CONTENT_INDEX_PATH = str(tmp / 'content_index.db')
+        COMPRESS_CACHE_PATH = str(tmp / 'compressed')
+        UPLOAD_CHUNK_SIZE = CHUNK_SIZE
+        UPLOAD_DISK_RESERVE = 0
+        DEDUP_ENABLED = True
+        WATCHER_BACKEND = 'off'
+
+    return create_app(TestConfig)
+
+
+@pytest.fixture
+def storage(app):
+    """The storage directory, emptied after the test"""
+    root = app.config['STORAGE_PATH']
+    yield root
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+@pytest.fixture
+def client(app, storage):
+    """Test client logged in as the default admin"""
+    client = app.test_client()
+    response = client.post('/auth/login', data={'username': 'admin', 'password': 'admin'})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+DATA = bytes(range(256)) * 16
+URL = '/download/data.bin'
+
+
+@pytest.fixture
+def stored_file(storage):
+    path = os.path.join(storage, 'data.bin')
+    with open(path, 'wb') as f:
+        f.write(DATA)
+    return path
+
+
+def get(client, url, **headers):
+    response = client.get(url, headers=headers)
+    # Read the streamed body before the file is closed
+    response.get_data()
+    response.close()
+    return response
+
+
+def test_download_sends_validators(client, stored_file):
+    response = get(client, URL)
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['ETag'].startswith('"')
+    assert 'Last-Modified' in response.headers
+
+
+def test_conditional_download(client, stored_file):
+    etag = get(client, URL).headers['ETag']
+    last_modified = get(client, URL).headers['Last-Modified']
+
+    assert get(client, URL, **{'If-None-Match': etag}).status_code == 304
+    assert get(client, URL, **{'If-Modified-Since': last_modified}).status_code == 304
+    assert get(client, URL, **{'If-None-Match': '"stale"'}).status_code == 200
+
+    # A changed file gets another ETag
+    with open(stored_file, 'ab') as f:
+        f.write(b'more')
+    response = get(client, URL, **{'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_range_download(client, stored_file):
+    response = get(client, URL, Range='bytes=10-19')
+    assert response.status_code == 206
+    assert response.data == DATA[10:20]
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(DATA)}'
+
+    response = get(client, URL, Range='bytes=-5')
+    assert response.status_code == 206
+    assert response.data == DATA[-5:]
+
+    response = get(client, URL, Range='bytes=0-1,5-6')
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert f'Content-Range: bytes 5-6/{len(DATA)}'.encode() in response.data
+
+    response = get(client, URL, Range=f'bytes={len(DATA)}-')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_if_range(client, stored_file):
+    etag = get(client, URL).headers['ETag']
+
+    response = get(client, URL, Range='bytes=0-9', **{'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == DATA[:10]
+
+    # The client's copy is outdated, it gets the whole file
+    response = get(client, URL, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == DATA
@@ -0,0 +1,151 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from app.files.uploads import ReceivedFile, UploadError, upload_manager
+from conftest import CHUNK_SIZE
+
+
+def create_upload(client, filename, size, **fields):
+    return client.post('/uploads', data=dict(filename=filename, size=str(size), path='', **fields))
+
+
+def write_chunk(client, upload, data, index):
+    start = index * CHUNK_SIZE
+    return client.patch(upload['url'], data=data[start:start + CHUNK_SIZE],
+                        headers={'Upload-Offset': str(start)})
+
+
+def upload_file(client, filename, data):
+    response = create_upload(client, filename, len(data))
+    assert response.status_code == 201
+    upload = response.get_json()
+    for index in range(len(upload['chunks'])):
+        assert write_chunk(client, upload, data, index).status_code == 200
+    return client.post(upload['complete_url'])
+
+
+def upload_files(storage):
+    """Hidden files of uploads in progress"""
+    return [name for name in os.listdir(storage) if name.startswith('.upload-')]
+
+
+def test_resumable_upload_out_of_order(client, storage):
+    data = os.urandom(2 * CHUNK_SIZE + 1000)
+    response = create_upload(client, 'out-of-order.bin', len(data))
+    assert response.status_code == 201
+    upload = response.get_json()
+    assert upload['chunks'] == '000'
+    assert upload['offset'] == 0
+
+    # A gap before the chunk keeps the offset at the start
+    response = write_chunk(client, upload, data, 1)
+    assert response.status_code == 200
+    assert response.headers['Upload-Offset'] == '0'
+    response = client.head(upload['url'])
+    assert response.status_code == 200
+    assert response.headers['Upload-Offset'] == '0'
+    assert response.headers['Upload-Length'] == str(len(data))
+
+    response = client.post(upload['complete_url'])
+    assert response.status_code == 409
+    assert response.get_json()['chunks'] == '010'
+
+    assert write_chunk(client, upload, data, 0).headers['Upload-Offset'] == str(2 * CHUNK_SIZE)
+    assert write_chunk(client, upload, data, 2).headers['Upload-Offset'] == str(len(data))
+    status = client.get(upload['url']).get_json()
+    assert status['chunks'] == '111'
+    assert status['received'] == len(data)
+
+    response = client.post(upload['complete_url'])
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['complete']
+    assert result['sha256'] == hashlib.sha256(data).hexdigest()
+    with open(os.path.join(storage, 'out-of-order.bin'), 'rb') as f:
+        assert f.read() == data
+    assert upload_files(storage) == []
+
+    # Finished uploads are gone
+    assert client.get(upload['url']).status_code == 404
+    assert client.post(upload['complete_url']).status_code == 404
+
+
+def test_resumable_upload_resumes_by_fingerprint(client, storage):
+    data = os.urandom(2 * CHUNK_SIZE)
+    upload = create_upload(client, 'resumed.bin', len(data), fingerprint='abc').get_json()
+    write_chunk(client, upload, data, 0)
+
+    response = create_upload(client, 'resumed.bin', len(data), fingerprint='abc')
+    resumed = response.get_json()
+    assert resumed['id'] == upload['id']
+    assert resumed['offset'] == CHUNK_SIZE
+    assert resumed['chunks'] == '10'
+
+
+def test_resumable_upload_rejects_bad_writes(client, storage):
+    data = os.urandom(2 * CHUNK_SIZE)
+    upload = create_upload(client, 'bad-writes.bin', len(data)).get_json()
+
+    response = client.patch(upload['url'], data=data[:10], headers={'Upload-Offset': '1'})
+    assert response.status_code == 409
+    response = client.patch(upload['url'], data=data[:10])
+    assert response.status_code == 400
+    response = client.patch(upload['url'], data=data + b'x', headers={'Upload-Offset': '0'})
+    assert response.status_code == 413
+
+    assert client.delete(upload['url']).status_code == 200
+    assert client.head(upload['url']).status_code == 404
+    assert upload_files(storage) == []
+
+
+def test_upload_rejected_when_disk_is_full(client, storage, monkeypatch):
+    # Leave nothing to uploads, whatever the disk has free
+    free = upload_manager.free_space(storage)
+    monkeypatch.setattr(upload_manager, 'disk_reserve', free)
+
+    response = create_upload(client, 'too-large.bin', CHUNK_SIZE)
+    assert response.status_code == 507
+    assert upload_files(storage) == []
+
+    response = client.post('/upload', data={'file': (io.BytesIO(b'x' * 100), 'form.txt'), 'path': ''},
+                           content_type='multipart/form-data')
+    assert response.status_code == 507
+    assert not os.path.exists(os.path.join(storage, 'form.txt'))
+
+
+def test_duplicate_upload_is_linked(client, storage):
+    data = os.urandom(CHUNK_SIZE + 100)
+    assert upload_file(client, 'original.bin', data).status_code == 200
+
+    result = upload_file(client, 'copy.bin', data).get_json()
+    assert result['deduplicated']
+    original = os.stat(os.path.join(storage, 'original.bin'))
+    copy = os.stat(os.path.join(storage, 'copy.bin'))
+    assert copy.st_ino == original.st_ino
+
+    # Clients sending the hash first skip the transfer
+    sha256 = hashlib.sha256(data).hexdigest()
+    response = client.get('/uploads/lookup', query_string={'sha256': sha256, 'size': len(data)})
+    assert response.get_json()['exists']
+    response = create_upload(client, 'linked.bin', len(data), sha256=sha256)
+    assert response.status_code == 201
+    assert response.get_json()['deduplicated']
+    assert os.stat(os.path.join(storage, 'linked.bin')).st_ino == original.st_ino
+    assert upload_files(storage) == []
+
+
+def test_admission_counts_uploads_in_flight(app, storage, monkeypatch):
+    monkeypatch.setattr(upload_manager, 'free_space', lambda directory: 10 * CHUNK_SIZE)
+    receiving = ReceivedFile('in-flight.bin', os.path.join(storage, '.upload-x.tmp'), 8 * CHUNK_SIZE)
+    upload_manager._receiving.add(receiving)
+    try:
+        with app.app_context():
+            upload_manager.admit(storage, 2 * CHUNK_SIZE)
+            with pytest.raises(UploadError) as error:
+                upload_manager.admit(storage, 2 * CHUNK_SIZE + 1)
+            assert error.value.status == 507
+    finally:
+        upload_manager._receiving.discard(receiving)